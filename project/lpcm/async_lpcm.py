@@ -0,0 +1,127 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
+from key import LPCMKey
+from lpm import MISSING
+from shortcuts import LPCM
+from single_flight import SingleFlight
+from thread_local import is_in_test, lpcm_thread_local
+import config
+
+class AsyncLargePersistentCachedMap(object):
+  """ A non-blocking interface to an LPCM, for callers that cannot wait on memcached or dynamodb.
+    The calls run on a process-wide pool of LPCM_ASYNC_THREADS threads, and every method returns
+    right away with an AsyncResult: call .get(timeout) on it, or pass a callback, which is called
+    with the result on success.
+    Concurrent get()s of the same key share a single request.
+    m = AsyncLargePersistentCachedMap("my_table")
+    m.set("key1", "some string")
+    m.get("key1", callback = handle_value)
+    print m.get_many(["key1", "key2"]).get(timeout = 1)
+    keys = m.iterkeys()
+    print keys.next_batch().get(timeout = 1)
+  """
+  class Constants(object):
+    BATCH_SIZE = 100 # items per next_batch() of the iterators
+
+  _pool = None
+  _pool_lock = threading.Lock()
+
+  def __init__(self, name, **kwargs):
+    "kwargs are passed to shortcuts.LPCM, so cache-only maps are made in tests and debug too"
+    self.name = name
+    self.map = LPCM(name, **kwargs)
+    self._reads = SingleFlight()
+
+  def get(self, k, d = None, callback = None):
+    return self._submit(self._coalesced_get, (k, d), callback = callback)
+
+  def get_many(self, keys, callback = None):
+    return self._submit(self.map.get_many, (list(keys),), callback = callback)
+
+  def set(self, k, v, callback = None):
+    return self._submit(self.map.__setitem__, (k, v), callback = callback)
+
+  def set_many(self, mapping, callback = None):
+    return self._submit(self.map.set_many, (dict(mapping),), callback = callback)
+
+  def delete(self, k, callback = None):
+    return self._submit(self.map.delete, (k,), callback = callback)
+
+  def increment(self, k, value = 1, callback = None):
+    return self._submit(self.map.increment, (k, value), callback = callback)
+
+  def decrement(self, k, value = 1, callback = None):
+    return self._submit(self.map.decrement, (k, value), callback = callback)
+
+  def iterkeys(self, batch_size = None, **kwargs):
+    """ Returns an AsyncIterator over the keys. kwargs (segments, request_limit, consistent_read)
+    are passed to the map's iterkeys """
+    return AsyncIterator(self, self.map.iterkeys(**kwargs), batch_size)
+
+  def iteritems(self, batch_size = None, **kwargs):
+    "Returns an AsyncIterator over the (key, value) items. See iterkeys"
+    return AsyncIterator(self, self.map.iteritems(**kwargs), batch_size)
+
+  def itervalues(self, batch_size = None, **kwargs):
+    "Returns an AsyncIterator over the values. See iterkeys"
+    return AsyncIterator(self, self.map.itervalues(**kwargs), batch_size)
+
+  def keys(self, callback = None):
+    """ Note: this method is EXPENSIVE! PLease only use if absolutely needed"""
+    return self._submit(self.map.keys, (), callback = callback)
+
+  def items(self, callback = None):
+    """ Note: this method is EXPENSIVE! PLease only use if absolutely needed"""
+    return self._submit(self.map.items, (), callback = callback)
+
+  def _coalesced_get(self, k, d):
+    cmp_key = LPCMKey.get(self.name, k)
+    value = self._reads.do((is_in_test(), cmp_key.cache_key), lambda: self.map.get(cmp_key, MISSING))
+    if value is MISSING:
+      return d # each caller has its own default
+    return value
+
+  def _submit(self, func, args, callback):
+    return self.get_pool().apply_async(_run_as, (is_in_test(), func, args), callback = callback)
+
+  @classmethod
+  def get_pool(cls):
+    if cls._pool is None:
+      with cls._pool_lock:
+        if cls._pool is None:
+          cls._pool = ThreadPool(config.LPCM_ASYNC_THREADS)
+    return cls._pool
+
+
+class AsyncIterator(object):
+  """ Streams the items of a map iterator, which is advanced in the pool threads.
+    next_batch() returns an AsyncResult of the next list of at most batch_size items, and an
+    empty list once the iteration is over. Batches are read in order, one at a time """
+  def __init__(self, async_map, iterator, batch_size = None):
+    self._map = async_map
+    self._iterator = iterator
+    self._batch_size = batch_size or AsyncLargePersistentCachedMap.Constants.BATCH_SIZE
+    self._lock = threading.Lock()
+
+  def next_batch(self, callback = None):
+    return self._map._submit(self._next_batch, (), callback = callback)
+
+  def close(self):
+    "Stops the iteration, and the dynamodb queries behind it"
+    with self._lock:
+      close = getattr(self._iterator, 'close', None)
+      if close is not None:
+        close()
+
+  def _next_batch(self):
+    with self._lock:
+      return list(itertools.islice(self._iterator, self._batch_size))
+
+def _run_as(in_test, func, args):
+  "Runs func in a pool thread, with the test mode of the calling thread (see LPCMKey)"
+  lpcm_thread_local.is_in_test = in_test
+  return func(*args)
@@ -0,0 +1,2 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
@@ -0,0 +1,39 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import random
+import string
+import timeit
+from ..codec import Codec, msgpack, lz4_block
+
+def sample_values():
+  random.seed(0)
+  words = [''.join(random.choice(string.ascii_lowercase) for _ in xrange(random.randint(3, 10)))
+    for _ in xrange(500)]
+  return [
+    ("short string", "some short string"),
+    ("10kb text", ' '.join(random.choice(words) for _ in xrange(1500))[:10 * 1024]),
+    ("1000 int set", set(random.randint(0, 10 ** 9) for _ in xrange(1000))),
+    ("500 string set", set(words)),
+    ]
+
+def codecs():
+  serializers = ['pickle', 'marshal'] + (['msgpack'] if msgpack else [])
+  compressions = [None, 'zlib'] + (['lz4'] if lz4_block else [])
+  for serializer in serializers:
+    for compression in compressions:
+      yield Codec(serializer, compression, compress_threshold = 1024)
+
+def run(repeat = 1000):
+  """ Returns report lines with the encode and decode time (microseconds per value)
+  and the encoded size of some typical values, for every available codec """
+  lines = ["{:<16} {:<8} {:<6} {:>10} {:>10} {:>8}".format(
+    "value", "format", "comp", "encode us", "decode us", "bytes")]
+  for name, value in sample_values():
+    for codec in codecs():
+      data = codec.encode(value)
+      encode_time = timeit.timeit(lambda: codec.encode(value), number = repeat)
+      decode_time = timeit.timeit(lambda: Codec.decode(data), number = repeat)
+      lines.append("{:<16} {:<8} {:<6} {:>10.1f} {:>10.1f} {:>8}".format(name, codec.serializer,
+        codec.compression, encode_time * 1e6 / repeat, decode_time * 1e6 / repeat, len(data)))
+  return lines
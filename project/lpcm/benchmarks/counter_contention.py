@@ -0,0 +1,48 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import operator
+import threading
+import time
+from ..cache import Cache
+from ..key import LPCMKey
+
+MAP_NAME = "__lpcm_benchmark_counters"
+
+def _hammer(update, num_threads, increments_per_thread):
+  "Runs update() from num_threads threads at once. Returns the elapsed time and the errors"
+  errors = []
+  def worker():
+    for _ in xrange(increments_per_thread):
+      try:
+        update()
+      except Cache.AtomicUpdateError as e:
+        errors.append(e)
+  threads = [threading.Thread(target = worker) for _ in xrange(num_threads)]
+  started = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return time.time() - started, errors
+
+def run(num_threads = 32, increments_per_thread = 200):
+  """ Increments a single memcached key from many threads, with memcached's incr and with
+  the CAS loop, and reports the throughput, the failed updates and whether any were lost """
+  cache = Cache(0)
+  cache_key = LPCMKey(MAP_NAME, "counter").cache_key
+  modes = [
+    ("incr", lambda: cache.incr(cache_key, 1, initial_value = 0)),
+    ("cas", lambda: cache.atomic_update(cache_key, 1, operator.add, default_value = 0)),
+    ]
+  lines = ["{} threads x {} increments of one key".format(num_threads, increments_per_thread),
+    "{:<6} {:>10} {:>8} {:>8} {:>8}".format("mode", "ops/s", "errors", "final", "lost")]
+  for name, update in modes:
+    cache.delete(cache_key)
+    elapsed, errors = _hammer(update, num_threads, increments_per_thread)
+    expected = num_threads * increments_per_thread - len(errors)
+    final = cache.get(cache_key) or 0
+    lines.append("{:<6} {:>10.0f} {:>8} {:>8} {:>8}".format(name,
+      num_threads * increments_per_thread / elapsed, len(errors), final, expected - final))
+  cache.delete(cache_key)
+  return lines
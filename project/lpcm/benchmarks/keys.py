@@ -0,0 +1,23 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import timeit
+from ..key import LPCMKey
+
+MAP_NAME = "__lpcm_benchmark_keys"
+
+def run(repeat = 100000):
+  "Reports the time it takes to build a key (microseconds per key) with and without the memo"
+  samples = [
+    ("short string", "user_123"),
+    ("long unicode", 'Ivan Krsti\xc4\x87 '.decode('utf8') * 10),
+    ("tuple", (123, "abc")),
+    ]
+  lines = ["{:<14} {:>8} {:>8} {:>8}".format("key", "base32", "hex", "memo")]
+  for name, key in samples:
+    base32 = timeit.timeit(lambda: LPCMKey(MAP_NAME, key, 'base32'), number = repeat)
+    hex = timeit.timeit(lambda: LPCMKey(MAP_NAME, key, 'hex'), number = repeat)
+    memo = timeit.timeit(lambda: LPCMKey.get(MAP_NAME, key), number = repeat)
+    lines.append("{:<14} {:>8.2f} {:>8.2f} {:>8.2f}".format(name,
+      base32 * 1e6 / repeat, hex * 1e6 / repeat, memo * 1e6 / repeat))
+  return lines
@@ -1,65 +1,395 @@
 # Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
 # Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
 
+import operator
+import random
+import time
 from django.core.cache import get_cache, InvalidCacheBackendError
 from django.core.cache import cache as default_cache
+from codec import Codec
+from local_cache import LocalCache
 import config
+import invalidation
 
 try:
   LPCM_CACHE = get_cache('lpcm')
 except InvalidCacheBackendError:
   LPCM_CACHE  = default_cache
 
+# The in-process tier in front of LPCM_CACHE, shared by all maps created with local_cache = True
+LPCM_LOCAL_CACHE = LocalCache(
+  max_entries = config.LPCM_LOCAL_CACHE_MAX_ENTRIES,
+  max_bytes = config.LPCM_LOCAL_CACHE_MAX_BYTES,
+  timeout = config.LPCM_LOCAL_CACHE_TIMEOUT)
+
+class KeyMissing(object):
+  "Cached in place of a value, to remember that the key does not exist (negative caching)"
+  pass
+
 class Cache(object):
+  class Constants(object):
+    TOKEN_TIMEOUT = 2 # expected time for a dynamo-db transaction
+    KEY_MISSING = "key_missing"
+    LEASED = "leased" # returned by get_with_lease when the caller got the token
+    CAS_MAX_RETRIES = 10
+    CAS_BACKOFF = 0.001 # seconds before the first retry. doubled on every retry
 
-  def __init__(self, timeout):
+  class AtomicUpdateError(Exception):
+    "Raised when an atomic update keeps failing because of other clients updating the same key"
+    pass
+
+  def __init__(self, timeout, negative_timeout = None, local_cache = False, codec = None):
+    """ When negative_timeout is set, keys that are found missing are remembered
+    for negative_timeout seconds. Any write to the key replaces the record.
+    When local_cache is True, values are also kept in LPCM_LOCAL_CACHE, in front of memcached.
+    Writes made by other processes only invalidate the local copies if an invalidation
+    broadcaster is configured.
+    With a codec, values are saved in memcached encoded (and compressed if large). The local
+    copies are kept decoded. """
     if timeout is None:
       timeout = config.LPCM_CACHE_TIMEOUT
     self.timeout = timeout
+    self.negative_timeout = negative_timeout
+    self.codec = codec
+    self.local = None
+    if local_cache:
+      self.local = LPCM_LOCAL_CACHE
+      self.local_timeout = config.LPCM_LOCAL_CACHE_TIMEOUT
+      if timeout:
+        self.local_timeout = min(self.local_timeout, timeout)
+
+  @staticmethod
+  def is_missing(value):
+    "True if a cached value records that the key does not exist"
+    return isinstance(value, KeyMissing)
 
   def get(self, key):
-    return LPCM_CACHE.get(key)
+    if self.local is None:
+      return self._decode(LPCM_CACHE.get(key))
+    invalidation.evict_invalidated_keys(self.local)
+    value = self.local.get(key)
+    if value is None:
+      value = self._decode(LPCM_CACHE.get(key))
+      if value is not None:
+        self.local.set(key, value, self.local_timeout)
+    return value
+
+  def set_missing(self, keys):
+    "Records that the given keys do not exist, if negative caching is enabled"
+    if not self.negative_timeout or not keys:
+      return None
+    if self.local is not None:
+      for key in keys:
+        self.local.set(key, KeyMissing(), min(self.negative_timeout, self.local_timeout))
+    return LPCM_CACHE.set_many(dict((key, KeyMissing()) for key in keys), self.negative_timeout)
 
   def set(self, key, value):
-    return LPCM_CACHE.set(key, value, self.timeout)
+    if self.local is not None:
+      self.local.set(key, value, self.local_timeout)
+    return LPCM_CACHE.set(key, self._encode(value), self.timeout)
+
+  def add(self, key, value):
+    "Sets the value only if the key is not cached. Returns True if it was set"
+    if self.local is not None:
+      self.local.delete(key)
+    return LPCM_CACHE.add(key, self._encode(value), self.timeout)
 
   def delete(self, key):
+    if self.local is not None:
+      self.local.delete(key)
     return LPCM_CACHE.delete(key)
 
+  def get_many(self, keys):
+    "Returns a dict of the keys found in cache, in a single round trip"
+    if self.local is None:
+      return self._decode_many(LPCM_CACHE.get_many(keys))
+    invalidation.evict_invalidated_keys(self.local)
+    found = {}
+    for key in keys:
+      value = self.local.get(key)
+      if value is not None:
+        found[key] = value
+    missing = [key for key in keys if key not in found]
+    if missing:
+      from_cache = self._decode_many(LPCM_CACHE.get_many(missing))
+      for key, value in from_cache.iteritems():
+        self.local.set(key, value, self.local_timeout)
+      found.update(from_cache)
+    return found
+
+  def set_many(self, mapping):
+    if self.local is not None:
+      for key, value in mapping.iteritems():
+        self.local.set(key, value, self.local_timeout)
+    if self.codec is not None:
+      mapping = dict((key, self._encode(value)) for key, value in mapping.iteritems())
+    return LPCM_CACHE.set_many(mapping, self.timeout)
+
+  def delete_many(self, keys):
+    if self.local is not None:
+      self.local.delete_many(keys)
+    return LPCM_CACHE.delete_many(keys)
+
+  def add_many(self, mapping):
+    """ Sets the values of the keys that are not cached. Returns the list of keys that were set.
+    A single round trip if has_batched_add(), else one add per key """
+    if self.local is not None:
+      self.local.delete_many(mapping.keys())
+    return self._add_many(dict((key, self._encode(value)) for key, value in mapping.iteritems()),
+      self.timeout)
+
+  @staticmethod
+  def has_batched_add():
+    """ True if the backend adds many keys in one round trip: LocalCASCache, or a client with
+    add_multi such as pylibmc. python-memcached has none """
+    return (hasattr(LPCM_CACHE, 'add_many')
+      or hasattr(getattr(LPCM_CACHE, '_cache', None), 'add_multi'))
+
+  def _add_many(self, mapping, timeout):
+    if hasattr(LPCM_CACHE, 'add_many'):
+      return LPCM_CACHE.add_many(mapping, timeout)
+    client = getattr(LPCM_CACHE, '_cache', None)
+    if hasattr(client, 'add_multi'):
+      keys = dict((LPCM_CACHE.make_key(key), key) for key in mapping)
+      failed = set(client.add_multi(
+        dict((LPCM_CACHE.make_key(key), value) for key, value in mapping.iteritems()),
+        LPCM_CACHE._get_memcache_timeout(timeout)))
+      return [key for made_key, key in keys.iteritems() if made_key not in failed]
+    return [key for key, value in mapping.iteritems() if LPCM_CACHE.add(key, value, timeout)]
+
   def get_thread_safe_token(self, key):
-    "Returns True if we can get a thread-safe token to update a given key"
-    key_token =  "{key}_thread_safe_token".format(key = key)
-    timeout = 2 # expected time for a dynamo-db transaction
+    """ Returns True if we can get a thread-safe token to update a given key.
+    The token is a lease: it expires on its own if its holder never releases it """
+    return LPCM_CACHE.add(self._token_key(key), True, self._token_timeout())
+
+  def release_thread_safe_token(self, key, key_missing = False):
+    """ Releases the token once the value has been saved in cache. When the key turned out
+    not to exist, the token is kept until it expires, as a notice to the waiting threads """
+    if key_missing:
+      return LPCM_CACHE.set(self._token_key(key), self.Constants.KEY_MISSING, self._token_timeout())
+    return LPCM_CACHE.delete(self._token_key(key))
+
+  def get_thread_safe_tokens(self, keys):
+    "The batched get_thread_safe_token. Returns the keys whose tokens we got"
+    tokens = dict((self._token_key(key), key) for key in keys)
+    return [tokens[token_key] for token_key in self._add_many(
+      dict.fromkeys(tokens, True), self._token_timeout())]
+
+  def release_thread_safe_tokens(self, keys, missing_keys = ()):
+    """ The batched release_thread_safe_token: the tokens of missing_keys are kept as a notice,
+    the others are deleted """
+    missing_keys = set(missing_keys)
+    released = [self._token_key(key) for key in keys if key not in missing_keys]
+    if released:
+      LPCM_CACHE.delete_many(released)
+    if missing_keys:
+      LPCM_CACHE.set_many(dict((self._token_key(key), self.Constants.KEY_MISSING)
+        for key in missing_keys), self._token_timeout())
+
+  def get_with_lease(self, key):
+    """ Like get_with_token, but when the key is neither cached nor claimed, also claims its
+    token: the returned token is then LEASED, and the caller must fill the key and release it.
+    A single round trip on backends with get_and_add (see cache_backend.py). Otherwise the token
+    is claimed first, and the value only read if another thread holds it """
+    token_key = self._token_key(key)
+    if hasattr(LPCM_CACHE, 'get_and_add'):
+      value, added, token = LPCM_CACHE.get_and_add(key, token_key, True, self._token_timeout())
+      if added:
+        return None, self.Constants.LEASED
+      return self._decode(value), token
+    if LPCM_CACHE.add(token_key, True, self._token_timeout()):
+      return None, self.Constants.LEASED
+    return self.get_with_token(key)
+
+  def get_many_with_tokens(self, keys):
+    "The batched get_with_token: returns a dict of key: (value, token), in a single round trip"
+    tokens = dict((key, self._token_key(key)) for key in keys)
+    found = LPCM_CACHE.get_many(list(keys) + tokens.values())
+    return dict((key, (self._decode(found.get(key)), found.get(tokens[key]))) for key in keys)
+
+  def get_with_token(self, key):
+    """ Returns a (value, token) tuple for a given key, in a single round trip.
+    token is True while another thread holds it, KEY_MISSING if that thread found
+    that the key does not exist, and None if nobody holds it """
+    token_key = self._token_key(key)
+    found = LPCM_CACHE.get_many([key, token_key])
+    return self._decode(found.get(key)), found.get(token_key)
+
+  def _encode(self, value):
+    if self.codec is None or self.is_missing(value) or not self.codec.should_encode(value):
+      return value
+    return self.codec.encode(value)
+
+  def _decode(self, value):
+    "Values written with any codec are decoded, even if this cache has none"
+    return Codec.decode(value)
+
+  def _decode_many(self, found):
+    return dict((key, self._decode(value)) for key, value in found.iteritems())
+
+  def _token_key(self, key):
+    return "{key}_thread_safe_token".format(key = key)
+
+  def _token_timeout(self):
+    timeout = self.Constants.TOKEN_TIMEOUT
     if self.timeout:
       timeout = min(timeout, self.timeout)
-    return LPCM_CACHE.add(key_token, True, timeout)
+    return timeout
+
+  def incr(self, key, delta, initial_value = None):
+    """ Atomically adds delta to a cached number, and returns the new value.
+    Non-negative integer deltas use memcached's incr, a single round trip. Other deltas go
+    through CAS, since memcached's decr stops at 0 and incr only supports integers.
+    If the key is not cached, it is set to initial_value + delta with an atomic add, or None is
+    returned when initial_value is None """
+    if self.local is not None:
+      self.local.delete(key)
+    for attempt in xrange(self.Constants.CAS_MAX_RETRIES):
+      new_value = self._incr(key, delta)
+      if new_value is not None or initial_value is None:
+        return new_value
+      if LPCM_CACHE.add(key, initial_value + delta, self.timeout):
+        return initial_value + delta
+      # another client just added it. it can be incremented now
+    raise self.AtomicUpdateError(u"Could not increment {}".format(key))
+
+  def _incr(self, key, delta):
+    if isinstance(delta, (int, long)) and delta >= 0:
+      try:
+        return LPCM_CACHE.incr(key, delta)
+      except ValueError: # not cached, or not a non-negative integer
+        pass
+    return self.atomic_update(key, delta, operator.add, default_value = None)
 
   def atomic_update(self, key, update_value, update_operator, default_value):
     """ Performs an atomic update to a cached value, using CAS (Compare And Swap)
-    If there is no current value for the given key, default_value will be used """
-    curr_val = LPCM_CACHE.get(key)
-    if curr_val is None:
-      curr_val = default_value
-    new_value = update_operator(curr_val, update_value)
+    If there is no current value for the given key, default_value will be used, and the new
+    value is saved with an atomic add. If default_value is None, nothing is saved and None is
+    returned instead. When another client changed the value first, retries with a jittered
+    exponential backoff, and raises AtomicUpdateError after CAS_MAX_RETRIES.
+    Returns the new value """
+    backoff = self.Constants.CAS_BACKOFF
+    try:
+      for attempt in xrange(self.Constants.CAS_MAX_RETRIES):
+        curr_val, cas_id = self._gets(key)
+        curr_val = self._decode(curr_val)
+        if curr_val is None:
+          if default_value is None:
+            return None
+          new_value = update_operator(default_value, update_value)
+          success = LPCM_CACHE.add(key, self._encode(new_value), self.timeout)
+        else:
+          if self.is_missing(curr_val):
+            if default_value is None:
+              return None
+            curr_val = default_value
+          new_value = update_operator(curr_val, update_value)
+          success = self._cas(key, self._encode(new_value), cas_id)
+        if success:
+          return new_value
+        # another client just changed this :/ lets try again
+        time.sleep(backoff * random.uniform(0.5, 1.5))
+        backoff *= 2
+      raise self.AtomicUpdateError(u"Too much contention on {}".format(key))
+    finally:
+      if not hasattr(LPCM_CACHE, 'cas'):
+        client = getattr(LPCM_CACHE, '_cache', None)
+        getattr(client, 'cas_ids', {}).pop(LPCM_CACHE.make_key(key), None)
+      if self.local is not None:
+        self.local.delete(key)
+
+  def _gets(self, key):
+    """ Returns (value, cas_id), from the backend's gets if it has one (see cache_backend.py),
+    else from the memcached client: pylibmc returns the cas id with the value, while
+    python-memcached keeps the cas ids itself, and the cas id is then the memcached key """
+    if hasattr(LPCM_CACHE, 'gets'):
+      return LPCM_CACHE.gets(key)
+    client = getattr(LPCM_CACHE, '_cache', None)
+    if not hasattr(client, 'gets'):
+      raise self.AtomicUpdateError("The cache backend does not support CAS. Use memcached, "
+        "or project.lpcm.cache_backend.LocalCASCache")
     cas_key = LPCM_CACHE.make_key(key)
-    success = LPCM_CACHE._cache.cas(cas_key, new_value)
-    if not success: # another thread just changed this :/ lets try again
-      self.atomic_update(key, update_value, update_operator, default_value)
+    if not self._is_python_memcached(client):
+      return client.gets(cas_key)
+    if getattr(client, 'cache_cas', True) is False:
+      client.cache_cas = True # python-memcached's cas is a plain set unless it keeps the cas ids
+    return client.gets(cas_key), cas_key
+
+  def _cas(self, key, value, cas_id):
+    if hasattr(LPCM_CACHE, 'cas'):
+      return LPCM_CACHE.cas(key, value, cas_id, self.timeout)
+    client = LPCM_CACHE._cache
+    timeout = LPCM_CACHE._get_memcache_timeout(self.timeout)
+    if self._is_python_memcached(client):
+      return client.cas(cas_id, value, timeout)
+    return client.cas(LPCM_CACHE.make_key(key), value, cas_id, timeout)
+
+  @staticmethod
+  def _is_python_memcached(client):
+    "python-memcached keeps the cas ids in the client. pylibmc returns them from gets"
+    return hasattr(client, 'cas_ids')
 
 class CacheDisabled(object):
   "A dummy cache object that doesn't cache at all. used to diable caching"
 
+  @staticmethod
+  def is_missing(value):
+    return False
+
   def get(self, key):
     return None
 
+  def set_missing(self, keys):
+    return None
+
   def set(self, key, value):
     return None
 
+  def add(self, key, value):
+    return False
+
+  def add_many(self, mapping):
+    return []
+
+  @staticmethod
+  def has_batched_add():
+    return True
+
   def delete(self, key):
     return None
 
+  def get_many(self, keys):
+    return {}
+
+  def set_many(self, mapping):
+    return None
+
+  def delete_many(self, keys):
+    return None
+
   def get_thread_safe_token(self, key):
     return True
 
+  def release_thread_safe_token(self, key, key_missing = False):
+    return None
+
+  def get_thread_safe_tokens(self, keys):
+    return list(keys)
+
+  def release_thread_safe_tokens(self, keys, missing_keys = ()):
+    return None
+
+  def get_with_lease(self, key):
+    return None, Cache.Constants.LEASED
+
+  def get_many_with_tokens(self, keys):
+    return dict((key, (None, None)) for key in keys)
+
+  def get_with_token(self, key):
+    return None, None
+
+  def incr(self, key, delta, initial_value = None):
+    return None
+
   def atomic_update(self, key, update_value, update_operator, default_value):
     return None
@@ -1,45 +1,78 @@
+import threading
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from thread_local import  lpcm_thread_local, is_in_test
 from models import Signals as LPCMSignal
+import config
 
 
 MapRecord = namedtuple('MapRecord', field_names = ['map_name', 'map_class'])
 
 class LPCMCleanUp(object):
-  """ Keeps track of all the maps updated in test threads (once .bind() is called
-      Can clean up all keys for all updated tables using the full_cleanup()
+  """ Keeps track of the keys updated by test threads in each map (once .bind() is called),
+      in any thread of the process.
+      full_clean_up() deletes them all with one batched delete_many per map
   """
+  _updated_maps = {} # MapRecord: set of updated keys, or None if they are not known
+  _lock = threading.Lock()
+
   @classmethod
   def bind(cls):
     assert is_in_test(), "Should only call this in a test thread"
     LPCMSignal.post_update.connect(receiver = on_map_update)
 
   @classmethod
-  def full_clean_up(cls):
-    updated_maps = cls._get_updated_maps()
-    for map_record in updated_maps:
-      KLS = map_record.map_class
-      map = KLS(name = map_record.map_name)
-      for k in map.keys():
-        map.delete(k)
+  def full_clean_up(cls, num_threads = None):
+    """ Deletes the updated keys of every map. Maps whose keys are not known are cleared
+    with a full scan. With num_threads > 1, that many maps are cleaned up in parallel.
+    num_threads defaults to LPCM_TEST_CLEAN_UP_THREADS """
+    with cls._lock:
+      updated_maps = cls._updated_maps.items()
+      cls._updated_maps.clear()
+    if num_threads is None:
+      num_threads = config.LPCM_TEST_CLEAN_UP_THREADS
+    if num_threads > 1 and len(updated_maps) > 1:
+      pool = ThreadPool(min(num_threads, len(updated_maps)))
+      try:
+        pool.map(_clean_up_in_test, updated_maps)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      for map_record_and_keys in updated_maps:
+        _clean_up(map_record_and_keys)
 
   @classmethod
-  def add_map_record(cls, map_class, map_name):
-    updated_maps = cls._get_updated_maps()
+  def add_map_record(cls, map_class, map_name, keys = None):
+    "Records updates to keys of a map. Without keys, the whole map will be cleaned up"
     map_record = MapRecord(map_class = map_class, map_name = map_name)
-    updated_maps.add(map_record)
+    with cls._lock:
+      if keys is None:
+        cls._updated_maps[map_record] = None
+        return
+      updated_keys = cls._updated_maps.setdefault(map_record, set())
+      if updated_keys is not None:
+        try:
+          updated_keys.update(keys)
+        except TypeError: # unhashable keys
+          cls._updated_maps[map_record] = None
 
-  @classmethod
-  def _get_updated_maps(cls):
-    try:
-      return lpcm_thread_local.updated_maps
-    except AttributeError:
-      lpcm_thread_local.updated_maps = set()
-    return lpcm_thread_local.updated_maps
 
+def _clean_up(map_record_and_keys):
+  map_record, keys = map_record_and_keys
+  map = map_record.map_class(name = map_record.map_name)
+  if keys is None:
+    keys = map.keys()
+  if keys:
+    map.delete_many(keys) # deletes are not recorded, see on_map_update
+
+def _clean_up_in_test(map_record_and_keys):
+  lpcm_thread_local.is_in_test = True # without binding: the pool threads don't update anything else
+  _clean_up(map_record_and_keys)
 
 def on_map_update(sender, **kwargs):
-  if not is_in_test():
-    return
+  if not is_in_test() or kwargs['action'] == 'delete':
+    return # deleted keys have nothing left to clean up
   map_name = kwargs['map_name']
-  LPCMCleanUp.add_map_record(map_class = sender, map_name = map_name)
\ No newline at end of file
+  LPCMCleanUp.add_map_record(map_class = sender, map_name = map_name,
+    keys = LPCMSignal.updated_keys(kwargs))
@@ -0,0 +1,135 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import cPickle as pickle
+import marshal
+import numbers
+import struct
+import zlib
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+try:
+  from lz4 import block as lz4_block
+except ImportError:
+  lz4_block = None
+
+class Codec(object):
+  """ Serializes values to byte strings, and compresses the ones larger than compress_threshold.
+    Every encoded value starts with a header holding a format version, the serializer and the
+    compression, so it is always decoded the way it was written, even after a map switches
+    codecs. Values saved without a codec have no header, and are returned as they are.
+    Numbers are never encoded, so that atomic increments keep working.
+    c = Codec('msgpack', compression = 'zlib', compress_threshold = 1024)
+    data = c.encode(set(["a", "b"]))
+    print Codec.decode(data)
+  """
+  MAGIC = "\x00LPCM"
+  VERSION = 1
+  HEADER = struct.Struct("!BBB") # version, serializer, compression
+  SERIALIZERS = {'pickle': 1, 'marshal': 2, 'msgpack': 3}
+  COMPRESSIONS = {None: 0, 'zlib': 1, 'lz4': 2}
+  MSGPACK_SET = 1 # msgpack extension type for sets
+
+  class UnknownFormat(ValueError):
+    pass
+
+  def __init__(self, serializer = 'pickle', compression = 'zlib', compress_threshold = 1024):
+    if serializer not in self.SERIALIZERS:
+      raise ValueError("Unknown serializer: {}".format(serializer))
+    if compression not in self.COMPRESSIONS:
+      raise ValueError("Unknown compression: {}".format(compression))
+    if serializer == 'msgpack' and msgpack is None:
+      raise ValueError("The msgpack serializer requires the msgpack package")
+    if compression == 'lz4' and lz4_block is None:
+      raise ValueError("lz4 compression requires the lz4 package")
+    self.serializer = serializer
+    self.compression = compression
+    self.compress_threshold = compress_threshold
+
+  @staticmethod
+  def should_encode(value):
+    return not isinstance(value, numbers.Number)
+
+  def encode(self, value):
+    data = self._serialize(self.serializer, value)
+    compression = None
+    if self.compression and len(data) > self.compress_threshold:
+      compressed = self._compress(self.compression, data)
+      if len(compressed) < len(data):
+        data, compression = compressed, self.compression
+    return self.MAGIC + self.HEADER.pack(self.VERSION,
+      self.SERIALIZERS[self.serializer], self.COMPRESSIONS[compression]) + data
+
+  @classmethod
+  def is_encoded(cls, data):
+    return isinstance(data, str) and data.startswith(cls.MAGIC)
+
+  @classmethod
+  def decode(cls, data):
+    "Returns the decoded value, or data itself if it was not encoded by a Codec"
+    if not cls.is_encoded(data):
+      return data
+    start = len(cls.MAGIC)
+    version, serializer_id, compression_id = cls.HEADER.unpack_from(data, start)
+    if version != cls.VERSION:
+      raise cls.UnknownFormat("Unknown codec version: {}".format(version))
+    serializer = cls._name(cls.SERIALIZERS, serializer_id)
+    compression = cls._name(cls.COMPRESSIONS, compression_id)
+    data = data[start + cls.HEADER.size:]
+    if compression:
+      data = cls._decompress(compression, data)
+    return cls._deserialize(serializer, data)
+
+  @classmethod
+  def _name(cls, names, format_id):
+    for name, name_id in names.iteritems():
+      if name_id == format_id:
+        return name
+    raise cls.UnknownFormat("Unknown codec format: {}".format(format_id))
+
+  @classmethod
+  def _serialize(cls, serializer, value):
+    if serializer == 'pickle':
+      return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if serializer == 'marshal':
+      return marshal.dumps(value)
+    return msgpack.packb(value, use_bin_type = True, default = cls._msgpack_default)
+
+  @classmethod
+  def _deserialize(cls, serializer, data):
+    if serializer == 'pickle':
+      return pickle.loads(data)
+    if serializer == 'marshal':
+      return marshal.loads(data)
+    if msgpack is None:
+      raise cls.UnknownFormat("Decoding this value requires the msgpack package")
+    return msgpack.unpackb(data, raw = False, ext_hook = cls._msgpack_ext_hook)
+
+  @classmethod
+  def _msgpack_default(cls, value):
+    if isinstance(value, (set, frozenset)):
+      return msgpack.ExtType(cls.MSGPACK_SET,
+        msgpack.packb(list(value), use_bin_type = True, default = cls._msgpack_default))
+    raise TypeError("Cannot serialize {!r} with msgpack".format(value))
+
+  @classmethod
+  def _msgpack_ext_hook(cls, code, data):
+    if code == cls.MSGPACK_SET:
+      return set(msgpack.unpackb(data, raw = False, ext_hook = cls._msgpack_ext_hook))
+    return msgpack.ExtType(code, data)
+
+  @staticmethod
+  def _compress(compression, data):
+    if compression == 'zlib':
+      return zlib.compress(data)
+    return lz4_block.compress(data)
+
+  @classmethod
+  def _decompress(cls, compression, data):
+    if compression == 'zlib':
+      return zlib.decompress(data)
+    if lz4_block is None:
+      raise cls.UnknownFormat("Decoding this value requires the lz4 package")
+    return lz4_block.decompress(data)
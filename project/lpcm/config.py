@@ -7,11 +7,51 @@ from django.core.exceptions import ImproperlyConfigured
 LPCM_CACHE_TIMEOUT = getattr(settings, 'LPCM_CACHE_TIMEOUT', 0)
 LPCM_TEST_USE_LOCAL_CACHE_ONLY = getattr(settings, 'LPCM_TEST_USE_LOCAL_CACHE_ONLY', True)
 LPCM_DEBUG_USE_LOCAL_CACHE_ONLY = getattr(settings, 'LPCM_DEBUG_USE_LOCAL_CACHE_ONLY', False)
+# How many maps the test tear down cleans up in parallel, see LPCMCleanUp
+LPCM_TEST_CLEAN_UP_THREADS = getattr(settings, 'LPCM_TEST_CLEAN_UP_THREADS', 1)
 LPCM_DYNAMODB_TABLE_NAME = getattr(settings, 'LPCM_DYNAMODB_TABLE_NAME', "lpcm")
+# How long a cache miss waits for another thread to load the same key from dynamodb,
+# before reading it directly. The cache is polled at a jittered, increasing interval.
+LPCM_STAMPEDE_MAX_WAIT_MS = getattr(settings, 'LPCM_STAMPEDE_MAX_WAIT_MS', 1000)
+LPCM_STAMPEDE_POLL_INTERVAL_MS = getattr(settings, 'LPCM_STAMPEDE_POLL_INTERVAL_MS', 10)
+# The in-process cache in front of memcached, for maps created with local_cache = True.
+# Without an invalidation broadcaster (below), entries are only invalidated by writes made
+# in the same process, so keep the timeout short.
+LPCM_LOCAL_CACHE_MAX_ENTRIES = getattr(settings, 'LPCM_LOCAL_CACHE_MAX_ENTRIES', 10000)
+LPCM_LOCAL_CACHE_MAX_BYTES = getattr(settings, 'LPCM_LOCAL_CACHE_MAX_BYTES', 10 * 1024 * 1024)
+LPCM_LOCAL_CACHE_TIMEOUT = getattr(settings, 'LPCM_LOCAL_CACHE_TIMEOUT', 5)
+# Publishes every update to the other processes, so they can evict their local copies.
+# e.g. 'project.lpcm.invalidation.MemcachedInvalidationBroadcaster'. See invalidation.py
+LPCM_INVALIDATION_BROADCASTER = getattr(settings, 'LPCM_INVALIDATION_BROADCASTER', None)
+LPCM_INVALIDATION_OPTIONS = getattr(settings, 'LPCM_INVALIDATION_OPTIONS', {})
+# Maps created with buffered_counters = True sum their increments in process, and write them
+# to dynamodb once this many keys are pending, or once the oldest delta is this many seconds old.
+LPCM_COUNTER_MAX_PENDING_KEYS = getattr(settings, 'LPCM_COUNTER_MAX_PENDING_KEYS', 1000)
+LPCM_COUNTER_FLUSH_INTERVAL = getattr(settings, 'LPCM_COUNTER_FLUSH_INTERVAL', 1.0)
+# The range key encoding of the maps that do not use base32, e.g. {'events': 'hex'}, so that
+# every process (including lpcm_cleanup, lpcm_export and the invalidation receivers) uses it.
+# See LPCMKey.ENCODINGS
+LPCM_KEY_ENCODINGS = getattr(settings, 'LPCM_KEY_ENCODINGS', {})
+# How many recently used keys of each map are kept encoded, see LPCMKey.get
+LPCM_KEY_MEMO_MAX_ENTRIES = getattr(settings, 'LPCM_KEY_MEMO_MAX_ENTRIES', 10000)
+# All threads share a pool of at most LPCM_DYNAMODB_POOL_SIZE dynamodb connections, and wait
+# up to LPCM_DYNAMODB_POOL_TIMEOUT seconds for one. Iterators hold theirs until exhausted.
+LPCM_DYNAMODB_POOL_SIZE = getattr(settings, 'LPCM_DYNAMODB_POOL_SIZE', 20)
+LPCM_DYNAMODB_POOL_TIMEOUT = getattr(settings, 'LPCM_DYNAMODB_POOL_TIMEOUT', 10)
+# The table is described once per process, to check that it exists and get its schema.
+# Set to False to skip that request, and assume the schema made by create_lpcm_table.
+LPCM_DYNAMODB_VALIDATE_TABLE = getattr(settings, 'LPCM_DYNAMODB_VALIDATE_TABLE', True)
+# Where the persistent maps are saved. None is DynamoDB. Without a network, set it to
+# 'project.lpcm.storage.MemoryStorage' or 'project.lpcm.storage.SqliteStorage' (with a 'path'
+# option). LPCM_STORAGE_OPTIONS can also inject 'latency' and a 'throttle_rate'. See storage.py
+LPCM_STORAGE_BACKEND = getattr(settings, 'LPCM_STORAGE_BACKEND', None)
+LPCM_STORAGE_OPTIONS = getattr(settings, 'LPCM_STORAGE_OPTIONS', {})
+# The number of threads shared by the AsyncLargePersistentCachedMaps of a process, see async_lpcm.py
+LPCM_ASYNC_THREADS = getattr(settings, 'LPCM_ASYNC_THREADS', 10)
 
 DYNAMODB_ACCESS_KEY = getattr(settings, "LPCM_DYNAMODB_ACCESS_KEY", None)
 DYNAMODB_SECRET_ACCESS_KEY = getattr(settings, "LPCM_DYNAMODB_SECRET_ACCESS_KEY", None)
-if not DYNAMODB_ACCESS_KEY or not DYNAMODB_SECRET_ACCESS_KEY:
+if not LPCM_STORAGE_BACKEND and (not DYNAMODB_ACCESS_KEY or not DYNAMODB_SECRET_ACCESS_KEY):
   raise ImproperlyConfigured("LPCM Config Error: " +
     "Please define values for DYNAMODB_ACCESS_KEY and LPCM_DYNAMODB_SECRET_ACCESS_KEY " +
     "in your settings module")
@@ -0,0 +1,93 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import threading
+import time
+from contextlib import contextmanager
+
+class ConnectionPool(object):
+  """ A thread-safe pool of at most max_size connections, made by calling connect().
+    Each connection is used by one thread at a time, and goes back to the pool afterwards, so
+    that its HTTP keep-alive sessions are reused by the next thread instead of being set up again.
+    Threads wait up to timeout seconds for a connection, then get a ConnectionPool.Timeout.
+    pool = ConnectionPool(connect = boto.connect_dynamodb, max_size = 10, timeout = 5)
+    with pool.connection() as conn:
+      print conn.list_tables()
+    print pool.stats()
+  """
+  class Timeout(Exception):
+    pass
+
+  def __init__(self, connect, max_size, timeout):
+    self.connect = connect
+    self.max_size = max_size
+    self.timeout = timeout
+    self._idle = [] # most recently used last
+    self._size = 0 # connections created and not discarded
+    self._condition = threading.Condition(threading.Lock())
+    self.acquired = 0
+    self.waits = 0
+    self.timeouts = 0
+    self.wait_time = 0.0
+
+  @contextmanager
+  def connection(self):
+    conn = self.acquire()
+    try:
+      yield conn
+    finally:
+      self.release(conn)
+
+  def acquire(self):
+    started = time.time()
+    waited = False
+    with self._condition:
+      while not self._idle and self._size >= self.max_size:
+        remaining = started + self.timeout - time.time()
+        if remaining <= 0:
+          self.timeouts += 1
+          raise self.Timeout("No connection available after {} seconds ({} in use)".format(
+            self.timeout, self._size))
+        waited = True
+        self._condition.wait(remaining)
+      self.acquired += 1
+      if waited:
+        self.waits += 1
+        self.wait_time += time.time() - started
+      if self._idle:
+        return self._idle.pop()
+      self._size += 1 # reserved, so we can connect without holding the lock
+    try:
+      return self.connect()
+    except:
+      self.discard(None)
+      raise
+
+  def release(self, conn):
+    with self._condition:
+      self._idle.append(conn)
+      self._condition.notify()
+
+  def discard(self, conn):
+    "Drops a connection that shouldn't be reused, making room for a new one"
+    with self._condition:
+      self._size -= 1
+      self._condition.notify()
+
+  def available(self):
+    "The number of connections that can be acquired right now without waiting"
+    with self._condition:
+      return len(self._idle) + self.max_size - self._size
+
+  def stats(self):
+    with self._condition:
+      return {
+        'size': self._size,
+        'idle': len(self._idle),
+        'in_use': self._size - len(self._idle),
+        'max_size': self.max_size,
+        'acquired': self.acquired,
+        'waits': self.waits,
+        'timeouts': self.timeouts,
+        'wait_time': self.wait_time,
+        }
@@ -0,0 +1,163 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import atexit
+import threading
+import time
+from storage import get_storage
+import config
+
+class CounterBuffer(object):
+  """ Write-behind aggregation of counter increments. The deltas are summed per key in process,
+    and flushed to dynamodb as a single ADD per key, once max_pending_keys keys are pending or
+    the oldest pending delta is flush_interval seconds old. The flushes are made by a background
+    thread, so add() never waits for dynamodb and never raises. Buffers are also flushed at exit.
+    Keys are LPCMKey objects, so a flush from another thread writes to the same item.
+    b = CounterBuffer(max_pending_keys = 1000, flush_interval = 1.0)
+    b.add(LPCMKey("my_table", "key1"), 1)
+    print b.stats()
+  """
+  def __init__(self, max_pending_keys, flush_interval):
+    self.max_pending_keys = max_pending_keys
+    self.flush_interval = flush_interval
+    self._pending = {} # cache_key: [cmp_key, delta]
+    self._oldest = None # when the oldest pending delta was added
+    self._lock = threading.Lock()
+    self._flush_lock = threading.Lock()
+    self._wake = threading.Event() # wakes the flusher up when a flush may be due
+    self._flusher = None
+    self.flushes = 0
+    self.flushed_keys = 0
+    self.last_flush_at = None
+    self.last_flush_duration = None
+
+  def add(self, cmp_key, delta):
+    with self._lock:
+      entry = self._pending.setdefault(cmp_key.cache_key, [cmp_key, 0])
+      entry[1] += delta
+      first_delta = self._oldest is None
+      if first_delta:
+        self._oldest = time.time()
+      if first_delta or len(self._pending) >= self.max_pending_keys:
+        self._start_flusher()
+        self._wake.set()
+
+  def discard(self, cmp_keys):
+    """ Drops the pending deltas of keys that were deleted, so that a flush does not create them
+    again. A flush that is already running may still write them """
+    with self._lock:
+      for cmp_key in cmp_keys:
+        self._pending.pop(cmp_key.cache_key, None)
+      if not self._pending:
+        self._oldest = None
+
+  def take(self, cmp_key):
+    "Removes the pending delta of a key and returns it, so the caller can write it itself"
+    with self._lock:
+      entry = self._pending.pop(cmp_key.cache_key, None)
+      if not self._pending:
+        self._oldest = None
+    return entry[1] if entry else 0
+
+  def pending(self, cmp_key):
+    with self._lock:
+      entry = self._pending.get(cmp_key.cache_key)
+    return entry[1] if entry else 0
+
+  def flush(self):
+    """ Writes all the pending deltas to dynamodb. If a write fails, the deltas that were
+    not written are put back, and the error is raised """
+    with self._flush_lock:
+      with self._lock:
+        pending, self._pending = self._pending, {}
+        self._oldest = None
+      started = time.time()
+      entries = pending.values()
+      try:
+        while entries:
+          cmp_key, delta = entries[-1]
+          if delta:
+            get_storage().add_to_item(cmp_key, delta)
+          entries.pop()
+      finally:
+        self._restore(entries)
+        self.flushes += 1
+        self.flushed_keys += len(pending) - len(entries)
+        self.last_flush_at = time.time()
+        self.last_flush_duration = self.last_flush_at - started
+
+  def stats(self):
+    "Returns the pending deltas and the flush lag (age of the oldest pending delta, in seconds)"
+    with self._lock:
+      return {
+        'pending_keys': len(self._pending),
+        'pending_delta': sum(delta for cmp_key, delta in self._pending.itervalues()),
+        'lag': time.time() - self._oldest if self._oldest is not None else 0,
+        'flushes': self.flushes,
+        'flushed_keys': self.flushed_keys,
+        'last_flush_at': self.last_flush_at,
+        'last_flush_duration': self.last_flush_duration,
+        }
+
+  def _restore(self, entries):
+    if not entries:
+      return
+    with self._lock:
+      for cmp_key, delta in entries:
+        entry = self._pending.setdefault(cmp_key.cache_key, [cmp_key, 0])
+        entry[1] += delta
+      if self._oldest is None:
+        self._oldest = time.time()
+
+  def _start_flusher(self):
+    "Call with the lock held"
+    if self._flusher is None:
+      self._flusher = threading.Thread(target = self._flush_in_background)
+      self._flusher.daemon = True
+      self._flusher.start()
+
+  def _flush_in_background(self):
+    while True:
+      self._wake.wait(self._time_to_flush())
+      self._wake.clear()
+      with self._lock:
+        due = self._pending and (len(self._pending) >= self.max_pending_keys or
+          time.time() - self._oldest >= self.flush_interval)
+      if due:
+        try:
+          self.flush()
+        except Exception:
+          pass # the deltas were put back, and are retried flush_interval seconds later
+
+  def _time_to_flush(self):
+    "Seconds until the oldest pending delta is due, or None (wait for an add) if none is pending"
+    with self._lock:
+      if self._oldest is None:
+        return None
+      return max(0, self._oldest + self.flush_interval - time.time())
+
+
+_counter_buffer = None
+_counter_buffer_lock = threading.Lock()
+
+def get_counter_buffer():
+  "Returns the process-wide buffer shared by all the maps with buffered counters"
+  global _counter_buffer
+  if _counter_buffer is None:
+    with _counter_buffer_lock:
+      if _counter_buffer is None:
+        _counter_buffer = CounterBuffer(config.LPCM_COUNTER_MAX_PENDING_KEYS,
+          config.LPCM_COUNTER_FLUSH_INTERVAL)
+  return _counter_buffer
+
+def discard_pending_deltas(cmp_keys):
+  "Drops the pending deltas of deleted keys, whether or not their map buffers its counters"
+  if _counter_buffer is not None:
+    _counter_buffer.discard(cmp_keys)
+
+def flush_counters():
+  "Writes all the pending counter deltas of this process to dynamodb"
+  if _counter_buffer is not None:
+    _counter_buffer.flush()
+
+atexit.register(flush_counters)
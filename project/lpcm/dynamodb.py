@@ -2,47 +2,205 @@
 # Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
 
 from collections import namedtuple
+import Queue
+import threading
+import time
 import boto
-from thread_local import lpcm_thread_local
+from boto.dynamodb.condition import BETWEEN, GE
+from boto.dynamodb.exceptions import DynamoDBConditionalCheckFailedError, DynamoDBResponseError
+from connection_pool import ConnectionPool
 import config
 
 class DynamoDB(object):
+  class Constants(object):
+    BATCH_GET_SIZE = 100 # DynamoDB's limit on keys per BatchGetItem
+    BATCH_WRITE_SIZE = 25 # DynamoDB's limit on items per BatchWriteItem
+    BATCH_WRITE_MAX_RETRIES = 8
+    BATCH_WRITE_BACKOFF = 0.05 # seconds, doubled on every retry of the unprocessed items
+    PARALLEL_QUERY_BUFFER_SIZE = 1000 # items fetched ahead of the consumer of a parallel query
+    HASH_KEY_NAME = 'table'
+    RANGE_KEY_NAME = 'key'
+
+  _pool = None
+  _pool_lock = threading.Lock()
+  _schemas = {} # table_name: schema, resolved once per process
+  _schemas_lock = threading.Lock()
 
   @classmethod
-  def get_connection(cls):
-    "Returns a thread-local dynamodb-boto connection"
-    try:
-      return lpcm_thread_local.ddb_connection
-    except AttributeError:
-      pass
-    lpcm_thread_local.ddb_connection = boto.connect_dynamodb(
+  def get_pool(cls):
+    "Returns the process-wide pool of boto connections. See LPCM_DYNAMODB_POOL_* in the settings"
+    if cls._pool is None:
+      with cls._pool_lock:
+        if cls._pool is None:
+          cls._pool = ConnectionPool(cls._connect,
+            max_size = config.LPCM_DYNAMODB_POOL_SIZE,
+            timeout = config.LPCM_DYNAMODB_POOL_TIMEOUT)
+    return cls._pool
+
+  @classmethod
+  def connection(cls):
+    """ Borrows a dynamodb-boto connection from the pool, for a with statement.
+    boto connections are not thread-safe: only use it inside the with block """
+    return cls.get_pool().connection()
+
+  @classmethod
+  def _connect(cls):
+    conn = boto.connect_dynamodb(
       config.DYNAMODB_ACCESS_KEY,
       config.DYNAMODB_SECRET_ACCESS_KEY)
-    return lpcm_thread_local.ddb_connection
+    conn.lpcm_tables = {}
+    return conn
 
   @classmethod
-  def get_table(cls, table_name):
-    "Note that tables are cached by trhead"
-    if table_name in lpcm_thread_local.ddb_table_cache:
-      return lpcm_thread_local.ddb_table_cache[table_name]
-    conn = cls.get_connection()
-    tables = conn.list_tables()
-    if table_name not in tables:
-      raise cls.TableNotFound("Table {} not found".format(table_name))
-    lpcm_thread_local.ddb_table_cache[table_name] = conn.get_table(table_name)
-    return lpcm_thread_local.ddb_table_cache[table_name]
+  def get_table(cls, table_name, conn):
+    """ Returns the table object bound to a borrowed connection. Tables are cached by connection,
+    and built from the schema resolved by the first one, without any request """
+    table = conn.lpcm_tables.get(table_name)
+    if table is None:
+      table = conn.table_from_schema(table_name, cls._get_schema(table_name, conn))
+      conn.lpcm_tables[table_name] = table
+    return table
+
+  @classmethod
+  def _get_schema(cls, table_name, conn):
+    """ Describes the table the first time it is used in this process. Without
+    LPCM_DYNAMODB_VALIDATE_TABLE, the lpcm schema is assumed and nothing is requested """
+    schema = cls._schemas.get(table_name)
+    if schema is not None:
+      return schema
+    with cls._schemas_lock:
+      if table_name not in cls._schemas:
+        if config.LPCM_DYNAMODB_VALIDATE_TABLE:
+          try:
+            cls._schemas[table_name] = conn.get_table(table_name).schema
+          except DynamoDBResponseError as e:
+            if e.error_code == 'ResourceNotFoundException':
+              raise cls.TableNotFound("Table {} not found".format(table_name))
+            raise
+        else:
+          cls._schemas[table_name] = conn.create_schema(
+            hash_key_name = cls.Constants.HASH_KEY_NAME, hash_key_proto_value = 'S',
+            range_key_name = cls.Constants.RANGE_KEY_NAME, range_key_proto_value = 'S')
+      return cls._schemas[table_name]
+
+  @classmethod
+  def warm_up(cls, num_connections = 1):
+    """ Resolves the table and creates num_connections pooled connections, so that the first
+    requests don't pay for it. Meant to be called at startup, e.g. from wsgi.py """
+    pool = cls.get_pool()
+    conns = [pool.acquire() for i in xrange(min(num_connections, pool.max_size))]
+    try:
+      for conn in conns:
+        cls.get_table(config.LPCM_DYNAMODB_TABLE_NAME, conn)
+    finally:
+      for conn in conns:
+        pool.release(conn)
 
   @classmethod
   def get_item(cls, cmp_key):
     "Tries to get an item from DynamoDB. Throws DynamoDBKeyNotFoundError"
-    table = cls.get_table(config.LPCM_DYNAMODB_TABLE_NAME)
-    return table.get_item(hash_key = cmp_key.hash_key, range_key = cmp_key.range_key)
+    with cls.connection() as conn:
+      table = cls.get_table(config.LPCM_DYNAMODB_TABLE_NAME, conn)
+      return table.get_item(hash_key = cmp_key.hash_key, range_key = cmp_key.range_key)
 
   @classmethod
-  def create_item(cls, cmp_key):
-    table = DynamoDB.get_table(config.LPCM_DYNAMODB_TABLE_NAME)
+  def batch_get_items(cls, cmp_keys):
+    """ Gets several items using BatchGetItem requests of up to 100 keys each.
+    Keys that do not exist are simply missing from the returned list of items """
+    keys = list(set((k.hash_key, k.range_key) for k in cmp_keys)) # BatchGetItem rejects duplicates
+    items = []
+    with cls.connection() as conn:
+      table = cls.get_table(config.LPCM_DYNAMODB_TABLE_NAME, conn)
+      for i in xrange(0, len(keys), cls.Constants.BATCH_GET_SIZE):
+        # boto takes care of re-requesting the UnprocessedKeys of each batch
+        items.extend(table.batch_get_item(keys[i:i + cls.Constants.BATCH_GET_SIZE]))
+    return items
+
+  @classmethod
+  def create_item(cls, cmp_key, conn):
+    "Returns a new item, bound to a borrowed connection"
+    table = cls.get_table(config.LPCM_DYNAMODB_TABLE_NAME, conn)
     return table.new_item(hash_key = cmp_key.hash_key, range_key = cmp_key.range_key)
 
+  @classmethod
+  def put_item(cls, cmp_key, value, expected_value = None):
+    """ Saves an item, replacing the existing one. With expected_value (e.g. {'value': 'x'}),
+    the put only happens if the item has those values, else DynamoDBConditionalCheckFailedError
+    is raised """
+    with cls.connection() as conn:
+      item = cls.create_item(cmp_key, conn)
+      item['value'] = value
+      return item.put(expected_value = expected_value)
+
+  @classmethod
+  def add_to_item(cls, cmp_key, value, return_values = None):
+    """ Adds value (a number, or a set of values) to the item's value with a single UpdateItem,
+    without reading it first. The item is created if it does not exist.
+    With return_values = 'UPDATED_NEW', the response has the new value in 'Attributes' """
+    with cls.connection() as conn:
+      item = cls.create_item(cmp_key, conn)
+      item.add_attribute('value', value)
+      return item.save(return_values = return_values)
+
+  @classmethod
+  def delete_from_item(cls, cmp_key, values, return_values = None):
+    """ Deletes a set of values from an item with a single UpdateItem, without reading it first.
+    Returns None if the item does not exist. With return_values = 'UPDATED_NEW', the response
+    has the remaining values in 'Attributes' (no 'value' once the set is empty) """
+    with cls.connection() as conn:
+      item = cls.create_item(cmp_key, conn)
+      item.delete_attribute('value', values)
+      try:
+        return item.save(expected_value = {'value': True}, return_values = return_values)
+      except DynamoDBConditionalCheckFailedError:
+        return None # Nothing to do
+
+  @classmethod
+  def delete_item(cls, cmp_key, return_values = None):
+    """ Deletes an item without reading it first. Deleting a non-existent item is a no-op.
+    With return_values = 'ALL_OLD', the response has the deleted item's 'Attributes' """
+    with cls.connection() as conn:
+      return cls.create_item(cmp_key, conn).delete(return_values = return_values)
+
+  @classmethod
+  def batch_write(cls, puts = (), deletes = ()):
+    """ Puts and deletes items using BatchWriteItem requests of up to 25 items each.
+    puts is a list of (cmp_key, value) pairs and deletes is a list of cmp_keys.
+    Unprocessed items are retried with an exponential backoff """
+    with cls.connection() as conn:
+      cls._batch_write(conn, puts, deletes)
+
+  @classmethod
+  def _batch_write(cls, conn, puts, deletes):
+    table = cls.get_table(config.LPCM_DYNAMODB_TABLE_NAME, conn)
+    # a single BatchWriteItem cannot touch the same item twice. The last write wins.
+    requests = {}
+    for cmp_key, value in puts:
+      item = table.new_item(hash_key = cmp_key.hash_key, range_key = cmp_key.range_key,
+        attrs = {'value': value})
+      requests[(cmp_key.hash_key, cmp_key.range_key)] = {
+        'PutRequest': {'Item': conn.dynamize_item(item)}}
+    for cmp_key in deletes:
+      key = conn.build_key_from_values(table.schema, cmp_key.hash_key, cmp_key.range_key)
+      requests[(cmp_key.hash_key, cmp_key.range_key)] = {'DeleteRequest': {'Key': key}}
+    requests = requests.values()
+    for i in xrange(0, len(requests), cls.Constants.BATCH_WRITE_SIZE):
+      cls._submit_batch_write(conn,
+        {table.name: requests[i:i + cls.Constants.BATCH_WRITE_SIZE]})
+
+  @classmethod
+  def _submit_batch_write(cls, conn, request_items):
+    # goes through layer1, so that UnprocessedItems come back in a format we can resubmit
+    for retry in xrange(cls.Constants.BATCH_WRITE_MAX_RETRIES + 1):
+      if retry:
+        time.sleep(cls.Constants.BATCH_WRITE_BACKOFF * 2 ** (retry - 1))
+      response = conn.layer1.batch_write_item(request_items)
+      request_items = response.get('UnprocessedItems')
+      if not request_items:
+        return
+    raise cls.BatchWriteError("{} items were still unprocessed after {} retries".format(
+      sum(len(v) for v in request_items.values()), cls.Constants.BATCH_WRITE_MAX_RETRIES))
+
   @classmethod
   def create_table(cls, table_name, hash_key_name, hash_key_proto_value,
       range_key_name, range_key_proto_value, read_units, write_units):
@@ -50,27 +208,95 @@ class DynamoDB(object):
     This probably shouldn't be called in production code.
     For a sample of table schema, see: http://boto.readthedocs.org/en/latest/dynamodb_tut.html
     """
-    conn = cls.get_connection()
-    schema = conn.create_schema(
-      hash_key_name = hash_key_name,
-      hash_key_proto_value = hash_key_proto_value,
-      range_key_name = range_key_name,
-      range_key_proto_value = range_key_proto_value)
-    table = conn.create_table(
-          name = table_name,
-          schema = schema,
-          read_units = read_units,
-          write_units = write_units)
-    return table
+    with cls.connection() as conn:
+      schema = conn.create_schema(
+        hash_key_name = hash_key_name,
+        hash_key_proto_value = hash_key_proto_value,
+        range_key_name = range_key_name,
+        range_key_proto_value = range_key_proto_value)
+      table = conn.create_table(
+            name = table_name,
+            schema = schema,
+            read_units = read_units,
+            write_units = write_units)
+      return table
 
   @classmethod
   def query(cls, cmp_key, attributes_to_get = None, request_limit = None,
-            max_results = None, consistent_read = False):
-    table = DynamoDB.get_table(config.LPCM_DYNAMODB_TABLE_NAME)
-    return table.query(hash_key = cmp_key.hash_key, range_key_condition = None,
-      attributes_to_get = attributes_to_get, request_limit = request_limit,
-      max_results = max_results, consistent_read = consistent_read)
+            max_results = None, consistent_read = False, range_key_condition = None):
+    """ Yields the items of a query, page by page. The connection is borrowed until the
+    iteration ends (or the iterator is closed), so don't leave iterators half consumed """
+    with cls.connection() as conn:
+      table = cls.get_table(config.LPCM_DYNAMODB_TABLE_NAME, conn)
+      for item in table.query(hash_key = cmp_key.hash_key, range_key_condition = range_key_condition,
+          attributes_to_get = attributes_to_get, request_limit = request_limit,
+          max_results = max_results, consistent_read = consistent_read):
+        yield item
+
+  @classmethod
+  def parallel_query(cls, cmp_key, range_key_segments, attributes_to_get = None,
+                     request_limit = None, consistent_read = False):
+    """ Queries the (start, end) ranges of range keys in parallel, and yields the items as they
+    arrive, in no particular order. end is exclusive, and None for the last segment.
+    Each query keeps a pooled connection until its segment is exhausted, so the segments are
+    shared by as many threads as there are free connections (at least one), rather than a
+    thread per segment waiting for the pool.
+    Only a bounded number of items are buffered, so slow consumers pause the queries """
+    items = Queue.Queue(maxsize = cls.Constants.PARALLEL_QUERY_BUFFER_SIZE)
+    segments = Queue.Queue()
+    for segment in range_key_segments:
+      segments.put(segment)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+      while not stopped.is_set():
+        try:
+          items.put(item, timeout = 0.1)
+          return
+        except Queue.Full:
+          pass
+
+    def query_segments():
+      try:
+        while not stopped.is_set():
+          try:
+            start, end = segments.get_nowait()
+          except Queue.Empty:
+            return
+          # range keys never equal the single character that starts the next segment
+          condition = GE(start) if end is None else BETWEEN(start, end)
+          for item in cls.query(cmp_key, attributes_to_get = attributes_to_get,
+              request_limit = request_limit, consistent_read = consistent_read,
+              range_key_condition = condition):
+            if stopped.is_set():
+              return
+            put(item)
+          put(done)
+      except Exception as e:
+        put(e)
+
+    num_threads = max(1, min(segments.qsize(), cls.get_pool().available()))
+    remaining = segments.qsize()
+    for i in xrange(num_threads):
+      thread = threading.Thread(target = query_segments)
+      thread.daemon = True
+      thread.start()
+    try:
+      while remaining:
+        item = items.get()
+        if item is done:
+          remaining -= 1
+        elif isinstance(item, Exception):
+          raise item
+        else:
+          yield item
+    finally:
+      stopped.set() # the consumer stopped early or a query failed
 
 
   class TableNotFound(KeyError):
     pass
+
+  class BatchWriteError(Exception):
+    pass
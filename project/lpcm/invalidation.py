@@ -0,0 +1,190 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import errno
+import json
+import os
+import socket
+import threading
+import time
+from django.dispatch import receiver
+from django.utils.importlib import import_module
+from key import LPCMKey
+from models import Signals
+import config
+
+class InvalidationBroadcaster(object):
+  """ Keeps the in-process cache tier consistent across processes. Every update is published
+    as a (map_name, keys, action) message, and processes reading with a local cache poll for
+    these messages and evict the matching local entries.
+    Keys are sent as their string form (LPCMKey.original_key_str). A message with a map_name
+    of None means that everything must be evicted.
+  """
+  class Constants(object):
+    KEYS_PER_MESSAGE = 100
+
+  def publish(self, map_name, keys, action):
+    raise NotImplementedError
+
+  def poll(self):
+    "Returns the messages published since the last poll"
+    raise NotImplementedError
+
+  def _chunks(self, keys):
+    for i in xrange(0, len(keys), self.Constants.KEYS_PER_MESSAGE):
+      yield keys[i:i + self.Constants.KEYS_PER_MESSAGE]
+
+
+class MemcachedInvalidationBroadcaster(InvalidationBroadcaster):
+  """ Uses a generation counter in memcached. Publishing increments the counter and saves
+    each message under its generation number. Polling reads the counter, then the messages
+    this process hasn't seen, with a single get_many. If some of them are gone (or are
+    not written yet), the whole local cache is evicted, to be on the safe side.
+  """
+  GENERATION_KEY = "__lpcm_invalidation_generation"
+  GENERATION_TIMEOUT = 30 * 24 * 3600 # the longest relative timeout memcached accepts
+
+  def __init__(self, poll_interval = 0.1, log_timeout = 60, max_log_reads = 1000):
+    self.poll_interval = poll_interval
+    self.log_timeout = log_timeout
+    self.max_log_reads = max_log_reads
+    self._last_generation = None
+    self._last_poll = 0
+    self._lock = threading.Lock()
+
+  def publish(self, map_name, keys, action):
+    from cache import LPCM_CACHE
+    messages = [(map_name, chunk, action) for chunk in self._chunks(keys)]
+    if not messages:
+      return
+    try:
+      generation = LPCM_CACHE.incr(self.GENERATION_KEY, len(messages))
+    except ValueError: # the counter doesn't exist yet
+      LPCM_CACHE.add(self.GENERATION_KEY, 0, self.GENERATION_TIMEOUT)
+      generation = LPCM_CACHE.incr(self.GENERATION_KEY, len(messages))
+    first = generation - len(messages) + 1
+    LPCM_CACHE.set_many(dict((self._log_key(first + i), message)
+      for i, message in enumerate(messages)), self.log_timeout)
+
+  def poll(self):
+    from cache import LPCM_CACHE
+    with self._lock:
+      if time.time() - self._last_poll < self.poll_interval:
+        return []
+      self._last_poll = time.time()
+      generation = LPCM_CACHE.get(self.GENERATION_KEY) or 0
+      last_generation, self._last_generation = self._last_generation, generation
+    if last_generation is None or generation == last_generation:
+      return []
+    if not 0 < generation - last_generation <= self.max_log_reads: # fell behind or counter reset
+      return [(None, [], 'delete')]
+    log_keys = [self._log_key(g) for g in xrange(last_generation + 1, generation + 1)]
+    found = LPCM_CACHE.get_many(log_keys)
+    if len(found) < len(log_keys):
+      return [(None, [], 'delete')]
+    return [tuple(found[log_key]) for log_key in log_keys]
+
+  def _log_key(self, generation):
+    return "{}_{}".format(self.GENERATION_KEY, generation)
+
+
+class SocketInvalidationBroadcaster(InvalidationBroadcaster):
+  """ Sends messages as datagrams to a list of peers, over UDP or unix sockets.
+    address is the (host, port) or the socket file path this process listens on, and peers
+    is the list of addresses to publish to. Meant for tests and single-host deployments:
+    datagrams may get lost, and nothing is authenticated.
+    A socket file left behind by a previous process is replaced, but a socket file that another
+    process still listens on is not: socket.error EADDRINUSE is raised instead.
+  """
+  MAX_DATAGRAM_SIZE = 65507
+
+  def __init__(self, address, peers):
+    self.peers = peers
+    self.socket = socket.socket(self._family(address), socket.SOCK_DGRAM)
+    if isinstance(address, basestring) and os.path.exists(address):
+      self._unlink_stale_socket(address)
+    self.socket.bind(address)
+    self.socket.setblocking(False)
+
+  def publish(self, map_name, keys, action):
+    for chunk in self._chunks(keys):
+      datagram = json.dumps([map_name, chunk, action])
+      for peer in self.peers:
+        try:
+          self.socket.sendto(datagram, peer)
+        except socket.error: # a peer that is down shouldn't fail the update
+          pass
+
+  def poll(self):
+    messages = []
+    while True:
+      try:
+        datagram = self.socket.recv(self.MAX_DATAGRAM_SIZE)
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return messages
+        raise
+      messages.append(tuple(json.loads(datagram)))
+
+  def _unlink_stale_socket(self, path):
+    "Nobody receives on a stale socket file, so connecting to it is refused"
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      probe.connect(path)
+    except socket.error as e:
+      if e.errno != errno.ECONNREFUSED:
+        raise
+      os.unlink(path) # left behind by a previous process
+    else:
+      raise socket.error(errno.EADDRINUSE, "{} is in use by another process".format(path))
+    finally:
+      probe.close()
+
+  def _family(self, address):
+    if isinstance(address, basestring):
+      return socket.AF_UNIX
+    return socket.AF_INET
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+_local_maps = set() # the maps created with local_cache = True in this process
+
+def add_local_map(map_name):
+  """ Records that a map is cached in-process, so that its updates are published. Maps without
+  a local cache have no local copies to invalidate, and their updates are not published """
+  _local_maps.add(map_name)
+
+def get_broadcaster():
+  "Returns the process-wide broadcaster set in LPCM_INVALIDATION_BROADCASTER, or None"
+  global _broadcaster
+  if _broadcaster is None and config.LPCM_INVALIDATION_BROADCASTER:
+    with _broadcaster_lock:
+      if _broadcaster is None:
+        module_name, class_name = config.LPCM_INVALIDATION_BROADCASTER.rsplit('.', 1)
+        kls = getattr(import_module(module_name), class_name)
+        _broadcaster = kls(**config.LPCM_INVALIDATION_OPTIONS)
+  return _broadcaster
+
+def evict_invalidated_keys(local_cache):
+  "Evicts the local entries of the keys updated by other processes"
+  broadcaster = get_broadcaster()
+  if broadcaster is None:
+    return
+  for map_name, keys, action in broadcaster.poll():
+    if map_name is None:
+      local_cache.clear()
+    else:
+      local_cache.delete_many([LPCMKey.get(map_name, key).cache_key for key in keys])
+
+
+@receiver(Signals.post_update)
+def on_map_update(sender, **kwargs):
+  if kwargs['map_name'] not in _local_maps:
+    return
+  broadcaster = get_broadcaster()
+  if broadcaster is None:
+    return
+  keys = [LPCMKey.get(kwargs['map_name'], key).original_key_str
+    for key in Signals.updated_keys(kwargs)]
+  broadcaster.publish(kwargs['map_name'], keys, kwargs['action'])
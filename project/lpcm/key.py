@@ -1,16 +1,38 @@
 import base64
+import binascii
 from thread_local import is_in_test
+import config
 
 class LPCMKey(object):
   """Represents a composite key used by dynamo-db and memcached"""
-  def __init__(self, map_name, key):
+  __slots__ = ('original_key_obj', 'original_key_str', 'range_key', 'hash_key', 'cache_key')
+
+  # How range keys are encoded. base32 is the original encoding. hex is cheaper, and keeps the
+  # keys in order: dynamodb sorts them as their utf-8 strings would sort.
+  ENCODINGS = ('base32', 'hex')
+  # the characters range keys are made of, in the order dynamodb sorts them
+  RANGE_KEY_ALPHABETS = {
+    'base32': sorted("ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"),
+    'hex': sorted("0123456789abcdef"),
+    }
+
+  _map_encodings = {} # map_name: encoding, set by the map constructors (see set_map_encoding)
+  _used_maps = set() # the maps whose keys were built with their encoding
+  _memos = {} # map_name: {(in_test, key type, key): LPCMKey}
+
+  def __init__(self, map_name, key, encoding = None):
+    if encoding is None:
+      encoding = self.map_encoding(map_name)
+      self._used_maps.add(map_name)
     self.original_key_obj = key
     if isinstance(key, str) or isinstance(key, unicode):
       self.original_key_str = key
     else:
       self.original_key_str = repr(key) # so you we have tuple and other obj keys
-    self.range_key =  base64.b32encode(self.original_key_str.encode('utf-8'))
+    self.range_key = self.encode_range_key(self.original_key_str, encoding)
     self.hash_key = self._get_ddb_hash_key(map_name)
+    #noinspection PyTypeChecker
+    self.cache_key = "{self.hash_key}_{self.range_key}".format(self = self)
 
   def _get_ddb_hash_key(self, map_name):
     hash_key = map_name
@@ -18,7 +40,72 @@ class LPCMKey(object):
       hash_key = u"__test_{hash_key}".format(hash_key = hash_key)
     return hash_key
 
-  @property
-  def cache_key(self):
-    #noinspection PyTypeChecker
-    return "{self.hash_key}_{self.range_key}".format(self = self)
+  @classmethod
+  def get(cls, map_name, key):
+    """ Returns the LPCMKey of map_name:key, from a bounded memo of the recently used keys of
+    each map. An LPCMKey is returned as it is, so that a key built by one layer is reused by
+    the next. The memo is cleared when it reaches LPCM_KEY_MEMO_MAX_ENTRIES """
+    if isinstance(key, LPCMKey):
+      return key
+    memo = cls._memos.get(map_name)
+    if memo is None:
+      memo = cls._memos.setdefault(map_name, {})
+    memo_key = (is_in_test(), type(key), key) # 1, 1.0 and True are equal, but not the same key
+    try:
+      return memo[memo_key]
+    except KeyError:
+      pass
+    except TypeError: # not hashable
+      return cls(map_name, key)
+    cmp_key = cls(map_name, key)
+    if len(memo) >= config.LPCM_KEY_MEMO_MAX_ENTRIES:
+      memo.clear()
+    memo[memo_key] = cmp_key
+    return cmp_key
+
+  @classmethod
+  def set_map_encoding(cls, map_name, encoding):
+    """ Sets the range key encoding of a map in this process. It must not change once the map
+    has data: the keys saved with another encoding would not be found. So it raises ValueError
+    if the map already has another encoding, set here or in LPCM_KEY_ENCODINGS, or if keys of
+    the map were already built with its current one.
+    Other processes only know the encodings set in LPCM_KEY_ENCODINGS: prefer it """
+    if encoding not in cls.ENCODINGS:
+      raise ValueError("Unknown key encoding: {}".format(encoding))
+    current = cls.map_encoding(map_name)
+    if current == encoding:
+      return
+    if (map_name in cls._map_encodings or map_name in config.LPCM_KEY_ENCODINGS or
+        map_name in cls._used_maps):
+      raise ValueError("Map {} already uses the {} key encoding".format(map_name, current))
+    cls._map_encodings[map_name] = encoding
+    cls._memos.pop(map_name, None)
+
+  @classmethod
+  def map_encoding(cls, map_name):
+    encoding = cls._map_encodings.get(map_name)
+    if encoding is None:
+      encoding = config.LPCM_KEY_ENCODINGS.get(map_name, 'base32')
+    return encoding
+
+  @staticmethod
+  def encode_range_key(key_str, encoding = 'base32'):
+    if encoding == 'hex':
+      return binascii.hexlify(key_str.encode('utf-8'))
+    return base64.b32encode(key_str.encode('utf-8'))
+
+  @staticmethod
+  def decode_range_key(range_key, encoding = 'base32'):
+    "Returns the key string of a range key"
+    if encoding == 'hex':
+      return binascii.unhexlify(range_key).decode('utf-8')
+    return base64.b32decode(range_key).decode('utf-8')
+
+  @classmethod
+  def range_key_segments(cls, num_segments, encoding = 'base32'):
+    """ Splits the range keys in (at most) num_segments ranges, by their first character.
+    Returns a list of (start, end) tuples. end is exclusive, and None for the last segment """
+    alphabet = cls.RANGE_KEY_ALPHABETS[encoding]
+    num_segments = max(1, min(num_segments, len(alphabet)))
+    starts = [alphabet[i * len(alphabet) // num_segments] for i in xrange(num_segments)]
+    return zip(starts, starts[1:] + [None])
@@ -1,15 +1,20 @@
-import operator
+import itertools
 from django.dispatch import receiver
+from cache import Cache
 from lpcm import LargePersistentCachedMap
-from lpm import MockLPM
+from lpm import MockLPM, MISSING
 from models import Signals
 from key import LPCMKey
 
 class LargeCachedMap(LargePersistentCachedMap):
   """The Cached-only version of LPCM. Used in tests and debug"""
+  class Constants(object):
+    ITER_BATCH_SIZE = 100
 
-  def __init__(self, name, cache_timeout = None):
-    super(LargeCachedMap, self).__init__(name, cache_timeout)
+  def __init__(self, name, cache_timeout = None, local_cache = False, codec = None,
+      key_encoding = None):
+    super(LargeCachedMap, self).__init__(name, cache_timeout, local_cache = local_cache, codec = codec,
+      key_encoding = key_encoding)
     self.lpm = MockLPM()
 
   def __setitem__(self, key, value):
@@ -20,39 +25,122 @@ class LargeCachedMap(LargePersistentCachedMap):
 
   def _atomic_add_value(self, key, value):
     Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
-    cmp_key = LPCMKey(self.name, key)
-    self.cache.atomic_update(cmp_key.cache_key, value,
-      update_operator = operator.add, default_value = 0)
+    cmp_key = LPCMKey.get(self.name, key)
+    new_value = self.cache.incr(cmp_key.cache_key, value, initial_value = 0)
     Signals.post_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
+    return new_value
 
   def __iter__(self):
-    return LCMKeys.get_keys(map_name = self.name).__iter__()
+    return LCMKeys.iter_keys(map_name = self.name)
+
+  def iterkeys(self, segments = 1, request_limit = None, consistent_read = False):
+    return self.__iter__()
+
+  def iteritems(self, segments = 1, request_limit = None, consistent_read = False):
+    """ segments and consistent_read are ignored: the keys are read a page at a time,
+    and the values in batches of request_limit keys """
+    keys = iter(self)
+    batch_size = request_limit or self.Constants.ITER_BATCH_SIZE
+    while True:
+      batch = list(itertools.islice(keys, batch_size))
+      if not batch:
+        return
+      found = self.get_many(batch)
+      for key in batch:
+        if key in found:
+          yield key, found[key]
+
+  def pop(self, k, d = MISSING):
+    "Not atomic: memcached cannot delete a key and return its value in one operation"
+    try:
+      value = self[k]
+    except KeyError:
+      if d is MISSING:
+        raise
+      return d
+    self.delete(k)
+    return value
 
 class LCMKeys(object):
-  """Enables cached-only LPCM maps to keep track of their keys"""
+  """ Enables cached-only LPCM maps to keep track of their keys.
+    Each key is saved in its own numbered slot, from a per-map memcached counter, and a marker
+    cached next to the key records its slot. Adding keys that are already indexed costs one
+    add_many of their markers, removing keys deletes their slots and markers, and the keys are
+    read a page of slots at a time.
+    Slots are never reused: the slots of removed keys are left empty, and iter_keys still reads
+    them, so maps with a lot of churn page through more and more empty slots.
+    A key removed while it is being added (between the add of its marker and the save of its
+    slot) is indexed again by that add """
   class Constants(object):
-    LCMSET_NAME = "__lcm_keys"
+    INDEX_NAME = "__lcm_keys"
+    PAGE_SIZE = 100 # slots read per get_many
+    ADDING = "adding" # the marker of a key while its slot is being saved
+    ADDING_TIMEOUT = 10 # seconds, so a failed add does not keep the key out of the index
+
+  _cache = Cache(timeout = None)
+  _adding_cache = Cache(timeout = Constants.ADDING_TIMEOUT)
 
   @classmethod
   def add_key(cls, map_name, key):
-    map_keys = cls._get_keys_map()
-    map_keys.insert_values(key = map_name, values = [key])
+    cls.add_keys(map_name, [key])
+
+  @classmethod
+  def add_keys(cls, map_name, keys):
+    markers = [(key, cls._marker_key(map_name, key)) for key in keys]
+    added = set(cls._adding_cache.add_many(
+      dict((marker_key, cls.Constants.ADDING) for key, marker_key in markers)))
+    new_keys = [key for key, marker_key in markers if marker_key in added]
+    if not new_keys:
+      return
+    last_slot = cls._cache.incr(cls._counter_key(map_name), len(new_keys), initial_value = 0)
+    mapping = {}
+    for slot, key in enumerate(new_keys, last_slot - len(new_keys) + 1):
+      mapping[cls._slot_key(map_name, slot)] = key
+      mapping[cls._marker_key(map_name, key)] = slot
+    cls._cache.set_many(mapping)
 
   @classmethod
   def remove_key(cls, map_name, key):
-    map_keys = cls._get_keys_map()
-    map_keys.remove_values(key = map_name, values = [key])
+    cls.remove_keys(map_name, [key])
+
+  @classmethod
+  def remove_keys(cls, map_name, keys):
+    marker_keys = [cls._marker_key(map_name, key) for key in keys]
+    slots = cls._cache.get_many(marker_keys).values()
+    slot_keys = [cls._slot_key(map_name, slot) for slot in slots if slot != cls.Constants.ADDING]
+    cls._cache.delete_many(marker_keys + slot_keys)
+
+  @classmethod
+  def iter_keys(cls, map_name, page_size = None):
+    """ Iterates over the keys of a map, reading page_size slots at a time. Keys added while
+    iterating may be missed """
+    page_size = page_size or cls.Constants.PAGE_SIZE
+    last_slot = cls._cache.get(cls._counter_key(map_name)) or 0
+    for first_slot in xrange(1, last_slot + 1, page_size):
+      slots = dict((cls._slot_key(map_name, slot), slot)
+        for slot in xrange(first_slot, min(first_slot + page_size, last_slot + 1)))
+      keys = dict((slots[slot_key], key) for slot_key, key in cls._cache.get_many(slots).iteritems())
+      # a removed key may be left in its old slot by a concurrent add. its marker tells
+      markers = cls._cache.get_many([cls._marker_key(map_name, key) for key in keys.itervalues()])
+      for slot in sorted(keys):
+        if markers.get(cls._marker_key(map_name, keys[slot])) == slot:
+          yield keys[slot]
 
   @classmethod
   def get_keys(cls, map_name):
-    map_keys = cls._get_keys_map()
-    return map_keys[map_name]
+    return set(cls.iter_keys(map_name))
+
+  @classmethod
+  def _counter_key(cls, map_name):
+    return LPCMKey(cls.Constants.INDEX_NAME, map_name).cache_key
+
+  @classmethod
+  def _slot_key(cls, map_name, slot):
+    return LPCMKey(cls.Constants.INDEX_NAME, (map_name, slot)).cache_key
 
   @classmethod
-  def _get_keys_map(cls):
-    "Returns a cached-only LCPMSet which maps map-names to their current keys"
-    from lpcm_set import LargeCachedMapForSets as LCMSet
-    return LCMSet("__lcm_keys")
+  def _marker_key(cls, map_name, key):
+    return "{cache_key}_lcm_slot".format(cache_key = LPCMKey.get(map_name, key).cache_key)
 
 
 @receiver(Signals.post_update)
@@ -61,11 +149,9 @@ def on_lcm_update(sender, **kwargs):
     return
   action = kwargs['action']
   map_name = kwargs['map_name']
-  if map_name == LCMKeys.Constants.LCMSET_NAME:
-    return # this would cause a nasty recursion!
-  key = kwargs['key']
+  keys = Signals.updated_keys(kwargs)
   if action == 'put':
-    LCMKeys.add_key(map_name, key)
+    LCMKeys.add_keys(map_name, keys)
   elif action == 'delete':
-    LCMKeys.remove_key(map_name, key)
+    LCMKeys.remove_keys(map_name, keys)
 
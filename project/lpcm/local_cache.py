@@ -0,0 +1,169 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import cPickle as pickle
+import itertools
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+class LocalCache(object):
+  """ A thread-safe, in-process LRU cache with timeouts, bounded by both the number of entries
+    and their total size in bytes. Mutable values are stored pickled, so callers always get
+    their own copy.
+    c = LocalCache(max_entries = 1000, max_bytes = 1024 * 1024, timeout = 5)
+    c.set("key1", set([1, 2]))
+    print c.get("key1"), c.stats()
+  """
+  IMMUTABLE_TYPES = (str, unicode, int, long, float, bool)
+
+  def __init__(self, max_entries, max_bytes, timeout):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.timeout = timeout
+    self._entries = OrderedDict() # key: (value, is_pickled, size, expires_at, cas_id), oldest first
+    self._cas_ids = itertools.count(1)
+    self._lock = threading.Lock()
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    "Returns None for missing and expired keys"
+    with self._lock:
+      entry = self._get_entry(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+    return self._load(entry)
+
+  def set(self, key, value, timeout = None):
+    stored = self._prepare(value)
+    with self._lock:
+      self._set(key, stored, timeout)
+
+  def add(self, key, value, timeout = None):
+    "Sets the value only if the key is missing or expired. Returns True if it was set"
+    stored = self._prepare(value)
+    with self._lock:
+      if self._get_entry(key) is not None:
+        return False
+      self._set(key, stored, timeout)
+      return True
+
+  def get_and_add(self, key, add_key, add_value, timeout = None):
+    """ In one atomic operation, gets the value of key and, if it is missing, adds add_value
+    at add_key. Returns (value, added, the value found at add_key when it was not added) """
+    stored = self._prepare(add_value)
+    with self._lock:
+      entry = self._get_entry(key)
+      if entry is not None:
+        return self._load(entry), False, None
+      add_entry = self._get_entry(add_key)
+      if add_entry is not None:
+        return None, False, self._load(add_entry)
+      self._set(add_key, stored, timeout)
+      return None, True, None
+
+  def incr(self, key, delta):
+    """ Atomically adds delta to an integer value, keeping its timeout. Returns the new value,
+    or None if the key is missing. Raises ValueError if the value is not an integer """
+    with self._lock:
+      entry = self._get_entry(key)
+      if entry is None:
+        return None
+      if entry[1] or not isinstance(entry[0], (int, long)) or isinstance(entry[0], bool):
+        raise ValueError("Cannot increment a non-integer value")
+      value = entry[0] + delta
+      self._entries[key] = (value, False, entry[2], entry[3], next(self._cas_ids))
+      return value
+
+  def gets(self, key):
+    "Returns (value, cas_id). cas_id changes whenever the value does. (None, None) if missing"
+    with self._lock:
+      entry = self._get_entry(key)
+    if entry is None:
+      return None, None
+    return self._load(entry), entry[4]
+
+  def cas(self, key, value, cas_id, timeout = None):
+    """ Compare And Swap: sets the value only if it did not change since gets() returned cas_id.
+    Returns True if it was set """
+    stored = self._prepare(value)
+    with self._lock:
+      entry = self._get_entry(key)
+      if entry is None or entry[4] != cas_id:
+        return False
+      self._set(key, stored, timeout)
+      return True
+
+  def delete(self, key):
+    with self._lock:
+      self._delete(key)
+
+  def delete_many(self, keys):
+    with self._lock:
+      for key in keys:
+        self._delete(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    "Returns the hit/miss counters and the current size, to help sizing the cache"
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'entries': len(self._entries),
+        'bytes': self._bytes,
+        }
+
+  def _get_entry(self, key):
+    "Returns the entry of a key, as the most recently used, or None. Call with the lock held"
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return None
+    if entry[3] < time.time():
+      self._bytes -= entry[2]
+      return None
+    self._entries[key] = entry
+    return entry
+
+  def _prepare(self, value):
+    "Returns the (value, is_pickled, size) to store"
+    if isinstance(value, self.IMMUTABLE_TYPES):
+      return value, False, sys.getsizeof(value)
+    value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    return value, True, len(value)
+
+  def _load(self, entry):
+    if entry[1]:
+      return pickle.loads(entry[0])
+    return entry[0]
+
+  def _set(self, key, stored, timeout):
+    "Call with the lock held"
+    if timeout is None:
+      timeout = self.timeout
+    value, is_pickled, size = stored
+    self._delete(key)
+    if size > self.max_bytes:
+      return
+    self._entries[key] = (value, is_pickled, size, time.time() + timeout, next(self._cas_ids))
+    self._bytes += size
+    while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+      _, entry = self._entries.popitem(last = False)
+      self._bytes -= entry[2]
+      self.evictions += 1
+
+  def _delete(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._bytes -= entry[2]
@@ -2,10 +2,15 @@
 # Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
 
 import numbers
+import random
 import time
 from cache import Cache, CacheDisabled
-from lpm import LargePersistentMap
+from counters import discard_pending_deltas, get_counter_buffer
+import invalidation
+import config
+from lpm import LargePersistentMap, MISSING
 from models import Signals
+from single_flight import SingleFlight
 from key import LPCMKey
 
 class LargePersistentCachedMap(object):
@@ -18,26 +23,47 @@ class LargePersistentCachedMap(object):
     m2 = LargePersistentCachedMap("my_table")
     print m2["key1"]
   """
+  _reads = SingleFlight() # the dynamodb reads in flight, shared by all the maps of the process
 
-  def __init__(self, name, cache_timeout = None):
-    "When cache_only is true, the data will be stored in memcached only (used in tests)"
+  def __init__(self, name, cache_timeout = None, negative_cache_timeout = None, local_cache = False,
+      codec = None, buffered_counters = False, key_encoding = None):
+    """ When negative_cache_timeout is set, keys that are not in dynamodb are remembered in
+    memcached for that many seconds, so that repeated reads of missing keys are cheap.
+    When local_cache is True, values are also cached in-process, in front of memcached.
+    This suits small, very hot maps. See LPCM_LOCAL_CACHE_* in the settings. Only the updates of
+    such maps are published to the invalidation broadcaster, so every process that writes to
+    the map must create it with local_cache = True too.
+    codec (a codec.Codec) serializes and compresses values, in both memcached and dynamodb.
+    Values saved before the codec was set are still read correctly.
+    With buffered_counters, increments are applied to memcached right away, but written to
+    dynamodb in the background, summed per key. See counters.py and LPCM_COUNTER_* in the settings.
+    Increments are only buffered once a read has cached the counter, and reads that miss
+    memcached write the pending deltas of the key first.
+    key_encoding sets how keys are encoded (prefer LPCM_KEY_ENCODINGS, see LargePersistentMap).
+    It cannot change once the map has data.
+    'hex' is cheaper than the default 'base32', and keeps the keys in order """
     self.name = name
-    self.lpm = LargePersistentMap(name)
-    self.cache = Cache(cache_timeout)
+    self.lpm = LargePersistentMap(name, codec, key_encoding)
+    self.cache = Cache(cache_timeout, negative_cache_timeout, local_cache, codec)
+    if local_cache:
+      invalidation.add_local_map(name)
+    self.counter_buffer = get_counter_buffer() if buffered_counters else None
 
   def __setitem__(self, key, value):
     Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
-    cmp_key = LPCMKey(self.name, key)
+    cmp_key = LPCMKey.get(self.name, key)
     self.cache.set(cmp_key.cache_key, value)
-    self.lpm[key] = value
+    self.lpm[cmp_key] = value
     Signals.post_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
 
   def __getitem__(self, key):
-    cmp_key = LPCMKey(self.name, key)
+    cmp_key = LPCMKey.get(self.name, key)
     v = self.cache.get(cmp_key.cache_key)
-    if v is not None:
-      return v
-    return self._get_from_dynamodb_and_save_in_cache(cmp_key)
+    if v is None:
+      return self._get_from_dynamodb_and_save_in_cache(cmp_key)
+    if self.cache.is_missing(v):
+      raise self._key_error(cmp_key)
+    return v
 
   def get(self, k, d = None):
     """ D.get(k[,d]) -> D[k] if k in D, else d.  d defaults to None. """
@@ -53,72 +79,302 @@ class LargePersistentCachedMap(object):
       return False
     return True
 
+  def get_many(self, keys):
+    """ Returns a dict of key:value for the given keys that exist in the map.
+    All keys are looked up in a single memcached get_many. The misses are then read from
+    dynamodb in batches and saved back in cache with a single set_many. When the cache adds
+    many keys in one round trip, the tokens of the misses are claimed together first, so that
+    batched reads are protected from the cache-miss stampede too """
+    cmp_keys = [LPCMKey.get(self.name, key) for key in keys]
+    cached = self.cache.get_many([cmp_key.cache_key for cmp_key in cmp_keys])
+    result = {}
+    misses = []
+    for cmp_key in cmp_keys:
+      if cmp_key.cache_key not in cached:
+        misses.append(cmp_key)
+      elif not self.cache.is_missing(cached[cmp_key.cache_key]):
+        result[cmp_key.original_key_obj] = cached[cmp_key.cache_key]
+    if not misses:
+      return result
+    if self.cache.has_batched_add():
+      found = self._get_many_with_tokens(misses)
+    else:
+      found = self._get_many_from_dynamodb_and_save_in_cache(misses)
+    for cmp_key, value in found.iteritems():
+      result[cmp_key.original_key_obj] = value
+    return result
+
   def disable_caching(self):
     self.cache = CacheDisabled()
 
   def _get_from_dynamodb_and_save_in_cache(self, cmp_key):
-    """ Gets value from dynamodb and puts it in cache, taking care of the cache-miss stampede """
-    if self.cache.get_thread_safe_token(cmp_key.cache_key):
-      # we got the token. i'll get it from db while other threads wait!
-      value = self.lpm[cmp_key.original_key_obj]
-      self.cache.set(cmp_key.cache_key, value)
-      return value
-    # someone is already getting it
-    time.sleep(1) # wait a little, and get it again (hopefully from cache)
-    return self.__getitem__(cmp_key.original_key_obj)
+    """ Gets value from dynamodb and puts it in cache, taking care of the cache-miss stampede.
+    The threads of a process that miss the same key share one read, and only that read
+    competes with the other processes for the memcached token """
+    return self._reads.do(cmp_key.cache_key, lambda: self._get_with_token(cmp_key))
+
+  def _get_with_token(self, cmp_key):
+    value, token = self.cache.get_with_lease(cmp_key.cache_key)
+    if token != Cache.Constants.LEASED:
+      # someone is already getting it, or just did
+      if self.cache.is_missing(value) or token == Cache.Constants.KEY_MISSING:
+        raise self._key_error(cmp_key)
+      if value is not None:
+        return value
+      return self._wait_for_token_holder(cmp_key)
+    # we got the token. i'll get it from db while other threads wait!
+    try:
+      self._write_pending_deltas([cmp_key])
+      value = self.lpm[cmp_key]
+    except KeyError:
+      self.cache.set_missing([cmp_key.cache_key])
+      self.cache.release_thread_safe_token(cmp_key.cache_key, key_missing = True)
+      raise
+    except:
+      self.cache.release_thread_safe_token(cmp_key.cache_key)
+      raise
+    self.cache.set(cmp_key.cache_key, value)
+    self.cache.release_thread_safe_token(cmp_key.cache_key)
+    return value
+
+  def _wait_for_token_holder(self, cmp_key):
+    """ Polls the cache until the thread holding the token has saved the value. Raises KeyError
+    if that thread found the key missing. If it gives up or takes longer than
+    LPCM_STAMPEDE_MAX_WAIT_MS, we read the value from dynamodb ourselves """
+    deadline = time.time() + config.LPCM_STAMPEDE_MAX_WAIT_MS / 1000.0
+    interval = config.LPCM_STAMPEDE_POLL_INTERVAL_MS / 1000.0
+    while time.time() < deadline:
+      time.sleep(interval * random.uniform(0.5, 1.5)) # jitter, so waiters don't poll in lockstep
+      interval = max(0, min(interval * 2, deadline - time.time()))
+      value, token = self.cache.get_with_token(cmp_key.cache_key)
+      if self.cache.is_missing(value) or token == Cache.Constants.KEY_MISSING:
+        raise self._key_error(cmp_key)
+      if value is not None:
+        return value
+      if token is None:
+        break # the holder failed without saving anything
+    self._write_pending_deltas([cmp_key])
+    try:
+      value = self.lpm[cmp_key]
+    except KeyError:
+      self.cache.set_missing([cmp_key.cache_key])
+      raise
+    self.cache.set(cmp_key.cache_key, value)
+    return value
+
+  def _get_many_from_dynamodb_and_save_in_cache(self, cmp_keys):
+    "Returns a dict of cmp_key:value for the keys that exist"
+    self._write_pending_deltas(cmp_keys)
+    found = self.lpm.get_many(cmp_keys) # keyed by the LPCMKeys
+    self.cache.set_many(dict((cmp_key.cache_key, value) for cmp_key, value in found.iteritems()))
+    self.cache.set_missing([cmp_key.cache_key for cmp_key in cmp_keys if cmp_key not in found])
+    return found
+
+  def _get_many_with_tokens(self, cmp_keys):
+    """ The batched _get_with_token: claims the tokens of all the keys in one add_many, reads the
+    claimed keys from dynamodb in batches, and waits for the holders of the other tokens.
+    Returns a dict of cmp_key:value for the keys that exist """
+    by_cache_key = dict((cmp_key.cache_key, cmp_key) for cmp_key in cmp_keys)
+    claimed = set(self.cache.get_thread_safe_tokens(by_cache_key.keys()))
+    found = {}
+    if claimed:
+      try:
+        found = self._get_many_from_dynamodb_and_save_in_cache(
+          [by_cache_key[cache_key] for cache_key in claimed])
+      except:
+        self.cache.release_thread_safe_tokens(claimed)
+        raise
+      self.cache.release_thread_safe_tokens(claimed, missing_keys = [cache_key
+        for cache_key in claimed if by_cache_key[cache_key] not in found])
+    others = [cmp_key for cmp_key in cmp_keys if cmp_key.cache_key not in claimed]
+    if others:
+      found.update(self._wait_for_token_holders(others))
+    return found
+
+  def _wait_for_token_holders(self, cmp_keys):
+    """ The batched _wait_for_token_holder: polls the cache for all the keys at once. The keys
+    that are still not saved when the holders give up or LPCM_STAMPEDE_MAX_WAIT_MS is over are
+    read from dynamodb. Returns a dict of cmp_key:value for the keys that exist """
+    deadline = time.time() + config.LPCM_STAMPEDE_MAX_WAIT_MS / 1000.0
+    interval = config.LPCM_STAMPEDE_POLL_INTERVAL_MS / 1000.0
+    found = {}
+    waiting = list(cmp_keys)
+    abandoned = [] # the holder failed without saving anything
+    while waiting and time.time() < deadline:
+      time.sleep(interval * random.uniform(0.5, 1.5))
+      interval = max(0, min(interval * 2, deadline - time.time()))
+      cached = self.cache.get_many_with_tokens([cmp_key.cache_key for cmp_key in waiting])
+      still_waiting = []
+      for cmp_key in waiting:
+        value, token = cached[cmp_key.cache_key]
+        if self.cache.is_missing(value) or token == Cache.Constants.KEY_MISSING:
+          continue
+        if value is not None:
+          found[cmp_key] = value
+        elif token is None:
+          abandoned.append(cmp_key)
+        else:
+          still_waiting.append(cmp_key)
+      waiting = still_waiting
+    if waiting or abandoned:
+      found.update(self._get_many_from_dynamodb_and_save_in_cache(abandoned + waiting))
+    return found
+
+  def _key_error(self, cmp_key):
+    return KeyError(u"{name}:{key}".format(name = self.name, key = cmp_key.original_key_obj))
 
   def delete(self, key):
     "Deletes a key-value map from memcached and dynamodb. Ignores it if item does not exist"
     Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'delete')
-    cmp_key = LPCMKey(self.name, key)
+    cmp_key = LPCMKey.get(self.name, key)
+    discard_pending_deltas([cmp_key])
     self.cache.delete(cmp_key.cache_key)
-    self.lpm.delete(key)
+    self.lpm.delete(cmp_key)
     Signals.post_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'delete')
 
+  def set_many(self, mapping):
+    """ Saves all the key:value pairs of the given dict with a single memcached set_many
+    and batched dynamodb writes. The update signals are sent once for the whole batch """
+    keys = list(mapping)
+    Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = None, keys = keys,
+      action = 'put')
+    cmp_mapping = dict((LPCMKey.get(self.name, key), value) for key, value in mapping.iteritems())
+    self.cache.set_many(dict((cmp_key.cache_key, value) for cmp_key, value in cmp_mapping.iteritems()))
+    self.lpm.set_many(cmp_mapping)
+    Signals.post_update.send(sender = self.__class__, map_name = self.name, key = None, keys = keys,
+      action = 'put')
+
+  def delete_many(self, keys):
+    """ Deletes the given keys with a single memcached delete_many and batched dynamodb writes.
+    Ignores keys that do not exist. The update signals are sent once for the whole batch """
+    keys = list(keys)
+    Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = None, keys = keys,
+      action = 'delete')
+    cmp_keys = [LPCMKey.get(self.name, key) for key in keys]
+    discard_pending_deltas(cmp_keys)
+    self.cache.delete_many([cmp_key.cache_key for cmp_key in cmp_keys])
+    self.lpm.delete_many(cmp_keys)
+    Signals.post_update.send(sender = self.__class__, map_name = self.name, key = None, keys = keys,
+      action = 'delete')
+
   def increment(self, key, value = 1):
+    "Returns the new value"
     if not isinstance(value, numbers.Number):
       raise ValueError(
         "Invalid increment value: {}. Only numbers are supported".format(value))
-    self._atomic_add_value(key, value)
+    return self._atomic_add_value(key, value)
 
   def decrement(self, key, value = 1):
+    "Returns the new value"
     if not isinstance(value, numbers.Number):
       raise ValueError(
         "Invalid decrement value: {}. Only numbers are supported".format(value))
-    self._atomic_add_value(key, value * -1)
+    return self._atomic_add_value(key, value * -1)
 
   def _atomic_add_value(self, key, value):
+    """ The cached value is deleted after the dynamodb update, rather than updated: its order
+    against the update is unknown (a concurrent read may have cached the new total already, and
+    concurrent updates return in any order), so only the next read can cache the right value """
     Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
-    cmp_key = LPCMKey(self.name, key)
-    self.lpm.atomic_add_value(key, value)
-    self.cache.delete(cmp_key.cache_key)
+    cmp_key = LPCMKey.get(self.name, key)
+    if self.counter_buffer is not None and isinstance(value, numbers.Number):
+      new_value = self._buffered_add_value(cmp_key, value)
+    else:
+      new_value = self.lpm.atomic_add_value(cmp_key, value)
+      self.cache.delete(cmp_key.cache_key)
     Signals.post_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
+    return new_value
+
+  def _buffered_add_value(self, cmp_key, value):
+    """ Increments the cached counter, and leaves the dynamodb write to the counter buffer.
+    If the counter is not cached, the pending delta is written right away instead, and the
+    cached value is deleted like in _atomic_add_value. If that write fails, the pending delta is
+    put back. So increments are only buffered once a read has cached the counter.
+    The cached counter is the base of the later increments, so reads that miss the cache write
+    the pending deltas of the key before reading it (see _write_pending_deltas). An increment
+    made by another process between such a read and its cache write can still be missing from
+    the cached total, until the key leaves the cache """
+    new_value = self.cache.incr(cmp_key.cache_key, value)
+    if new_value is not None:
+      self.counter_buffer.add(cmp_key, value)
+      return new_value
+    pending = self.counter_buffer.take(cmp_key)
+    try:
+      new_value = self.lpm.atomic_add_value(cmp_key, pending + value)
+    except:
+      if pending:
+        self.counter_buffer.add(cmp_key, pending)
+      raise
+    self.cache.delete(cmp_key.cache_key)
+    return new_value
+
+  def _write_pending_deltas(self, cmp_keys):
+    """ Writes the buffered counter deltas of keys that are about to be read from dynamodb and
+    cached, so that the cached totals include them """
+    if self.counter_buffer is None or isinstance(self.cache, CacheDisabled):
+      return
+    for cmp_key in cmp_keys:
+      delta = self.counter_buffer.take(cmp_key)
+      if not delta:
+        continue
+      try:
+        self.lpm.atomic_add_value(cmp_key, delta)
+      except:
+        self.counter_buffer.add(cmp_key, delta)
+        raise
 
   def _atomic_delete_values(self, key, values):
+    "Like _atomic_add_value, the cached set is deleted after the dynamodb update"
     Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
-    cmp_key = LPCMKey(self.name, key)
-    self.lpm.atomic_delete_values(key, values)
+    cmp_key = LPCMKey.get(self.name, key)
+    new_value = self.lpm.atomic_delete_values(cmp_key, values)
     self.cache.delete(cmp_key.cache_key)
     Signals.post_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
+    return new_value
 
   def __iter__(self):
     """ Note: this method is EXPENSIVE! PLease only use if absolutely needed"""
-    return self.lpm.__iter__()
+    return self.iterkeys()
+
+  def iteritems(self, segments = 1, request_limit = None, consistent_read = False):
+    """ Note: this method is EXPENSIVE! PLease only use if absolutely needed
+    Streams the (key, value) pairs from dynamodb, request_limit items per query page.
+    With segments > 1, that many ranges of keys are queried in parallel """
+    return self.lpm.iteritems(segments, request_limit, consistent_read)
+
+  def iterkeys(self, segments = 1, request_limit = None, consistent_read = False):
+    """ Note: this method is EXPENSIVE! PLease only use if absolutely needed"""
+    return self.lpm.iterkeys(segments, request_limit, consistent_read)
+
+  def itervalues(self, segments = 1, request_limit = None, consistent_read = False):
+    """ Note: this method is EXPENSIVE! PLease only use if absolutely needed"""
+    for key, value in self.iteritems(segments, request_limit, consistent_read):
+      yield value
 
-  def items(self):
+  def items(self, segments = 1, request_limit = None, consistent_read = False):
     """ Note: this method is EXPENSIVE! PLease only use if absolutely needed"""
-    return [(k, self[k]) for k in self]
+    return list(self.iteritems(segments, request_limit, consistent_read))
 
-  def keys(self):
+  def keys(self, segments = 1, request_limit = None, consistent_read = False):
     """ Note: this method is EXPENSIVE! PLease only use if absoluely needed"""
-    return [k for k in self]
+    return list(self.iterkeys(segments, request_limit, consistent_read))
 
-  def pop(self, k, d = None):
+  def values(self, segments = 1, request_limit = None, consistent_read = False):
+    """ Note: this method is EXPENSIVE! PLease only use if absolutely needed"""
+    return list(self.itervalues(segments, request_limit, consistent_read))
+
+  def pop(self, k, d = MISSING):
     """
     D.pop(k[,d]) -> v, remove specified key and return the corresponding value.
     If key is not found, d is returned if given, otherwise KeyError is raised
     """
-    pass
+    Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = k, action = 'delete')
+    cmp_key = LPCMKey.get(self.name, k)
+    discard_pending_deltas([cmp_key])
+    self.cache.delete(cmp_key.cache_key)
+    value = self.lpm.pop(cmp_key, d)
+    Signals.post_update.send(sender = self.__class__, map_name = self.name, key = k, action = 'delete')
+    return value
 
   def clear(self):
     raise NotImplementedError()
@@ -1,6 +1,8 @@
 # Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
 # Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
 
+import zlib
+from boto.dynamodb.exceptions import DynamoDBConditionalCheckFailedError, DynamoDBValidationError
 from lpcm import LargePersistentCachedMap
 from lcm import LargeCachedMap
 from lpm import LargePersistentMap
@@ -17,14 +19,20 @@ class LargePersistentCachedMapForSets(LargePersistentCachedMap):
     m["new-key"] returns set()
   """
 
-  def __init__(self, name, cache_timeout=None):
-    "When cache_only is true, the data will be stored in memcached only (used in tests)"
-    super(LargePersistentCachedMapForSets, self).__init__(name)
+  def __init__(self, name, cache_timeout = None, negative_cache_timeout = None, local_cache = False,
+      codec = None, key_encoding = None):
+    "The codec only applies to memcached: dynamodb needs native sets for the atomic updates"
+    super(LargePersistentCachedMapForSets, self).__init__(name, cache_timeout,
+      negative_cache_timeout, local_cache, codec, key_encoding = key_encoding)
     self.lpm = LargePersistentMapForSets(name)
 
   def __setitem__(self, key, value):
     return super(LargePersistentCachedMapForSets, self).__setitem__(key, set(value))
 
+  def set_many(self, mapping):
+    mapping = dict((key, set(value)) for key, value in mapping.iteritems())
+    return super(LargePersistentCachedMapForSets, self).set_many(mapping)
+
   def __getitem__(self, key):
     "Return empty set for non-existent keys"
     try:
@@ -32,12 +40,27 @@ class LargePersistentCachedMapForSets(LargePersistentCachedMap):
     except KeyError:
       return set()
 
+  def get_many(self, keys):
+    "Return empty sets for non-existent keys"
+    result = super(LargePersistentCachedMapForSets, self).get_many(keys)
+    return dict((key, result.get(key, set())) for key in keys)
 
   def insert_values(self, key, values):
-    self._atomic_add_value(key, set(values))
+    """ Adds values to the set with a single dynamodb update, and returns the new set.
+    The cached set is deleted, and cached again by the next read """
+    values = set(values)
+    if not values:
+      return self[key] # dynamodb rejects empty sets
+    return self._atomic_add_value(key, values)
 
   def remove_values(self, key, values):
-    self._atomic_delete_values(key, set(values))
+    """ Removes values from the set with a single dynamodb update, and returns the new set.
+    The cached set is deleted, and cached again by the next read """
+    values = set(values)
+    if not values:
+      return self[key]
+    new_value = self._atomic_delete_values(key, values)
+    return set() if new_value is None else new_value
 
   def increment(self, key, value = 1):
     raise NotImplementedError
@@ -50,6 +73,10 @@ class LargeCachedMapForSets(LargeCachedMap):
   def __setitem__(self, key, value):
     return super(LargeCachedMapForSets, self).__setitem__(key, set(value))
 
+  def set_many(self, mapping):
+    mapping = dict((key, set(value)) for key, value in mapping.iteritems())
+    return super(LargeCachedMapForSets, self).set_many(mapping)
+
   def __getitem__(self, key):
     "Return empty set for non-existent keys"
     try:
@@ -57,19 +84,26 @@ class LargeCachedMapForSets(LargeCachedMap):
     except KeyError:
       return set()
 
+  def get_many(self, keys):
+    "Return empty sets for non-existent keys"
+    result = super(LargeCachedMapForSets, self).get_many(keys)
+    return dict((key, result.get(key, set())) for key in keys)
+
   def insert_values(self, key, values):
     Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
-    cmp_key = LPCMKey(self.name, key)
-    self.cache.atomic_update(cmp_key.cache_key, values,
+    cmp_key = LPCMKey.get(self.name, key)
+    new_value = self.cache.atomic_update(cmp_key.cache_key, set(values),
       update_operator = set.union, default_value = set())
     Signals.post_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
+    return new_value
 
   def remove_values(self, key, values):
     Signals.pre_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
-    cmp_key = LPCMKey(self.name, key)
-    self.cache.atomic_update(cmp_key.cache_key, values,
+    cmp_key = LPCMKey.get(self.name, key)
+    new_value = self.cache.atomic_update(cmp_key.cache_key, set(values),
       update_operator = set.difference, default_value = set())
     Signals.post_update.send(sender = self.__class__, map_name = self.name, key = key, action = 'put')
+    return new_value
 
   def increment(self, key, value = 1):
     raise NotImplementedError
@@ -79,12 +113,146 @@ class LargeCachedMapForSets(LargeCachedMap):
 
 class LargePersistentMapForSets(LargePersistentMap):
   """Persistent later of LPCMForSets. Pre and post processing enables empty sets"""
+  EMPTY_SET = "__empty_set__" # cannot send empty set to dynamodb
+
   def _preprocess_value_before_ddb_save(self, value):
     if not value:
-      value = "__empty_set__"  # cannot send empty set to dynamodb
+      value = self.EMPTY_SET
     return value
 
   def _postprocess_value_after_ddb_load(self, value):
-    if value == "__empty_set__":
+    value = super(LargePersistentMapForSets, self)._postprocess_value_after_ddb_load(value)
+    if value == self.EMPTY_SET:
       value = set()
     return value
+
+  def atomic_add_value(self, key, values):
+    """ The empty set marker is a string, which dynamodb cannot add values to. It is replaced
+    with the values instead, unless another update replaced it first """
+    try:
+      return super(LargePersistentMapForSets, self).atomic_add_value(key, values)
+    except DynamoDBValidationError:
+      pass
+    try:
+      self.storage.put_item(LPCMKey.get(self.name, key), values,
+        expected_value = {'value': self.EMPTY_SET})
+      return set(values)
+    except DynamoDBConditionalCheckFailedError:
+      return super(LargePersistentMapForSets, self).atomic_add_value(key, values)
+
+  def atomic_delete_values(self, key, values):
+    "There is nothing to delete from the empty set marker"
+    try:
+      return super(LargePersistentMapForSets, self).atomic_delete_values(key, values)
+    except DynamoDBValidationError:
+      return set()
+
+
+class LargeShardedMapForSets(object):
+  """ A map of key:set for sets too large for one item: the members of each set are spread
+    over num_shards sub-sets, by a hash of the member. The shards are saved in an LPCMSet with
+    the same name, and their sizes in an LPCM named "<name>__sizes".
+    m = LargeShardedMapForSets("followers", num_shards = 64)
+    m.insert_values(user_id, [follower_id])
+    m.contains(user_id, follower_id) # reads one shard
+    for follower_id in m.iter_members(user_id):
+      ...
+    print m.cardinality(user_id)
+    num_shards cannot change once the map has data: the members would be looked up in the
+    wrong shards.
+  """
+
+  def __init__(self, name, num_shards = 16, **kwargs):
+    "kwargs are passed to the LPCMSet and LPCM shortcuts, e.g. cache_only or cache_timeout"
+    from shortcuts import LPCM, LPCMSet
+    self.name = name
+    self.num_shards = num_shards
+    self.shards = LPCMSet(name, **kwargs)
+    self.sizes = LPCM(u"{name}__sizes".format(name = name), **kwargs)
+
+  def shard_of(self, member):
+    "The shard of a member, the same in every process"
+    if isinstance(member, unicode):
+      member = member.encode('utf-8')
+    elif not isinstance(member, str):
+      member = repr(member)
+    return (zlib.crc32(member) & 0xffffffff) % self.num_shards
+
+  def _shard_key(self, key, shard):
+    """ The key of a shard in the LPCMSet. str and unicode keys are the same key, like in the
+    other maps, and other keys are used as their repr, like LPCMKey does """
+    if isinstance(key, str):
+      key = key.decode('utf-8')
+    elif not isinstance(key, unicode):
+      key = repr(key)
+    return u"{key}#{shard}".format(key = key, shard = shard)
+
+  def _group_by_shard(self, values):
+    shards = {}
+    for value in values:
+      shards.setdefault(self.shard_of(value), set()).add(value)
+    return shards
+
+  def contains(self, key, member):
+    return member in self.shards[self._shard_key(key, self.shard_of(member))]
+
+  def __getitem__(self, key):
+    "Returns the whole set. Prefer iter_members for large sets"
+    return set().union(*self.get_shards(key, range(self.num_shards)).values())
+
+  def get_shards(self, key, shards):
+    "Returns a dict of shard:set for the given shards of a key, read with a single get_many"
+    shard_keys = dict((self._shard_key(key, shard), shard) for shard in shards)
+    found = self.shards.get_many(shard_keys.keys())
+    return dict((shard, found[shard_key]) for shard_key, shard in shard_keys.iteritems())
+
+  def get_page(self, key, cursor = 0, shards_per_page = 1):
+    """ Returns (members, next_cursor): the members of shards_per_page shards, starting from
+    the cursor shard. next_cursor is None after the last page """
+    shards = range(cursor, min(cursor + shards_per_page, self.num_shards))
+    members = set().union(*self.get_shards(key, shards).values())
+    next_cursor = cursor + len(shards)
+    return members, (next_cursor if next_cursor < self.num_shards else None)
+
+  def iter_members(self, key, shards_per_page = 1):
+    "Iterates over the members of a set, reading shards_per_page shards at a time"
+    cursor = 0
+    while cursor is not None:
+      members, cursor = self.get_page(key, cursor, shards_per_page)
+      for member in members:
+        yield member
+
+  def cardinality(self, key):
+    """ Returns the number of members, from the sizes of the shards saved by the updates.
+    Concurrent updates of the same shard may leave its size slightly off, until the next one """
+    sizes = self.sizes.get_many([self._shard_key(key, shard) for shard in xrange(self.num_shards)])
+    return sum(sizes.itervalues())
+
+  def __setitem__(self, key, values):
+    "Replaces the whole set"
+    shards = self._group_by_shard(values)
+    self.shards.set_many(dict((self._shard_key(key, shard), shards.get(shard, set()))
+      for shard in xrange(self.num_shards)))
+    self.sizes.set_many(dict((self._shard_key(key, shard), len(shards.get(shard, ())))
+      for shard in xrange(self.num_shards)))
+
+  def insert_values(self, key, values):
+    "Adds values with one update per shard they fall in"
+    self._update_shards(key, values, self.shards.insert_values)
+
+  def remove_values(self, key, values):
+    "Removes values with one update per shard they fall in"
+    self._update_shards(key, values, self.shards.remove_values)
+
+  def _update_shards(self, key, values, update):
+    sizes = {}
+    for shard, shard_values in self._group_by_shard(values).iteritems():
+      shard_key = self._shard_key(key, shard)
+      sizes[shard_key] = len(update(shard_key, shard_values))
+    if sizes:
+      self.sizes.set_many(sizes)
+
+  def delete(self, key):
+    shard_keys = [self._shard_key(key, shard) for shard in xrange(self.num_shards)]
+    self.shards.delete_many(shard_keys)
+    self.sizes.delete_many(shard_keys)
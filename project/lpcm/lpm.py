@@ -1,11 +1,12 @@
 # Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
 # Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
-import base64
 from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
-from dynamodb import DynamoDB
+from boto.dynamodb.types import Binary
+from codec import Codec
 from key import LPCMKey
+from storage import get_storage
 
-
+MISSING = object() # default for arguments that may legitimately be None
 
 class LargePersistentMap(object):
   """ The DynamoDB layer of the LPCM. Most people probably don't need to use this.
@@ -19,20 +20,29 @@ class LargePersistentMap(object):
     print m2["key1"]
   """
 
-  def __init__(self, name):
+  def __init__(self, name, codec = None, key_encoding = None):
+    """ With a codec, values other than numbers are saved as encoded (and, if large, compressed)
+    binary attributes. See codec.Codec
+    key_encoding sets how the map's keys are encoded in dynamodb, see LPCMKey.ENCODINGS.
+    It cannot be changed once the map has data. Set it in LPCM_KEY_ENCODINGS rather than here,
+    so that the processes that never construct the map (lpcm_cleanup, invalidation) use it too.
+    The methods also accept LPCMKey objects as keys, so that callers can build them once.
+    The items are saved in the storage backend set by LPCM_STORAGE_BACKEND, DynamoDB by default """
     self.name = name
+    self.codec = codec
+    self.storage = get_storage()
+    if key_encoding is not None:
+      LPCMKey.set_map_encoding(name, key_encoding)
 
   def __setitem__(self, key, value):
-    cmp_key = LPCMKey(self.name, key)
+    cmp_key = LPCMKey.get(self.name, key)
     value = self._preprocess_value_before_ddb_save(value)
-    item = DynamoDB.create_item(cmp_key)
-    item['value'] = value
-    item.put()
+    self.storage.put_item(cmp_key, value)
 
   def __getitem__(self, key):
-    cmp_key = LPCMKey(self.name, key)
+    cmp_key = LPCMKey.get(self.name, key)
     try:
-      item = DynamoDB.get_item(cmp_key)
+      item = self.storage.get_item(cmp_key)
     except DynamoDBKeyNotFoundError:
       raise KeyError(u"{name}:{key}".format(name = self.name, key = cmp_key.original_key_obj))
     value = item['value']
@@ -46,47 +56,62 @@ class LargePersistentMap(object):
       return False
     return True
 
+  def get_many(self, keys):
+    """ Returns a dict of key:value for the given keys that exist in the map.
+    Keys are read from dynamodb in batches, rather than one request per key """
+    keys_by_range_key = {}
+    cmp_keys = []
+    for key in keys:
+      cmp_key = LPCMKey.get(self.name, key)
+      keys_by_range_key.setdefault(cmp_key.range_key, []).append(key)
+      cmp_keys.append(cmp_key)
+    result = {}
+    for item in self.storage.batch_get_items(cmp_keys):
+      if 'value' not in item:
+        continue
+      value = self._postprocess_value_after_ddb_load(item['value'])
+      for key in keys_by_range_key[item['key']]:
+        result[key] = value
+    return result
 
   def delete(self, key):
     "Deletes a key-value map from dynamodb. Ignores it if item does not exist"
-    cmp_key = LPCMKey(self.name, key)
-    try:
-      item = DynamoDB.get_item(cmp_key)
-    except DynamoDBKeyNotFoundError:
-      return  # delete fails silently
-    item.delete()
+    cmp_key = LPCMKey.get(self.name, key)
+    self.storage.delete_item(cmp_key)
+
+  def set_many(self, mapping):
+    "Saves all the key:value pairs of the given dict, using batched dynamodb writes"
+    puts = [(LPCMKey.get(self.name, key), self._preprocess_value_before_ddb_save(value))
+      for key, value in mapping.iteritems()]
+    self.storage.batch_write(puts = puts)
+
+  def delete_many(self, keys):
+    "Deletes the given keys using batched dynamodb writes. Ignores keys that do not exist"
+    self.storage.batch_write(deletes = [LPCMKey.get(self.name, key) for key in keys])
 
   def atomic_add_value(self, key, value):
-    cmp_key = LPCMKey(self.name, key)
-    try:
-      item = DynamoDB.get_item(cmp_key)
-    except DynamoDBKeyNotFoundError:
-      item = DynamoDB.create_item(cmp_key)
-    item.add_attribute('value', value)
-    item.save()
+    """ Adds value to a number (or a set) in a single round trip, and returns the new value.
+    Non-existent keys start from 0 (or an empty set) """
+    cmp_key = LPCMKey.get(self.name, key)
+    response = self.storage.add_to_item(cmp_key, value, return_values = 'UPDATED_NEW')
+    return self._postprocess_value_after_ddb_load(response['Attributes']['value'])
 
   def atomic_delete_values(self, key, values):
-    """Deletes a set of values from an item. Fails silently if item does not exist"""
-    cmp_key = LPCMKey(self.name, key)
-    try:
-      item = DynamoDB.get_item(cmp_key)
-    except DynamoDBKeyNotFoundError:
-      return # Nothing to do
-    item.delete_attribute('value', values)
-    item.save()
-
+    """ Deletes a set of values from an item in a single round trip, and returns the remaining
+    values. Returns None if the item does not exist """
+    cmp_key = LPCMKey.get(self.name, key)
+    response = self.storage.delete_from_item(cmp_key, values, return_values = 'UPDATED_NEW')
+    if response is None:
+      return None
+    return self._postprocess_value_after_ddb_load(response.get('Attributes', {}).get('value', set()))
 
   def __iter__(self):
     "Note: this method is EXPENSIVE! PLease only use if absolutely needed"
-    cmp_key = LPCMKey(self.name, 'dummy_key')
-    result = DynamoDB.query(cmp_key, attributes_to_get = ['table', 'key'])
-    for item in result:
-      key = item['key']
-      yield base64.b32decode(key).decode('utf-8')
+    return self.iterkeys()
 
-  def items(self):
+  def items(self, segments = 1, request_limit = None, consistent_read = False):
     """ D.items() -> list of D's (key, value) pairs, as 2-tuples """
-    pass
+    return list(self.iteritems(segments, request_limit, consistent_read))
 
   def get(self, k, d = None):
     """ D.get(k[,d]) -> D[k] if k in D, else d.  d defaults to None. """
@@ -95,37 +120,72 @@ class LargePersistentMap(object):
     except KeyError:
       return d
 
-  def iteritems(self): # real signature unknown; restored from __doc__
-    """ D.iteritems() -> an iterator over the (key, value) items of D """
-    pass
-
-  def iterkeys(self): # real signature unknown; restored from __doc__
+  def iteritems(self, segments = 1, request_limit = None, consistent_read = False):
+    """ D.iteritems() -> an iterator over the (key, value) items of D
+    Items are read lazily, request_limit items per query page, and values come in the same
+    pages as their keys. When segments > 1, the keys are split in that many ranges, which
+    are queried in parallel (and yielded in no particular order) """
+    for item in self._query(None, segments, request_limit, consistent_read):
+      if 'value' in item:
+        value = self._postprocess_value_after_ddb_load(item['value'])
+        yield LPCMKey.decode_range_key(item['key'], self.key_encoding), value
+
+  def iterkeys(self, segments = 1, request_limit = None, consistent_read = False):
     """ D.iterkeys() -> an iterator over the keys of D """
-    pass
+    for item in self._query(['table', 'key'], segments, request_limit, consistent_read):
+      yield LPCMKey.decode_range_key(item['key'], self.key_encoding)
 
-  def itervalues(self): # real signature unknown; restored from __doc__
+  def itervalues(self, segments = 1, request_limit = None, consistent_read = False):
     """ D.itervalues() -> an iterator over the values of D """
-    pass
-
-  def keys(self): # real signature unknown; restored from __doc__
+    for key, value in self.iteritems(segments, request_limit, consistent_read):
+      yield value
+
+  def _query(self, attributes_to_get, segments, request_limit, consistent_read):
+    cmp_key = LPCMKey.get(self.name, 'dummy_key')
+    if segments > 1:
+      return self.storage.parallel_query(cmp_key,
+        LPCMKey.range_key_segments(segments, self.key_encoding),
+        attributes_to_get = attributes_to_get, request_limit = request_limit,
+        consistent_read = consistent_read)
+    return self.storage.query(cmp_key, attributes_to_get = attributes_to_get,
+      request_limit = request_limit, consistent_read = consistent_read)
+
+  def keys(self, segments = 1, request_limit = None, consistent_read = False):
     """ D.keys() -> list of D's keys """
-    return []
+    return list(self.iterkeys(segments, request_limit, consistent_read))
 
-  def pop(self, k, d=None): # real signature unknown; restored from __doc__
+  def pop(self, k, d = MISSING):
     """
     D.pop(k[,d]) -> v, remove specified key and return the corresponding value.
     If key is not found, d is returned if given, otherwise KeyError is raised
+    The value is returned by the delete request itself, so this is a single round trip.
     """
-    pass
+    cmp_key = LPCMKey.get(self.name, k)
+    response = self.storage.delete_item(cmp_key, return_values = 'ALL_OLD')
+    attributes = response.get('Attributes', {})
+    if 'value' in attributes:
+      return self._postprocess_value_after_ddb_load(attributes['value'])
+    if d is MISSING:
+      raise KeyError(u"{name}:{key}".format(name = self.name, key = cmp_key.original_key_obj))
+    return d
 
-  def values(self): # real signature unknown; restored from __doc__
+  def values(self, segments = 1, request_limit = None, consistent_read = False):
     """ D.values() -> list of D's values """
-    return []
+    return list(self.itervalues(segments, request_limit, consistent_read))
+
+  @property
+  def key_encoding(self):
+    return LPCMKey.map_encoding(self.name)
 
   def _preprocess_value_before_ddb_save(self, value):
+    if self.codec is not None and self.codec.should_encode(value):
+      return Binary(self.codec.encode(value))
     return value
 
   def _postprocess_value_after_ddb_load(self, value):
+    "Values written with any codec are decoded, even if this map has none"
+    if isinstance(value, Binary) and Codec.is_encoded(value.value):
+      return Codec.decode(value.value)
     return value
 
   def clear(self):
@@ -148,9 +208,23 @@ class MockLPM(object):
   def __contains__(self, key):
     return False
 
+  def get_many(self, keys):
+    return {}
+
   def delete(self, key):
     pass
 
+  def pop(self, key, d = MISSING):
+    if d is MISSING:
+      raise KeyError()
+    return d
+
+  def set_many(self, mapping):
+    pass
+
+  def delete_many(self, keys):
+    pass
+
   def increment(self, key, value = 1):
     pass
 
@@ -13,15 +13,15 @@ class Command(BaseCommand):
   def handle(self, *args, **options):
     num_created = 0
     table_name = config.LPCM_DYNAMODB_TABLE_NAME
-    conn = DynamoDB.get_connection()
-    tables = conn.list_tables()
+    with DynamoDB.connection() as conn:
+      tables = conn.list_tables()
     if table_name in tables:
       logging.warning("LPCM table already exists and will not be recreated.")
       return
     table = DynamoDB.create_table(table_name,
-      hash_key_name = 'table',
+      hash_key_name = DynamoDB.Constants.HASH_KEY_NAME,
       hash_key_proto_value = 'S',
-      range_key_name = 'key',
+      range_key_name = DynamoDB.Constants.RANGE_KEY_NAME,
       range_key_proto_value = 'S',
       read_units = config.LPCM_PROVISIONED_THROUGHPUT['read_units'],
       write_units = config.LPCM_PROVISIONED_THROUGHPUT['write_units'],
@@ -0,0 +1,20 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.importlib import import_module
+
+class Command(BaseCommand):
+  help = """ Runs one of the benchmarks in lpcm/benchmarks and prints its report"""
+  args = "<benchmark_name>"
+
+  def handle(self, *args, **options):
+    if len(args) != 1:
+      raise CommandError("Usage: lpcm_benchmark {}".format(self.args))
+    package = __name__.rsplit('.', 3)[0] + '.benchmarks'
+    try:
+      benchmark = import_module("{}.{}".format(package, args[0]))
+    except ImportError:
+      raise CommandError("Unknown benchmark: {}".format(args[0]))
+    for line in benchmark.run():
+      self.stdout.write(line + "\n")
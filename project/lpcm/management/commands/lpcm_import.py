@@ -0,0 +1,40 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import logging
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from ...transfer import MapImporter
+from ... import config
+
+class Command(BaseCommand):
+  help = """ Imports a file written by lpcm_export into an LPCM map.
+    Interrupted imports can be resumed with --resume"""
+  args = "<map_name> <path>"
+  option_list = BaseCommand.option_list + (
+    make_option('--compression', choices = ['gzip', 'zstd'], default = None,
+      help = "The file is compressed with gzip or zstd"),
+    make_option('--throughput', type = 'float', default = 0.5,
+      help = "Fraction of the table's provisioned write units to use. Defaults to 0.5"),
+    make_option('--page-size', type = 'int', default = 100, dest = 'page_size',
+      help = "Number of keys per checkpoint"),
+    make_option('--key-encoding', choices = ['base32', 'hex'], default = None, dest = 'key_encoding',
+      help = "The key encoding the map was created with. Defaults to LPCM_KEY_ENCODINGS, or base32"),
+    make_option('--resume', action = 'store_true', default = False,
+      help = "Skip the keys imported before the last checkpoint of an interrupted import"),
+    )
+
+  def handle(self, *args, **options):
+    if len(args) != 2:
+      raise CommandError("Usage: lpcm_import {}".format(self.args))
+    map_name, path = args
+    importer = MapImporter(map_name, path,
+      compression = options['compression'],
+      units_per_second = options['throughput'] * config.LPCM_PROVISIONED_THROUGHPUT['write_units'],
+      page_size = options['page_size'],
+      key_encoding = options['key_encoding'])
+    try:
+      count = importer.run(resume = options['resume'])
+    except ValueError as e:
+      raise CommandError(str(e))
+    logging.info("Imported {} keys from {} into {}.".format(count, path, map_name))
@@ -4,5 +4,16 @@
 from  django import dispatch
 
 class Signals(object):
-  pre_update = dispatch.Signal(providing_args=["map_name", "key", "action"])
-  post_update = dispatch.Signal(providing_args=["map_name", "key", "action"])
+  """ Sent before and after every update to a map. Single key updates send the updated key
+  as `key`. Batched updates (set_many, delete_many) send one signal per batch, with the list
+  of updated keys as `keys`, and `key` set to None. Receivers should read the keys with
+  updated_keys(), which handles both """
+  pre_update = dispatch.Signal(providing_args=["map_name", "key", "keys", "action"])
+  post_update = dispatch.Signal(providing_args=["map_name", "key", "keys", "action"])
+
+  @staticmethod
+  def updated_keys(signal_kwargs):
+    "Returns the list of updated keys, for both single key and batched updates"
+    if signal_kwargs.get('keys') is not None:
+      return signal_kwargs['keys']
+    return [signal_kwargs['key']]
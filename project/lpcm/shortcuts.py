@@ -2,21 +2,33 @@ from django.conf import settings
 import config
 from thread_local import is_in_test
 
-def LPCM(name, cache_only = False, cache_timeout = None):
+def LPCM(name, cache_only = False, cache_timeout = None, negative_cache_timeout = None,
+    local_cache = False, codec = None, buffered_counters = False, key_encoding = None):
+  """ negative_cache_timeout and buffered_counters only apply to persistent maps.
+  Cache-only maps have nothing to save """
   if cache_only or force_cache_only():
     from lcm import LargeCachedMap
-    return LargeCachedMap(name, cache_timeout)
+    return LargeCachedMap(name, cache_timeout, local_cache, codec, key_encoding)
   else:
     from lpcm import LargePersistentCachedMap
-    return LargePersistentCachedMap(name, cache_timeout)
+    return LargePersistentCachedMap(name, cache_timeout, negative_cache_timeout, local_cache, codec,
+      buffered_counters, key_encoding)
 
-def LPCMSet(name, cache_only = False, cache_timeout = None):
+def LPCMSet(name, cache_only = False, cache_timeout = None, negative_cache_timeout = None,
+    local_cache = False, codec = None, key_encoding = None):
   if cache_only or force_cache_only():
     from lpcm_set import LargeCachedMapForSets
-    return LargeCachedMapForSets(name, cache_timeout)
+    return LargeCachedMapForSets(name, cache_timeout, local_cache, codec, key_encoding)
   else:
     from lpcm_set import LargePersistentCachedMapForSets
-    return LargePersistentCachedMapForSets(name, cache_timeout)
+    return LargePersistentCachedMapForSets(name, cache_timeout, negative_cache_timeout,
+      local_cache, codec, key_encoding = key_encoding)
+
+def ShardedLPCMSet(name, num_shards = 16, **kwargs):
+  """ An LPCMSet for sets too large for one item, see LargeShardedMapForSets.
+  kwargs are the arguments of LPCMSet """
+  from lpcm_set import LargeShardedMapForSets
+  return LargeShardedMapForSets(name, num_shards, **kwargs)
 
 def force_cache_only():
   if is_in_test():
@@ -0,0 +1,62 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import copy
+import sys
+import threading
+
+class SingleFlight(object):
+  """ Makes concurrent calls for the same key share one call, within a process.
+    The first thread to call do(key, func) runs func, and the threads that come while it runs
+    wait for it and get the same result, or the same exception. The waiters get shallow copies of
+    the result, so that a caller changing its set or dict does not change the others'.
+    reads = SingleFlight()
+    value = reads.do(cmp_key.cache_key, lambda: lpm[cmp_key])
+    print reads.stats()
+  """
+  class Call(object):
+    def __init__(self):
+      self.done = threading.Event()
+      self.value = None
+      self.exc_info = None
+
+  def __init__(self):
+    self._calls = {} # key: Call in flight
+    self._lock = threading.Lock()
+    self.calls = 0
+    self.shared = 0
+
+  def do(self, key, func):
+    with self._lock:
+      call = self._calls.get(key)
+      if call is None:
+        call = self._calls[key] = self.Call()
+        owner = True
+        self.calls += 1
+      else:
+        owner = False
+        self.shared += 1
+    if owner:
+      try:
+        call.value = func()
+      except:
+        call.exc_info = sys.exc_info()
+      finally:
+        with self._lock:
+          del self._calls[key]
+        call.done.set()
+    else:
+      call.done.wait()
+    if call.exc_info is not None:
+      raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+    if owner:
+      return call.value
+    return copy.copy(call.value)
+
+  def stats(self):
+    with self._lock:
+      return {
+        'in_flight': len(self._calls),
+        'calls': self.calls,
+        'shared': self.shared,
+        }
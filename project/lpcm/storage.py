@@ -0,0 +1,381 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import cPickle as pickle
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from django.utils.importlib import import_module
+from boto.dynamodb.condition import BEGINS_WITH, BETWEEN, EQ, GE, GT, LE, LT
+from boto.dynamodb.exceptions import DynamoDBConditionalCheckFailedError, DynamoDBKeyNotFoundError
+from boto.dynamodb.exceptions import DynamoDBResponseError, DynamoDBValidationError
+from dynamodb import DynamoDB
+import config
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+  """ Returns the process-wide storage backend of the persistent maps: DynamoDB, unless
+  LPCM_STORAGE_BACKEND is set (e.g. to 'project.lpcm.storage.MemoryStorage') """
+  global _storage
+  if _storage is None:
+    with _storage_lock:
+      if _storage is None:
+        if config.LPCM_STORAGE_BACKEND:
+          module_name, class_name = config.LPCM_STORAGE_BACKEND.rsplit('.', 1)
+          kls = getattr(import_module(module_name), class_name)
+          _storage = kls(**config.LPCM_STORAGE_OPTIONS)
+        else:
+          _storage = DynamoDB
+  return _storage
+
+
+class LocalStorage(object):
+  """ Stand-in for DynamoDB, with the same methods and the same semantics: the same responses,
+    the same errors (conditional checks, validation of sets and numbers), range keys queried in
+    order. Subclasses only store the items, see MemoryStorage and SqliteStorage.
+    Each request can be delayed by latency seconds (a number, or a (min, max) range), and is
+    throttled with the probability throttle_rate. Like boto, throttled requests are retried with
+    an exponential backoff, and fail with ProvisionedThroughputExceededException after
+    THROTTLE_MAX_RETRIES. stats() counts the requests and throttles.
+  """
+  class Constants(object):
+    THROTTLE_MAX_RETRIES = 10
+    THROTTLE_BACKOFF = 0.05 # seconds, doubled on every retry
+    ERROR_TYPE = "com.amazonaws.dynamodb.v20111205#{}"
+
+  def __init__(self, latency = 0, throttle_rate = 0):
+    self.latency = latency
+    self.throttle_rate = throttle_rate
+    self.requests = 0
+    self.throttled = 0
+    self._lock = threading.RLock() # guards the counters, and the items of MemoryStorage
+
+  def get_item(self, cmp_key):
+    "Tries to get an item. Throws DynamoDBKeyNotFoundError"
+    self._request()
+    with self._transaction() as txn:
+      item = self._get(txn, cmp_key.hash_key, cmp_key.range_key)
+    if item is None:
+      raise DynamoDBKeyNotFoundError("Key does not exist.")
+    return item
+
+  def batch_get_items(self, cmp_keys):
+    "Keys that do not exist are simply missing from the returned list of items"
+    keys = set((k.hash_key, k.range_key) for k in cmp_keys)
+    for i in xrange(0, len(keys), DynamoDB.Constants.BATCH_GET_SIZE):
+      self._request()
+    with self._transaction() as txn:
+      items = [self._get(txn, hash_key, range_key) for hash_key, range_key in keys]
+    return [item for item in items if item is not None]
+
+  def put_item(self, cmp_key, value, expected_value = None):
+    self._request()
+    self._validate(value)
+    with self._transaction(write = True) as txn:
+      self._check_expected(self._get(txn, cmp_key.hash_key, cmp_key.range_key), expected_value)
+      self._put(txn, self._new_item(cmp_key, value))
+    return {}
+
+  def add_to_item(self, cmp_key, value, return_values = None):
+    self._request()
+    self._validate(value)
+    with self._transaction(write = True) as txn:
+      item = self._get(txn, cmp_key.hash_key, cmp_key.range_key) or self._new_item(cmp_key)
+      current = item.get('value')
+      if current is None:
+        item['value'] = value
+      elif isinstance(value, (set, frozenset)) and isinstance(current, (set, frozenset)):
+        item['value'] = current | value
+      elif self._is_number(value) and self._is_number(current):
+        item['value'] = current + value
+      else:
+        raise self._error(DynamoDBValidationError, 'ValidationException',
+          "Type mismatch for attribute to update")
+      self._put(txn, item)
+    return self._updated_new(item, return_values)
+
+  def delete_from_item(self, cmp_key, values, return_values = None):
+    "Returns None if the item does not exist"
+    self._request()
+    self._validate(values)
+    with self._transaction(write = True) as txn:
+      item = self._get(txn, cmp_key.hash_key, cmp_key.range_key)
+      if item is None or 'value' not in item:
+        return None
+      if not isinstance(item['value'], (set, frozenset)):
+        raise self._error(DynamoDBValidationError, 'ValidationException',
+          "Type mismatch for attribute to update")
+      item['value'] = item['value'] - values
+      if not item['value']:
+        del item['value'] # like dynamodb, empty sets are removed
+      self._put(txn, item)
+    return self._updated_new(item, return_values)
+
+  def delete_item(self, cmp_key, return_values = None):
+    self._request()
+    with self._transaction(write = True) as txn:
+      item = self._get(txn, cmp_key.hash_key, cmp_key.range_key)
+      if item is not None:
+        self._delete(txn, cmp_key.hash_key, cmp_key.range_key)
+    if return_values == 'ALL_OLD' and item is not None:
+      return {'Attributes': item}
+    return {}
+
+  def batch_write(self, puts = (), deletes = ()):
+    puts, deletes = list(puts), list(deletes)
+    for value in (value for cmp_key, value in puts):
+      self._validate(value)
+    for i in xrange(0, len(puts) + len(deletes), DynamoDB.Constants.BATCH_WRITE_SIZE):
+      self._request()
+    with self._transaction(write = True) as txn:
+      for cmp_key, value in puts:
+        self._put(txn, self._new_item(cmp_key, value))
+      for cmp_key in deletes:
+        self._delete(txn, cmp_key.hash_key, cmp_key.range_key)
+
+  def query(self, cmp_key, attributes_to_get = None, request_limit = None,
+            max_results = None, consistent_read = False, range_key_condition = None):
+    "Yields the items of a query, reading request_limit items per request"
+    start = None
+    if isinstance(range_key_condition, (EQ, GE, GT, BETWEEN, BEGINS_WITH)):
+      start = range_key_condition.v1
+    num_results = 0
+    while True:
+      self._request()
+      with self._transaction() as txn:
+        page = self._range(txn, cmp_key.hash_key, start, request_limit)
+      for item in page:
+        if range_key_condition is not None and not self._matches(item['key'], range_key_condition):
+          if self._past_end(item['key'], range_key_condition):
+            return # the items are in order, so none of the next ones match either
+          continue
+        if max_results is not None and num_results >= max_results:
+          return
+        num_results += 1
+        if attributes_to_get is not None:
+          item = dict((name, item[name]) for name in attributes_to_get if name in item)
+        yield item
+      if not request_limit or len(page) < request_limit:
+        return
+      start = page[-1]['key'] + '\x00' # the first key after the last one
+
+  def parallel_query(self, cmp_key, range_key_segments, attributes_to_get = None,
+                     request_limit = None, consistent_read = False):
+    "The segments are queried one after the other"
+    for start, end in range_key_segments:
+      condition = GE(start) if end is None else BETWEEN(start, end)
+      for item in self.query(cmp_key, attributes_to_get = attributes_to_get,
+          request_limit = request_limit, consistent_read = consistent_read,
+          range_key_condition = condition):
+        yield item
+
+  def stats(self):
+    with self._lock:
+      return {
+        'requests': self.requests,
+        'throttled': self.throttled,
+        }
+
+  def _request(self):
+    "Simulates the latency and the throttling of a request"
+    with self._lock:
+      self.requests += 1
+    for retry in xrange(self.Constants.THROTTLE_MAX_RETRIES + 1):
+      if retry:
+        time.sleep(self.Constants.THROTTLE_BACKOFF * 2 ** (retry - 1))
+      if self.latency:
+        if isinstance(self.latency, (tuple, list)):
+          time.sleep(random.uniform(*self.latency))
+        else:
+          time.sleep(self.latency)
+      if not self.throttle_rate or random.random() >= self.throttle_rate:
+        return
+      with self._lock:
+        self.throttled += 1
+    raise self._error(DynamoDBResponseError, 'ProvisionedThroughputExceededException',
+      "The level of configured provisioned throughput for the table was exceeded")
+
+  def _error(self, kls, error_type, message):
+    "The errors raised by boto for dynamodb's error responses"
+    return kls(400, 'Bad Request', {
+      '__type': self.Constants.ERROR_TYPE.format(error_type),
+      'message': message})
+
+  def _validate(self, value):
+    if isinstance(value, (set, frozenset)) and not value:
+      raise self._error(DynamoDBValidationError, 'ValidationException',
+        "One or more parameter values were invalid: An string set may not be empty")
+    if value is None:
+      raise self._error(DynamoDBValidationError, 'ValidationException',
+        "Supplied AttributeValue is empty")
+
+  def _check_expected(self, item, expected_value):
+    for name, expected in (expected_value or {}).iteritems():
+      if expected is True:
+        failed = item is None or name not in item
+      elif expected is False:
+        failed = item is not None and name in item
+      else:
+        failed = item is None or item.get(name) != expected
+      if failed:
+        raise self._error(DynamoDBConditionalCheckFailedError, 'ConditionalCheckFailedException',
+          "The conditional request failed")
+
+  def _updated_new(self, item, return_values):
+    if return_values == 'UPDATED_NEW' and 'value' in item:
+      return {'Attributes': {'value': item['value']}}
+    return {}
+
+  @staticmethod
+  def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+  @staticmethod
+  def _new_item(cmp_key, value = None):
+    item = {DynamoDB.Constants.HASH_KEY_NAME: cmp_key.hash_key,
+      DynamoDB.Constants.RANGE_KEY_NAME: cmp_key.range_key}
+    if value is not None:
+      item['value'] = value
+    return item
+
+  @staticmethod
+  def _matches(range_key, condition):
+    if isinstance(condition, EQ):
+      return range_key == condition.v1
+    if isinstance(condition, LE):
+      return range_key <= condition.v1
+    if isinstance(condition, LT):
+      return range_key < condition.v1
+    if isinstance(condition, GE):
+      return range_key >= condition.v1
+    if isinstance(condition, GT):
+      return range_key > condition.v1
+    if isinstance(condition, BEGINS_WITH):
+      return range_key.startswith(condition.v1)
+    if isinstance(condition, BETWEEN):
+      return condition.v1 <= range_key <= condition.v2
+    raise ValueError("Unsupported range key condition: {}".format(condition))
+
+  @staticmethod
+  def _past_end(range_key, condition):
+    "Whether range_key, and so every later one, is after the range of condition"
+    if isinstance(condition, (EQ, LE, BEGINS_WITH)):
+      return range_key > condition.v1
+    if isinstance(condition, LT):
+      return range_key >= condition.v1
+    if isinstance(condition, BETWEEN):
+      return range_key > condition.v2
+    return False
+
+  # The storage of the items. Items are dicts of attributes, and are copied in and out
+  @contextmanager
+  def _transaction(self, write = False):
+    "Yields the txn argument of the methods below. Updates are made in write transactions"
+    raise NotImplementedError
+
+  def _get(self, txn, hash_key, range_key):
+    "Returns a copy of an item, or None"
+    raise NotImplementedError
+
+  def _put(self, txn, item):
+    raise NotImplementedError
+
+  def _delete(self, txn, hash_key, range_key):
+    raise NotImplementedError
+
+  def _range(self, txn, hash_key, start, limit):
+    "Returns (copies of) up to limit items of hash_key, from range key start on, in order"
+    raise NotImplementedError
+
+
+class MemoryStorage(LocalStorage):
+  "Keeps the items in process. Nothing is saved"
+
+  def __init__(self, latency = 0, throttle_rate = 0):
+    super(MemoryStorage, self).__init__(latency, throttle_rate)
+    self._tables = {} # hash_key: {range_key: item}
+
+  @contextmanager
+  def _transaction(self, write = False):
+    with self._lock:
+      yield None
+
+  def _get(self, txn, hash_key, range_key):
+    return self._copy(self._tables.get(hash_key, {}).get(range_key))
+
+  def _put(self, txn, item):
+    item = self._copy(item)
+    self._tables.setdefault(item[DynamoDB.Constants.HASH_KEY_NAME], {})[
+      item[DynamoDB.Constants.RANGE_KEY_NAME]] = item
+
+  def _delete(self, txn, hash_key, range_key):
+    self._tables.get(hash_key, {}).pop(range_key, None)
+
+  def _range(self, txn, hash_key, start, limit):
+    items = self._tables.get(hash_key, {})
+    range_keys = sorted(k for k in items if start is None or k >= start)
+    return [self._copy(items[k]) for k in range_keys[:limit]]
+
+  def clear(self):
+    with self._lock:
+      self._tables.clear()
+
+  @staticmethod
+  def _copy(item):
+    "So that nobody changes the stored sets"
+    if item is None:
+      return None
+    return dict((name, set(value) if isinstance(value, (set, frozenset)) else value)
+      for name, value in item.iteritems())
+
+
+class SqliteStorage(LocalStorage):
+  """ Saves the items in a sqlite file, which several processes can share. Each thread has its
+  own connection, and updates are made in immediate transactions, so they are atomic """
+
+  def __init__(self, path, latency = 0, throttle_rate = 0):
+    super(SqliteStorage, self).__init__(latency, throttle_rate)
+    self.path = path
+    self._local = threading.local()
+    with self._transaction(write = True) as txn:
+      txn.execute("CREATE TABLE IF NOT EXISTS lpcm ("
+        "hash_key TEXT, range_key TEXT, item BLOB, PRIMARY KEY (hash_key, range_key))")
+
+  def _connection(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = self._local.conn = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+    return conn
+
+  @contextmanager
+  def _transaction(self, write = False):
+    conn = self._connection()
+    conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+    try:
+      yield conn
+    except:
+      conn.execute("ROLLBACK")
+      raise
+    conn.execute("COMMIT")
+
+  def _get(self, txn, hash_key, range_key):
+    row = txn.execute("SELECT item FROM lpcm WHERE hash_key = ? AND range_key = ?",
+      (hash_key, range_key)).fetchone()
+    return None if row is None else pickle.loads(str(row[0]))
+
+  def _put(self, txn, item):
+    txn.execute("INSERT OR REPLACE INTO lpcm (hash_key, range_key, item) VALUES (?, ?, ?)",
+      (item[DynamoDB.Constants.HASH_KEY_NAME], item[DynamoDB.Constants.RANGE_KEY_NAME],
+      sqlite3.Binary(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))))
+
+  def _delete(self, txn, hash_key, range_key):
+    txn.execute("DELETE FROM lpcm WHERE hash_key = ? AND range_key = ?", (hash_key, range_key))
+
+  def _range(self, txn, hash_key, start, limit):
+    rows = txn.execute("SELECT item FROM lpcm WHERE hash_key = ? AND range_key >= ? "
+      "ORDER BY range_key LIMIT ?", (hash_key, start or '', limit or -1))
+    return [pickle.loads(str(row[0])) for row in rows]
@@ -4,4 +4,17 @@
 from lpm import TestLPM
 from lcm import TestLCM
 from lpcm import TestLPCM
-from lpcm_set import TestLPCMSet, TestLCMSet
+from lpcm_set import TestLPCMSet, TestLCMSet, TestShardedLPCMSet
+from local_cache import TestLocalCache
+from invalidation import TestInvalidation
+from transfer import TestTransfer
+from codec import TestCodec
+from counters import TestCounterBuffer
+from key import TestLPCMKey
+from connection_pool import TestConnectionPool
+from dynamodb import TestDynamoDB
+from async_lpcm import TestAsyncLPCM
+from single_flight import TestSingleFlight
+from cleanup import TestLPCMCleanUp
+from storage import TestMemoryStorage, TestSqliteStorage
+from cache_backend import TestLocalCASCache
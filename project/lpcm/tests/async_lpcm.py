@@ -0,0 +1,94 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import threading
+import unittest
+from django.core.cache import cache
+from base import LPCMTestCase
+from ..async_lpcm import AsyncLargePersistentCachedMap as AsyncLPCM
+from ..lcm import LargeCachedMap as LCM
+from ..shortcuts import LPCM
+from .. import config
+
+class TestAsyncLPCM(LPCMTestCase):
+
+  def setUp(self):
+    super(TestAsyncLPCM, self).setUp()
+    cache.clear()
+
+  def test_set_and_get(self):
+    some_map = AsyncLPCM(name = "some_map")
+    results = [some_map.set("a", 123), some_map.set("b", "some string")]
+    for result in results:
+      result.get(timeout = 10)
+    self.assertEquals(some_map.get("a").get(timeout = 10), 123)
+    self.assertEquals(some_map.get("b").get(timeout = 10), "some string")
+    self.assertEquals(some_map.get("c", 456).get(timeout = 10), 456)
+    self.assertIsNone(some_map.get("c").get(timeout = 10))
+    # the writes are made in test mode, like those of the calling thread
+    self.assertEquals(LPCM(name = "some_map")["a"], 123)
+
+  def test_get_many_and_set_many(self):
+    some_map = AsyncLPCM(name = "some_map")
+    some_map.set_many({"a": 1, "b": 2}).get(timeout = 10)
+    self.assertEquals(some_map.get_many(["a", "b", "c"]).get(timeout = 10), {"a": 1, "b": 2})
+    some_map.delete("a").get(timeout = 10)
+    self.assertEquals(some_map.get_many(["a", "b"]).get(timeout = 10), {"b": 2})
+
+  def test_increment(self):
+    some_map = AsyncLPCM(name = "some_map")
+    results = [some_map.increment("a") for i in xrange(10)]
+    for result in results:
+      result.get(timeout = 10)
+    self.assertEquals(some_map.get("a").get(timeout = 10), 10)
+    self.assertEquals(some_map.decrement("a", 3).get(timeout = 10), 7)
+
+  def test_callback(self):
+    some_map = AsyncLPCM(name = "some_map")
+    some_map.set("a", 123).get(timeout = 10)
+    called = threading.Event()
+    values = []
+    def on_value(value):
+      values.append(value)
+      called.set()
+    some_map.get("a", callback = on_value)
+    called.wait(10)
+    self.assertEquals(values, [123])
+
+  @unittest.skipIf(config.LPCM_TEST_USE_LOCAL_CACHE_ONLY, "Disable in CACHE_ONLY mode")
+  def test_coalesced_gets(self):
+    some_map = AsyncLPCM(name = "some_map")
+    some_map.set("a", 123).get(timeout = 10)
+    cache.clear()
+    lpm = some_map.map.lpm
+    release = threading.Event()
+    num_reads = []
+    class SlowLPM(object):
+      def __getitem__(self, key):
+        num_reads.append(key)
+        release.wait(10)
+        return lpm[key]
+    some_map.map.lpm = SlowLPM()
+    results = [some_map.get("a", d) for d in xrange(5)]
+    release.set()
+    self.assertEquals([result.get(timeout = 10) for result in results], [123] * 5)
+    self.assertEquals(len(num_reads), 1)
+
+  def test_cache_only(self):
+    some_map = AsyncLPCM(name = "some_map", cache_only = True)
+    self.assertIsInstance(some_map.map, LCM)
+    some_map.set("a", 123).get(timeout = 10)
+    self.assertEquals(LPCM(name = "some_map", cache_only = True)["a"], 123)
+
+  def test_iterators(self):
+    some_map = AsyncLPCM(name = "some_map")
+    mapping = dict(("key_{}".format(i), i) for i in xrange(25))
+    some_map.set_many(mapping).get(timeout = 10)
+    items = some_map.iteritems(batch_size = 10)
+    batches = [items.next_batch().get(timeout = 10) for i in xrange(4)]
+    self.assertEquals([len(batch) for batch in batches], [10, 10, 5, 0])
+    self.assertEquals(dict(sum(batches, [])), mapping)
+    keys = some_map.iterkeys(batch_size = 10)
+    self.assertEquals(len(keys.next_batch().get(timeout = 10)), 10)
+    keys.close()
+    some_map.map.delete_many(mapping.keys())
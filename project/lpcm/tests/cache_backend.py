@@ -0,0 +1,95 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import threading
+from base import LPCMTestCase
+from .. import cache as lpcm_cache
+from ..cache import Cache
+from ..cache_backend import LocalCASCache
+from ..key import LPCMKey
+from ..lcm import LargeCachedMap as LCM
+from ..lpcm_set import LargeCachedMapForSets as LCMSet
+from ..thread_local import set_in_test
+
+class TestLocalCASCache(LPCMTestCase):
+
+  def setUp(self):
+    super(TestLocalCASCache, self).setUp()
+    self.backend = LocalCASCache('lpcm', {'TIMEOUT': 60, 'OPTIONS': {'MAX_ENTRIES': 100}})
+
+  def test_backend(self):
+    self.backend.set("a", 123)
+    self.backend.set_many({"b": {1, 2}, "c": "some string"})
+    self.assertEquals(self.backend.get("a"), 123)
+    self.assertEquals(self.backend.get("bad_key", 456), 456)
+    self.assertEquals(self.backend.get_many(["a", "b", "bad_key"]), {"a": 123, "b": {1, 2}})
+    self.assertFalse(self.backend.add("a", 234))
+    self.assertTrue(self.backend.add("d", 234))
+    self.assertEquals(self.backend.incr("a", 2), 125)
+    self.assertEquals(self.backend.decr("a"), 124)
+    with self.assertRaises(ValueError):
+      self.backend.incr("bad_key")
+    self.backend.delete_many(["a", "b"])
+    self.assertFalse(self.backend.has_key("a"))
+    value, cas_id = self.backend.gets("c")
+    self.assertTrue(self.backend.cas("c", value + "!", cas_id))
+    self.assertFalse(self.backend.cas("c", value + "?", cas_id))
+    self.assertEquals(self.backend.get("c"), "some string!")
+
+  def test_atomic_updates(self):
+    "Cache-only sets and counters are atomic on this backend"
+    lpcm_cache.LPCM_CACHE, backend = self.backend, lpcm_cache.LPCM_CACHE
+    try:
+      some_set = LCMSet(name = "some_set")
+      counters = Cache(timeout = 60)
+      def update(i):
+        set_in_test()
+        for j in xrange(20):
+          some_set.insert_values("a", [(i, j)])
+          counters.incr("counter", 1, initial_value = 0)
+          counters.incr("float_counter", 0.5, initial_value = 0)
+      threads = [threading.Thread(target = update, args = (i,)) for i in xrange(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      self.assertEquals(len(some_set["a"]), 80)
+      self.assertEquals(counters.get("counter"), 80)
+      self.assertEquals(counters.get("float_counter"), 40.0)
+    finally:
+      lpcm_cache.LPCM_CACHE = backend
+
+  def test_leases(self):
+    self.assertEquals(sorted(self.backend.add_many({"a": 1, "b": 2})), ["a", "b"])
+    self.assertEquals(self.backend.add_many({"b": 3, "c": 4}), ["c"])
+    self.assertEquals(self.backend.get_and_add("a", "a_token", True), (1, False, None))
+    self.assertEquals(self.backend.get_and_add("d", "d_token", True), (None, True, None))
+    self.assertEquals(self.backend.get_and_add("d", "d_token", True), (None, False, True))
+    lpcm_cache.LPCM_CACHE, backend = self.backend, lpcm_cache.LPCM_CACHE
+    try:
+      cache = Cache(timeout = 60)
+      self.assertTrue(cache.has_batched_add())
+      self.assertEquals(cache.get_with_lease("e"), (None, Cache.Constants.LEASED))
+      self.assertEquals(cache.get_with_lease("e"), (None, True))
+      self.assertEquals(cache.get_thread_safe_tokens(["e", "f"]), ["f"])
+      cache.release_thread_safe_tokens(["e", "f"], missing_keys = ["f"])
+      self.assertEquals(cache.get_many_with_tokens(["e", "f"]),
+        {"e": (None, None), "f": (None, Cache.Constants.KEY_MISSING)})
+    finally:
+      lpcm_cache.LPCM_CACHE = backend
+
+  def test_get_many_waits_for_token_holders(self):
+    lpcm_cache.LPCM_CACHE, backend = self.backend, lpcm_cache.LPCM_CACHE
+    try:
+      some_map = LCM(name = "some_map")
+      some_map["b"] = 456
+      cache_key = LPCMKey("some_map", "a").cache_key
+      self.assertTrue(some_map.cache.get_thread_safe_token(cache_key))
+      # pretend another thread holds the token and saves the value a little later
+      threading.Timer(0.05, lambda: self.backend.set(cache_key, 123)).start()
+      self.assertEquals(some_map.get_many(["a", "b", "c"]), {"a": 123, "b": 456})
+      # the token of the missing key is kept as a notice
+      self.assertEquals(some_map.cache.get_with_lease(LPCMKey("some_map", "c").cache_key),
+        (None, Cache.Constants.KEY_MISSING))
+    finally:
+      lpcm_cache.LPCM_CACHE = backend
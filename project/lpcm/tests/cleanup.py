@@ -0,0 +1,51 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import threading
+from django.core.cache import cache
+from base import LPCMTestCase
+from ..cleanup import LPCMCleanUp, MapRecord
+from ..lcm import LargeCachedMap as LCM
+from ..thread_local import set_in_test
+
+class TestLPCMCleanUp(LPCMTestCase):
+
+  def setUp(self):
+    super(TestLPCMCleanUp, self).setUp()
+    cache.clear()
+
+  def test_updated_keys(self):
+    some_map = LCM(name = "some_map")
+    some_map["a"] = 1
+    some_map.set_many({"b": 2, "c": 3})
+    some_map.delete("c")
+    some_map.delete("d")
+    def update():
+      set_in_test()
+      some_map.increment("e")
+    thread = threading.Thread(target = update)
+    thread.start()
+    thread.join()
+    self.assertEquals(LPCMCleanUp._updated_maps,
+      {MapRecord(map_name = "some_map", map_class = LCM): {"a", "b", "c", "e"}})
+
+  def test_full_clean_up(self):
+    some_map = LCM(name = "some_map")
+    another_map = LCM(name = "another_map")
+    some_map.set_many({"a": 1, "b": 2})
+    another_map["c"] = 3
+    LPCMCleanUp.full_clean_up(num_threads = 2)
+    self.assertEquals(some_map.keys(), [])
+    self.assertEquals(another_map.keys(), [])
+    self.assertIsNone(some_map.get("a"))
+    self.assertEquals(LPCMCleanUp._updated_maps, {})
+
+  def test_unknown_keys(self):
+    some_map = LCM(name = "some_map")
+    some_map["a"] = 1
+    LPCMCleanUp.add_map_record(map_class = LCM, map_name = "some_map")
+    some_map["b"] = 2
+    self.assertEquals(LPCMCleanUp._updated_maps,
+      {MapRecord(map_name = "some_map", map_class = LCM): None})
+    LPCMCleanUp.full_clean_up()
+    self.assertEquals(some_map.keys(), [])
@@ -0,0 +1,45 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import unittest
+from base import LPCMTestCase
+from ..codec import Codec, msgpack
+
+class TestCodec(LPCMTestCase):
+  VALUES = ["some string", 'Ivan Krsti\xc4\x87'.decode('utf8'), "a" * 5000, {1, 2, 3}, {"a", "b"}, [1, "b"], {"a": 1}]
+
+  def _assert_round_trip(self, codec):
+    for value in self.VALUES:
+      self.assertEquals(Codec.decode(codec.encode(value)), value)
+
+  def test_pickle(self):
+    self._assert_round_trip(Codec('pickle'))
+    self._assert_round_trip(Codec('pickle', compression = None))
+
+  def test_marshal(self):
+    self._assert_round_trip(Codec('marshal'))
+
+  @unittest.skipIf(msgpack is None, "msgpack is not installed")
+  def test_msgpack(self):
+    self._assert_round_trip(Codec('msgpack'))
+
+  def test_compression_threshold(self):
+    codec = Codec('pickle', compression = 'zlib', compress_threshold = 1000)
+    self.assertLess(len(codec.encode("a" * 5000)), 1000)
+    self.assertIn("a" * 10, codec.encode("a" * 10))
+
+  def test_legacy_values(self):
+    for value in ["some string", 123, 4.5, {1, 2}, None]:
+      self.assertEquals(Codec.decode(value), value)
+
+  def test_unknown_version(self):
+    data = Codec().encode("some string")
+    data = Codec.MAGIC + chr(Codec.VERSION + 1) + data[len(Codec.MAGIC) + 1:]
+    with self.assertRaises(Codec.UnknownFormat):
+      Codec.decode(data)
+
+  def test_bad_options(self):
+    with self.assertRaises(ValueError):
+      Codec('json')
+    with self.assertRaises(ValueError):
+      Codec('pickle', compression = 'bzip2')
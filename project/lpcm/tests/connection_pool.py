@@ -0,0 +1,43 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import threading
+from base import LPCMTestCase
+from ..connection_pool import ConnectionPool
+
+class TestConnectionPool(LPCMTestCase):
+
+  def test_reuse(self):
+    pool = ConnectionPool(connect = object, max_size = 2, timeout = 1)
+    with pool.connection() as conn:
+      pass
+    with pool.connection() as same_conn:
+      self.assertIs(same_conn, conn)
+      with pool.connection() as another_conn:
+        self.assertIsNot(another_conn, conn)
+    self.assertEquals(pool.stats()['size'], 2)
+    self.assertEquals(pool.stats()['idle'], 2)
+    self.assertEquals(pool.stats()['acquired'], 3)
+
+  def test_timeout(self):
+    pool = ConnectionPool(connect = object, max_size = 1, timeout = 0.05)
+    with pool.connection():
+      with self.assertRaises(ConnectionPool.Timeout):
+        pool.acquire()
+    self.assertEquals(pool.stats()['timeouts'], 1)
+    self.assertEquals(pool.stats()['in_use'], 0)
+
+  def test_wait_for_release(self):
+    pool = ConnectionPool(connect = object, max_size = 1, timeout = 5)
+    conn = pool.acquire()
+    threading.Timer(0.05, lambda: pool.release(conn)).start()
+    self.assertIs(pool.acquire(), conn)
+    self.assertEquals(pool.stats()['waits'], 1)
+
+  def test_failed_connect(self):
+    def connect():
+      raise IOError()
+    pool = ConnectionPool(connect = connect, max_size = 1, timeout = 0.05)
+    with self.assertRaises(IOError):
+      pool.acquire()
+    self.assertEquals(pool.stats()['size'], 0)
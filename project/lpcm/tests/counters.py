@@ -0,0 +1,72 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import time
+import unittest
+from base import LPCMTestCase
+from .. import counters
+from ..counters import CounterBuffer
+from ..key import LPCMKey
+from ..lpm import LargePersistentMap as LPM
+from .. import config
+
+@unittest.skipIf(config.LPCM_TEST_USE_LOCAL_CACHE_ONLY, "Disable in CACHE_ONLY mode")
+class TestCounterBuffer(LPCMTestCase):
+
+  def test_flush_on_size(self):
+    some_map = LPM(name = "some_map")
+    counter_buffer = CounterBuffer(max_pending_keys = 2, flush_interval = 60)
+    counter_buffer.add(LPCMKey("some_map", "a"), 1)
+    counter_buffer.add(LPCMKey("some_map", "a"), 2)
+    self.assertEquals(counter_buffer.stats()['pending_delta'], 3)
+    self.assertNotIn("a", some_map)
+    counter_buffer.add(LPCMKey("some_map", "b"), -1) # flushed in the background
+    for i in xrange(100):
+      if counter_buffer.stats()['flushes']:
+        break
+      time.sleep(0.05)
+    self.assertEquals(counter_buffer.stats()['pending_keys'], 0)
+    self.assertEquals(some_map.get_many(["a", "b"]), {"a": 3, "b": -1})
+
+  def test_flush_on_time(self):
+    some_map = LPM(name = "some_map")
+    counter_buffer = CounterBuffer(max_pending_keys = 100, flush_interval = 0.1)
+    counter_buffer.add(LPCMKey("some_map", "a"), 1)
+    self.assertGreaterEqual(counter_buffer.stats()['lag'], 0)
+    time.sleep(1)
+    self.assertEquals(some_map["a"], 1)
+    self.assertEquals(counter_buffer.stats()['flushes'], 1)
+
+  def test_take(self):
+    counter_buffer = CounterBuffer(max_pending_keys = 100, flush_interval = 60)
+    counter_buffer.add(LPCMKey("some_map", "a"), 5)
+    self.assertEquals(counter_buffer.pending(LPCMKey("some_map", "a")), 5)
+    self.assertEquals(counter_buffer.take(LPCMKey("some_map", "a")), 5)
+    self.assertEquals(counter_buffer.take(LPCMKey("some_map", "a")), 0)
+    self.assertEquals(counter_buffer.stats()['pending_keys'], 0)
+
+  def test_discard(self):
+    counter_buffer = CounterBuffer(max_pending_keys = 100, flush_interval = 60)
+    counter_buffer.add(LPCMKey("some_map", "a"), 5)
+    counter_buffer.add(LPCMKey("some_map", "b"), 1)
+    counter_buffer.discard([LPCMKey("some_map", "a")])
+    self.assertEquals(counter_buffer.pending(LPCMKey("some_map", "a")), 0)
+    self.assertEquals(counter_buffer.stats()['pending_keys'], 1)
+
+  def test_failed_flush(self):
+    "add() does not raise when dynamodb fails, and the deltas are kept"
+    class FailingStorage(object):
+      def add_to_item(self, cmp_key, value):
+        raise IOError("dynamodb is down")
+    get_storage = counters.get_storage
+    counters.get_storage = FailingStorage
+    try:
+      counter_buffer = CounterBuffer(max_pending_keys = 1, flush_interval = 60)
+      counter_buffer.add(LPCMKey("some_map", "a"), 1)
+      for i in xrange(100):
+        if counter_buffer.stats()['flushes']:
+          break
+        time.sleep(0.05)
+      self.assertEquals(counter_buffer.pending(LPCMKey("some_map", "a")), 1)
+    finally:
+      counters.get_storage = get_storage
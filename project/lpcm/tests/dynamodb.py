@@ -0,0 +1,42 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import unittest
+from base import LPCMTestCase
+from ..connection_pool import ConnectionPool
+from ..dynamodb import DynamoDB
+from ..lpm import LargePersistentMap as LPM
+from .. import config
+
+@unittest.skipIf(config.LPCM_TEST_USE_LOCAL_CACHE_ONLY, "Disable in CACHE_ONLY mode")
+class TestDynamoDB(LPCMTestCase):
+
+  def test_warm_up(self):
+    DynamoDB.warm_up(num_connections = 2)
+    self.assertIn(config.LPCM_DYNAMODB_TABLE_NAME, DynamoDB._schemas)
+    self.assertGreaterEqual(DynamoDB.get_pool().stats()['idle'], 2)
+    with DynamoDB.connection() as conn:
+      table = DynamoDB.get_table(config.LPCM_DYNAMODB_TABLE_NAME, conn)
+      self.assertIs(DynamoDB.get_table(config.LPCM_DYNAMODB_TABLE_NAME, conn), table)
+      self.assertEquals(table.schema.hash_key_name, DynamoDB.Constants.HASH_KEY_NAME)
+
+  def test_table_not_found(self):
+    with DynamoDB.connection() as conn:
+      with self.assertRaises(DynamoDB.TableNotFound):
+        DynamoDB.get_table("__lpcm_no_such_table", conn)
+
+  def test_parallel_query_with_few_connections(self):
+    "More segments than pooled connections share the free ones, instead of timing out"
+    pool = DynamoDB._pool
+    DynamoDB._pool = ConnectionPool(DynamoDB._connect, max_size = 2, timeout = 1)
+    some_map = LPM(name = "some_map")
+    mapping = dict(("key_{}".format(i), i) for i in range(50))
+    try:
+      some_map.set_many(mapping)
+      self.assertEquals(set(some_map.iterkeys(segments = 8)), set(mapping))
+      with DynamoDB.connection() as conn: # one connection left for the query
+        self.assertEquals(dict(some_map.iteritems(segments = 8)), mapping)
+      self.assertEquals(DynamoDB.get_pool().stats()['timeouts'], 0)
+    finally:
+      some_map.delete_many(mapping.keys())
+      DynamoDB._pool = pool
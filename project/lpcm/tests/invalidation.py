@@ -0,0 +1,98 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+from django.core.cache import cache
+from base import LPCMTestCase
+from .. import invalidation
+from ..invalidation import MemcachedInvalidationBroadcaster, SocketInvalidationBroadcaster
+from ..key import LPCMKey
+from ..lcm import LargeCachedMap as LCM
+from ..local_cache import LocalCache
+
+class TestInvalidation(LPCMTestCase):
+
+  def setUp(self):
+    super(TestInvalidation, self).setUp()
+    cache.clear()
+
+  def test_memcached_broadcaster(self):
+    sender = MemcachedInvalidationBroadcaster(poll_interval = 0)
+    subscriber = MemcachedInvalidationBroadcaster(poll_interval = 0)
+    self.assertEquals(subscriber.poll(), [])
+    sender.publish("some_map", ["a", "b"], "put")
+    sender.publish("another_map", ["c"], "delete")
+    self.assertEquals(subscriber.poll(),
+      [("some_map", ["a", "b"], "put"), ("another_map", ["c"], "delete")])
+    self.assertEquals(subscriber.poll(), [])
+    sender.publish("some_map", ["d"], "put")
+    cache.delete(sender._log_key(3)) # a lost message evicts everything
+    self.assertEquals(subscriber.poll(), [(None, [], 'delete')])
+
+  def test_udp_broadcaster(self):
+    subscriber = SocketInvalidationBroadcaster(("127.0.0.1", 0), peers = [])
+    sender = SocketInvalidationBroadcaster(("127.0.0.1", 0),
+      peers = [subscriber.socket.getsockname()])
+    self.assertEquals(subscriber.poll(), [])
+    sender.publish("some_map", ["a"], "put")
+    time.sleep(0.01)
+    self.assertEquals(subscriber.poll(), [("some_map", ["a"], "put")])
+
+  def test_unix_socket_broadcaster(self):
+    directory = tempfile.mkdtemp()
+    try:
+      address = os.path.join(directory, "subscriber.sock")
+      subscriber = SocketInvalidationBroadcaster(address, peers = [])
+      sender = SocketInvalidationBroadcaster(os.path.join(directory, "sender.sock"),
+        peers = [address])
+      sender.publish("some_map", ["a"], "delete")
+      self.assertEquals(subscriber.poll(), [("some_map", ["a"], "delete")])
+    finally:
+      shutil.rmtree(directory)
+
+  def test_unix_socket_in_use(self):
+    directory = tempfile.mkdtemp()
+    try:
+      address = os.path.join(directory, "subscriber.sock")
+      subscriber = SocketInvalidationBroadcaster(address, peers = [])
+      with self.assertRaises(socket.error):
+        SocketInvalidationBroadcaster(address, peers = [])
+      subscriber.socket.close() # the socket file is now stale, and can be replaced
+      subscriber = SocketInvalidationBroadcaster(address, peers = [])
+    finally:
+      shutil.rmtree(directory)
+
+  def test_evict_invalidated_keys(self):
+    subscriber = SocketInvalidationBroadcaster(("127.0.0.1", 0), peers = [])
+    sender = SocketInvalidationBroadcaster(("127.0.0.1", 0),
+      peers = [subscriber.socket.getsockname()])
+    local_cache = LocalCache(max_entries = 10, max_bytes = 1024, timeout = 60)
+    local_cache.set(LPCMKey("some_map", "a").cache_key, 123)
+    local_cache.set(LPCMKey("some_map", (1, 2)).cache_key, 234)
+    local_cache.set(LPCMKey("some_map", "b").cache_key, 345)
+    invalidation._broadcaster = subscriber
+    try:
+      sender.publish("some_map", [LPCMKey("some_map", k).original_key_str for k in ["a", (1, 2)]], "put")
+      time.sleep(0.01)
+      invalidation.evict_invalidated_keys(local_cache)
+    finally:
+      invalidation._broadcaster = None
+    self.assertEquals(local_cache.get(LPCMKey("some_map", "a").cache_key), None)
+    self.assertEquals(local_cache.get(LPCMKey("some_map", (1, 2)).cache_key), None)
+    self.assertEquals(local_cache.get(LPCMKey("some_map", "b").cache_key), 345)
+
+  def test_publish_local_maps_only(self):
+    subscriber = SocketInvalidationBroadcaster(("127.0.0.1", 0), peers = [])
+    invalidation._broadcaster = SocketInvalidationBroadcaster(("127.0.0.1", 0),
+      peers = [subscriber.socket.getsockname()])
+    try:
+      LCM(name = "some_map")["a"] = 123
+      LCM(name = "local_map", local_cache = True)["b"] = 234
+      time.sleep(0.01)
+      self.assertEquals(subscriber.poll(), [("local_map", ["b"], "put")])
+    finally:
+      invalidation._broadcaster = None
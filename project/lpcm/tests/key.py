@@ -0,0 +1,35 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+from base import LPCMTestCase
+from ..key import LPCMKey
+
+class TestLPCMKey(LPCMTestCase):
+
+  def test_memo(self):
+    cmp_key = LPCMKey.get("some_map", "a")
+    self.assertIs(LPCMKey.get("some_map", "a"), cmp_key)
+    self.assertIs(LPCMKey.get("some_map", cmp_key), cmp_key)
+    self.assertIsNot(LPCMKey.get("another_map", "a"), cmp_key)
+    self.assertEquals(LPCMKey.get("some_map", 1).original_key_str, "1")
+    self.assertEquals(LPCMKey.get("some_map", 1.0).original_key_str, "1.0")
+    self.assertEquals(LPCMKey.get("some_map", ["a"]).original_key_str, "['a']") # not hashable
+    self.assertEquals(cmp_key.cache_key, LPCMKey("some_map", "a").cache_key)
+
+  def test_hex_encoding(self):
+    keys = [u"a", u"ab", u"b", u"ba", 'Ivan Krsti\xc4\x87'.decode('utf8'), u"~"]
+    range_keys = [LPCMKey.encode_range_key(key, 'hex') for key in keys]
+    self.assertEquals(sorted(range_keys), [LPCMKey.encode_range_key(key, 'hex') for key in sorted(keys)])
+    for key, range_key in zip(keys, range_keys):
+      self.assertEquals(LPCMKey.decode_range_key(range_key, 'hex'), key)
+
+  def test_map_encoding(self):
+    LPCMKey.set_map_encoding("hex_map", 'hex')
+    self.assertEquals(LPCMKey.get("hex_map", "a").range_key, "61")
+    self.assertEquals(LPCMKey.get("some_map", "a").range_key, "ME======")
+    with self.assertRaises(ValueError):
+      LPCMKey.set_map_encoding("hex_map", 'base32')
+    with self.assertRaises(ValueError):
+      LPCMKey.set_map_encoding("another_map", 'base64')
+    with self.assertRaises(ValueError): # its keys were built with base32 already
+      LPCMKey.set_map_encoding("some_map", 'hex')
@@ -1,9 +1,16 @@
 # Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
 # Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
 
+import threading
+import time
 from django.core.cache import cache
 from base import LPCMTestCase
-from ..lcm import LargeCachedMap as LCM
+from ..cache import Cache, LPCM_LOCAL_CACHE
+from ..codec import Codec
+from ..key import LPCMKey
+from ..lcm import LargeCachedMap as LCM, LCMKeys
+from ..models import Signals
+from ..thread_local import set_in_test
 
 class TestLCM(LPCMTestCase):
 
@@ -51,6 +58,59 @@ class TestLCM(LPCMTestCase):
     self.assertEquals(some_map.get("a", 234), 123)
     self.assertEquals(some_map.get("bad_key", 234), 234)
 
+  def test_get_many(self):
+    some_map = LCM(name = "some_map")
+    some_map["a"] = 123
+    some_map["b"] = "some string"
+    self.assertEquals(some_map.get_many(["a", "b", "bad_key"]), {"a": 123, "b": "some string"})
+    self.assertEquals(some_map.get_many([]), {})
+
+  def test_set_many_and_delete_many(self):
+    some_map = LCM(name = "some_map")
+    sent = []
+    def on_update(sender, **kwargs):
+      self.assertIsNone(kwargs['key']) # receivers that only know single key updates don't fail
+      sent.append(Signals.updated_keys(kwargs))
+    Signals.post_update.connect(on_update)
+    try:
+      some_map.set_many({"a": 123, "b": "some string", "c": 7.890})
+      some_map.delete_many(["a", "c", "lala_i_don't_exist"])
+    finally:
+      Signals.post_update.disconnect(on_update)
+    self.assertEquals(len(sent), 2) # one signal per batch
+    self.assertEquals(some_map.get_many(["a", "b", "c"]), {"b": "some string"})
+    self.assertEquals(set(some_map.keys()), {"b"})
+
+  def test_wait_for_token_holder(self):
+    some_map = LCM(name = "some_map")
+    cache_key = LPCMKey("some_map", "a").cache_key
+    self.assertTrue(some_map.cache.get_thread_safe_token(cache_key))
+    # pretend another thread holds the token and saves the value a little later
+    threading.Timer(0.05, lambda: some_map.cache.set(cache_key, 123)).start()
+    self.assertEquals(some_map["a"], 123)
+
+  def test_missing_key_notifies_waiters(self):
+    some_map = LCM(name = "some_map")
+    with self.assertRaises(KeyError):
+      a = some_map["bad_key"]
+    # the token is kept as a notice that the key is missing, so this read doesn't have to wait
+    start = time.time()
+    with self.assertRaises(KeyError):
+      a = some_map["bad_key"]
+    self.assertLess(time.time() - start, 0.5)
+
+  def test_local_cache(self):
+    LPCM_LOCAL_CACHE.clear()
+    some_map = LCM(name = "some_map", local_cache = True)
+    some_map["a"] = 123
+    cache.clear()
+    self.assertEquals(some_map["a"], 123) # served in-process
+    some_map.increment("a")
+    self.assertEquals(some_map["a"], 1) # increments invalidate the local copy
+    some_map.delete("a")
+    with self.assertRaises(KeyError):
+      a = some_map["a"]
+
   def test_unicode(self):
     some_map = LCM(name = "some_map")
     unicode_key = 'Ivan Krsti\xc4\x87'.decode('utf8')
@@ -62,7 +122,7 @@ class TestLCM(LPCMTestCase):
   def test_increment(self):
     some_map = LCM(name = "some_map")
     some_map['a'] = 41
-    some_map.increment('a')
+    self.assertEquals(some_map.increment('a'), 42)
     self.assertEquals(some_map['a'], 42)
     some_map.increment('a', 4.2)
     self.assertEquals(some_map['a'], 46.2)
@@ -77,6 +137,21 @@ class TestLCM(LPCMTestCase):
     some_map.decrement('a', 50.1)
     self.assertEquals(some_map['a'], -10)
 
+  def test_concurrent_increments(self):
+    some_map = LCM(name = "some_map")
+    def increment():
+      set_in_test()
+      for i in xrange(50):
+        some_map.increment('a')
+        some_map.decrement('b')
+    threads = [threading.Thread(target = increment) for i in xrange(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(some_map['a'], 200)
+    self.assertEquals(some_map['b'], -200)
+
   def test_increment_non_existent(self):
     some_map = LCM(name = "some_map")
     some_map.increment('new_key')
@@ -105,3 +180,63 @@ class TestLCM(LPCMTestCase):
     self.assertEquals(set(some_map.keys()), {'a', 'b', 'c', unicode_key})
     another_map.delete('e')
     self.assertEquals(set(another_map.keys()), {'a', 'd'})
+
+  def test_key_index(self):
+    some_map = LCM(name = "some_map")
+    some_map.set_many(dict((i, i) for i in xrange(10)))
+    some_map[3] = 33 # already indexed
+    some_map.delete_many([0, 5])
+    some_map[5] = 55 # indexed again, in a new slot
+    some_map.increment(10)
+    self.assertEquals(list(LCMKeys.iter_keys("some_map", page_size = 3)), [1, 2, 3, 4, 6, 7, 8, 9, 5, 10])
+    self.assertEquals(sorted(some_map.iteritems(request_limit = 4)),
+      [(1, 1), (2, 2), (3, 33), (4, 4), (5, 55), (6, 6), (7, 7), (8, 8), (9, 9), (10, 1)])
+
+  def test_failed_key_index(self):
+    "A key whose add failed half way is indexed again once its marker expires"
+    adding_cache = LCMKeys._adding_cache
+    LCMKeys._adding_cache = Cache(timeout = 1)
+    try:
+      LCMKeys._adding_cache.add(LCMKeys._marker_key("some_map", "a"), LCMKeys.Constants.ADDING)
+      some_map = LCM(name = "some_map")
+      some_map["a"] = 123
+      self.assertEquals(some_map.keys(), [])
+      time.sleep(1.5)
+      some_map["a"] = 234
+      self.assertEquals(some_map.keys(), ["a"])
+    finally:
+      LCMKeys._adding_cache = adding_cache
+
+  def test_items(self):
+    some_map = LCM(name = "some_map")
+    some_map["a"] = 123
+    some_map["b"] = "some string"
+    self.assertEquals(sorted(some_map.items()), [("a", 123), ("b", "some string")])
+    self.assertEquals(sorted(some_map.values()), [123, "some string"])
+
+  def test_pop(self):
+    some_map = LCM(name = "some_map")
+    some_map["a"] = 123
+    self.assertEquals(some_map.pop("a"), 123)
+    self.assertNotIn("a", some_map)
+    self.assertEquals(some_map.keys(), [])
+    self.assertEquals(some_map.pop("a", 234), 234)
+    with self.assertRaises(KeyError):
+      some_map.pop("a")
+
+  def test_codec(self):
+    some_map = LCM(name = "some_map", codec = Codec('marshal', compress_threshold = 100))
+    long_string = "some string " * 100
+    some_map["a"] = long_string
+    some_map["b"] = 123
+    some_map.increment("b")
+    some_map.set_many({"c": {1, 2}})
+    self.assertEquals(some_map.get_many(["a", "b", "c"]), {"a": long_string, "b": 124, "c": {1, 2}})
+    stored = cache.get(LPCMKey("some_map", "a").cache_key)
+    self.assertTrue(Codec.is_encoded(stored))
+    self.assertLess(len(stored), len(long_string))
+    self.assertEquals(cache.get(LPCMKey("some_map", "b").cache_key), 124)
+    # values written without the codec are still read
+    self.assertEquals(LCM(name = "some_map")["a"], long_string)
+    cache.set(LPCMKey("some_map", "d").cache_key, "some string")
+    self.assertEquals(some_map["d"], "some string")
@@ -0,0 +1,83 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import time
+from base import LPCMTestCase
+from ..local_cache import LocalCache
+
+class TestLocalCache(LPCMTestCase):
+
+  def test_get_set_delete(self):
+    c = LocalCache(max_entries = 10, max_bytes = 1024, timeout = 60)
+    c.set("a", 123)
+    c.set("b", {1, 2})
+    self.assertEquals(c.get("a"), 123)
+    self.assertEquals(c.get("b"), {1, 2})
+    self.assertEquals(c.get("bad_key"), None)
+    c.delete("a")
+    c.delete_many(["b", "bad_key"])
+    self.assertEquals(c.get("a"), None)
+    self.assertEquals(c.get("b"), None)
+
+  def test_values_are_copies(self):
+    c = LocalCache(max_entries = 10, max_bytes = 1024, timeout = 60)
+    c.set("a", {1, 2})
+    c.get("a").add(3)
+    self.assertEquals(c.get("a"), {1, 2})
+
+  def test_timeout(self):
+    c = LocalCache(max_entries = 10, max_bytes = 1024, timeout = 60)
+    c.set("a", 123, timeout = 0.01)
+    time.sleep(0.02)
+    self.assertEquals(c.get("a"), None)
+    self.assertEquals(c.stats()['entries'], 0)
+
+  def test_lru_eviction(self):
+    c = LocalCache(max_entries = 2, max_bytes = 1024, timeout = 60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")
+    c.set("c", 3) # evicts b, the least recently used
+    self.assertEquals(c.get("b"), None)
+    self.assertEquals(c.get("a"), 1)
+    self.assertEquals(c.get("c"), 3)
+    big = LocalCache(max_entries = 10, max_bytes = 1024, timeout = 60)
+    big.set("a", "x" * 600)
+    big.set("b", "y" * 600) # over max_bytes
+    self.assertEquals(big.get("a"), None)
+    self.assertEquals(big.get("b"), "y" * 600)
+    big.set("c", "z" * 2048) # never cached
+    self.assertEquals(big.get("c"), None)
+
+  def test_stats(self):
+    c = LocalCache(max_entries = 1, max_bytes = 1024, timeout = 60)
+    c.set("a", 1)
+    c.get("a")
+    c.get("bad_key")
+    c.set("b", 2)
+    stats = c.stats()
+    self.assertEquals((stats['hits'], stats['misses'], stats['evictions'], stats['entries']),
+      (1, 1, 1, 1))
+
+  def test_add_and_incr(self):
+    c = LocalCache(max_entries = 10, max_bytes = 1024, timeout = 60)
+    self.assertTrue(c.add("a", 1))
+    self.assertFalse(c.add("a", 2))
+    self.assertEquals(c.incr("a", 5), 6)
+    self.assertEquals(c.get("a"), 6)
+    self.assertIsNone(c.incr("bad_key", 1))
+    c.set("b", "some string")
+    with self.assertRaises(ValueError):
+      c.incr("b", 1)
+
+  def test_cas(self):
+    c = LocalCache(max_entries = 10, max_bytes = 1024, timeout = 60)
+    self.assertEquals(c.gets("a"), (None, None))
+    c.set("a", {1})
+    value, cas_id = c.gets("a")
+    self.assertEquals(value, {1})
+    self.assertTrue(c.cas("a", {1, 2}, cas_id))
+    self.assertFalse(c.cas("a", {1, 3}, cas_id)) # changed since gets
+    self.assertEquals(c.get("a"), {1, 2})
+    c.delete("a")
+    self.assertFalse(c.cas("a", {1}, c.gets("a")[1]))
@@ -1,10 +1,13 @@
 # Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
 # Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
 
+import threading
 import unittest
 from django.core.cache import cache
 from base import LPCMTestCase
+from ..key import LPCMKey
 from ..lpcm import LargePersistentCachedMap as LPCM
+from ..thread_local import set_in_test
 from .. import config
 from project.lpcm.lpm import MockLPM
 
@@ -46,6 +49,48 @@ class TestLPCM(LPCMTestCase):
     self.assertEquals(another_map["b"], "another string")
     self.assertEquals(another_map["c"], 8.901)
 
+  def test_negative_cache(self):
+    some_map = LPCM(name = "some_map", negative_cache_timeout = 60)
+    with self.assertRaises(KeyError):
+      a = some_map["a"]
+    some_map.lpm["a"] = 123 # bypasses the cache, so the key is still remembered as missing
+    self.assertNotIn("a", some_map)
+    self.assertEquals(some_map.get_many(["a"]), {})
+    some_map["a"] = 234 # writes replace the record
+    self.assertEquals(some_map["a"], 234)
+    self.assertEquals(some_map.get_many(["b", "c"]), {})
+    some_map.increment("b")
+    self.assertEquals(some_map.get_many(["b", "c"]), {"b": 1})
+
+  def test_concurrent_misses(self):
+    some_map = LPCM(name = "some_map")
+    some_map["a"] = 123
+    cache.clear()
+    lpm = some_map.lpm
+    release = threading.Event()
+    num_reads = []
+    class SlowLPM(object):
+      def __getitem__(self, key):
+        num_reads.append(key)
+        release.wait(5)
+        return lpm[key]
+    some_map.lpm = SlowLPM()
+    values = []
+    shared = LPCM._reads.stats()['shared']
+    def read():
+      set_in_test()
+      values.append(some_map["a"])
+    threads = [threading.Thread(target = read) for i in xrange(5)]
+    for thread in threads:
+      thread.start()
+    while LPCM._reads.stats()['shared'] < shared + 4: # all threads wait for the first one
+      release.wait(0.01)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(values, [123] * 5)
+    self.assertEquals(len(num_reads), 1)
+
   def test_contains(self):
     some_map = LPCM(name = "some_map")
     try:
@@ -65,6 +110,31 @@ class TestLPCM(LPCMTestCase):
     # deleting non existent key should be fine
     some_map.delete("lala_i_don't_exist")
 
+  def test_get_many(self):
+    some_map = LPCM(name = "some_map")
+    some_map["a"] = 123
+    some_map["b"] = "some string"
+    some_map[(1, 2)] = 7.890
+    expected = {"a": 123, "b": "some string", (1, 2): 7.890}
+    self.assertEquals(some_map.get_many(["a", "b", (1, 2), "bad_key"]), expected)
+    cache.clear()
+    self.assertEquals(some_map.get_many(["a", "b", (1, 2), "bad_key"]), expected)
+    # the misses were saved back in cache
+    some_map.lpm = MockLPM()
+    self.assertEquals(some_map.get_many(["a", "b", (1, 2)]), expected)
+
+  def test_set_many_and_delete_many(self):
+    some_map = LPCM(name = "some_map")
+    mapping = dict(("key_{}".format(i), i) for i in range(60)) # more than one BatchWriteItem
+    some_map.set_many(mapping)
+    self.assertEquals(some_map.get_many(mapping.keys()), mapping)
+    cache.clear()
+    self.assertEquals(some_map.get_many(mapping.keys()), mapping)
+    some_map.delete_many(mapping.keys() + ["lala_i_don't_exist"])
+    self.assertEquals(some_map.get_many(mapping.keys()), {})
+    cache.clear()
+    self.assertEquals(some_map.get_many(mapping.keys()), {})
+
   def test_unicode(self):
     some_map = LPCM(name = "some_map")
     unicode_key = 'Ivan Krsti\xc4\x87'.decode('utf8')
@@ -78,10 +148,79 @@ class TestLPCM(LPCMTestCase):
   def test_increment(self):
     some_map = LPCM(name = "some_map")
     some_map['a'] = 41
-    some_map.increment('a')
+    self.assertEquals(some_map.increment('a'), 42)
     self.assertEquals(some_map['a'], 42)
-    some_map.increment('a', 4.2)
+    self.assertEquals(some_map.increment('a', 4.2), 46.2)
     self.assertEquals(some_map['a'], 46.2)
+    self.assertEquals(cache.get(LPCMKey("some_map", "a").cache_key), 46.2) # cached by the read
+
+  def test_buffered_counters(self):
+    some_map = LPCM(name = "some_map", buffered_counters = True)
+    self.assertEquals(some_map.increment('a'), 1) # not cached: written right away
+    self.assertEquals(some_map['a'], 1) # cached by the read, so the next increments are buffered
+    self.assertEquals(some_map.increment('a', 2), 3)
+    self.assertEquals(some_map.decrement('a'), 2)
+    self.assertEquals(some_map['a'], 2)
+    self.assertEquals(some_map.counter_buffer.stats()['pending_keys'], 1)
+    some_map.disable_caching()
+    self.assertEquals(some_map['a'], 1) # the other deltas are still pending
+    some_map.counter_buffer.flush()
+    self.assertEquals(some_map['a'], 2)
+    self.assertEquals(some_map.counter_buffer.stats()['pending_keys'], 0)
+
+  def test_buffered_counters_read_miss(self):
+    some_map = LPCM(name = "some_map", buffered_counters = True)
+    some_map.increment('a')
+    self.assertEquals(some_map['a'], 1)
+    some_map.increment('a', 2)
+    cache.clear()
+    # the pending delta is written before the total is read and cached
+    self.assertEquals(some_map['a'], 3)
+    self.assertEquals(some_map.counter_buffer.pending(LPCMKey.get("some_map", 'a')), 0)
+    self.assertEquals(some_map.increment('a'), 4)
+    some_map.counter_buffer.flush()
+
+  def test_buffered_counters_failed_write(self):
+    some_map = LPCM(name = "some_map", buffered_counters = True)
+    some_map.increment('a')
+    self.assertEquals(some_map['a'], 1)
+    some_map.increment('a', 2)
+    cache.clear()
+    lpm = some_map.lpm
+    class FailingLPM(object):
+      def atomic_add_value(self, key, value):
+        raise IOError("dynamodb is down")
+    some_map.lpm = FailingLPM()
+    with self.assertRaises(IOError):
+      some_map.increment('a')
+    # the pending delta of the earlier increment is not lost
+    self.assertEquals(some_map.counter_buffer.pending(LPCMKey.get("some_map", 'a')), 2)
+    some_map.lpm = lpm
+    some_map.counter_buffer.flush()
+    self.assertEquals(some_map['a'], 3)
+
+  def test_read_during_update(self):
+    "A read that caches the new total between the dynamodb update and the cache update"
+    some_map = LPCM(name = "some_map")
+    some_map.increment('a', 5)
+    self.assertEquals(some_map['a'], 5)
+    lpm = some_map.lpm
+    class ReadAfterUpdateLPM(object):
+      def atomic_add_value(self, key, value):
+        new_value = lpm.atomic_add_value(key, value)
+        some_map.cache.delete(key.cache_key)
+        some_map[key] # another thread's read misses, and caches the new total
+        return new_value
+      def __getitem__(self, key):
+        return lpm[key]
+    some_map.lpm = ReadAfterUpdateLPM()
+    self.assertEquals(some_map.increment('a'), 6)
+    some_map.lpm = lpm
+    self.assertEquals(some_map['a'], 6) # not counted twice
+    some_map.lpm = ReadAfterUpdateLPM()
+    some_map.increment('a', -2)
+    some_map.lpm = lpm
+    self.assertEquals(some_map['a'], 4)
 
   def test_increment_non_existent(self):
     some_map = LPCM(name = "some_map")
@@ -99,7 +238,7 @@ class TestLPCM(LPCMTestCase):
   def test_decrement(self):
     some_map = LPCM(name = "some_map")
     some_map['a'] = 43
-    some_map.decrement('a')
+    self.assertEquals(some_map.decrement('a'), 42)
     self.assertEquals(some_map['a'], 42)
     some_map.decrement('a', 1.9)
     self.assertEquals(some_map['a'], 40.1)
@@ -131,3 +270,19 @@ class TestLPCM(LPCMTestCase):
     self.assertEquals(set(some_map.keys()), {'a', 'b', 'c', unicode_key})
     another_map.delete('e')
     self.assertEquals(set(another_map.keys()), {'a', 'd'})
+
+  def test_items(self):
+    some_map = LPCM(name = "some_map")
+    some_map["a"] = 123
+    some_map["b"] = "some string"
+    self.assertEquals(sorted(some_map.items()), [("a", 123), ("b", "some string")])
+    self.assertEquals(dict(some_map.iteritems(segments = 8)), {"a": 123, "b": "some string"})
+
+  def test_pop(self):
+    some_map = LPCM(name = "some_map")
+    some_map["a"] = 123
+    self.assertEquals(some_map.pop("a"), 123)
+    self.assertNotIn("a", some_map)
+    self.assertEquals(some_map.pop("a", 234), 234)
+    with self.assertRaises(KeyError):
+      some_map.pop("a")
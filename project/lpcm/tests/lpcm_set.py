@@ -6,6 +6,7 @@ from django.core.cache import cache
 from base import LPCMTestCase
 from ..lpcm_set import LargePersistentCachedMapForSets as LPCMSet
 from ..lpcm_set import  LargeCachedMapForSets as LCMSet
+from ..shortcuts import ShardedLPCMSet
 from .. import config
 
 @unittest.skipIf(config.LPCM_TEST_USE_LOCAL_CACHE_ONLY, "Disable in CACHE_ONLY mode")
@@ -49,6 +50,21 @@ class TestLPCMSet(LPCMTestCase):
     self.assertEquals(another_map["d"], set())
     self.assertEquals(another_map["bad_key"], set())  # non-existent keys return empty sets
 
+  def test_get_many(self):
+    some_map = LPCMSet(name = "some_map")
+    some_map["a"] = [1, 2]
+    some_map["b"] = set()
+    expected = {"a": {1, 2}, "b": set(), "bad_key": set()}
+    self.assertEquals(some_map.get_many(["a", "b", "bad_key"]), expected)
+    cache.clear()
+    self.assertEquals(some_map.get_many(["a", "b", "bad_key"]), expected)
+
+  def test_set_many(self):
+    some_map = LPCMSet(name = "some_map")
+    some_map.set_many({"a": [1, 2], "b": []})
+    cache.clear()
+    self.assertEquals(some_map.get_many(["a", "b"]), {"a": {1, 2}, "b": set()})
+
   def test_insert_values(self):
     some_map = LPCMSet(name = "some_map")
     some_map["some_list"] = [1,2,3,4]
@@ -70,6 +86,24 @@ class TestLPCMSet(LPCMTestCase):
     self.assertEquals(some_map["some_list"], {2})
     self.assertEquals(some_map["other_list"], set())
 
+  def test_updates_return_the_new_set(self):
+    some_map = LPCMSet(name = "some_map")
+    some_map["a"] = [1, 2]
+    self.assertEquals(some_map.insert_values("a", [3]), {1, 2, 3})
+    self.assertEquals(some_map.remove_values("a", [1]), {2, 3})
+    self.assertEquals(some_map.remove_values("b", [1]), set())
+    self.assertEquals(some_map["a"], {2, 3}) # the cached set was deleted, and read again
+
+  def test_update_empty_set(self):
+    some_map = LPCMSet(name = "some_map")
+    some_map["a"] = []
+    self.assertEquals(some_map.remove_values("a", [1]), set())
+    self.assertEquals(some_map.insert_values("a", [1, 2]), {1, 2})
+    self.assertEquals(some_map.remove_values("a", [1, 2]), set())
+    self.assertEquals(some_map.insert_values("a", [3]), {3})
+    cache.clear()
+    self.assertEquals(some_map["a"], {3})
+
 class TestLCMSet(LPCMTestCase):
 
   def setUp(self):
@@ -103,6 +137,13 @@ class TestLCMSet(LPCMTestCase):
     cache.clear()
     self.assertEquals(another_map["a"], set())  # non-existent keys return empty sets
 
+  def test_get_many(self):
+    some_map = LCMSet(name = "some_map")
+    some_map["a"] = [1, 2]
+    some_map["b"] = set()
+    self.assertEquals(some_map.get_many(["a", "b", "bad_key"]),
+      {"a": {1, 2}, "b": set(), "bad_key": set()})
+
   def test_insert_values(self):
     some_map = LCMSet(name = "some_map")
     some_map["some_list"] = [1,2,3,4]
@@ -121,3 +162,63 @@ class TestLCMSet(LPCMTestCase):
     some_map.remove_values("other_list", [5, 6, 7])
     self.assertEquals(some_map["some_list"], {2})
     self.assertEquals(some_map["other_list"], set())
+
+
+class TestShardedLPCMSet(LPCMTestCase):
+  def setUp(self):
+    super(TestShardedLPCMSet, self).setUp()
+    cache.clear()
+
+  def test_insert_and_remove_values(self):
+    some_map = ShardedLPCMSet(name = "some_map", num_shards = 4)
+    some_map.insert_values("a", xrange(100))
+    some_map.remove_values("a", [0, 1, 31415])
+    some_map.insert_values("a", ["x", "Ivan Krsti\xc4\x87".decode('utf8')])
+    self.assertEquals(some_map["a"], set(range(2, 100) + ["x", "Ivan Krsti\xc4\x87".decode('utf8')]))
+    self.assertEquals(some_map["b"], set())
+    self.assertEquals(some_map.cardinality("a"), 100)
+    self.assertEquals(some_map.cardinality("b"), 0)
+
+  def test_contains(self):
+    some_map = ShardedLPCMSet(name = "some_map", num_shards = 4)
+    some_map["a"] = [1, 2, 3]
+    self.assertTrue(some_map.contains("a", 2))
+    self.assertFalse(some_map.contains("a", 4))
+    self.assertFalse(some_map.contains("b", 1))
+
+  def test_shards(self):
+    some_map = ShardedLPCMSet(name = "some_map", num_shards = 4)
+    some_map["a"] = xrange(100)
+    shards = some_map.get_shards("a", range(4))
+    self.assertEquals(len(shards), 4)
+    for shard, members in shards.iteritems():
+      self.assertTrue(members) # 100 members are spread over all the shards
+      for member in members:
+        self.assertEquals(some_map.shard_of(member), shard)
+
+  def test_pages(self):
+    some_map = ShardedLPCMSet(name = "some_map", num_shards = 4)
+    some_map["a"] = xrange(100)
+    members, cursor = some_map.get_page("a", shards_per_page = 3)
+    self.assertEquals(cursor, 3)
+    more_members, cursor = some_map.get_page("a", cursor, shards_per_page = 3)
+    self.assertIsNone(cursor)
+    self.assertEquals(members | more_members, set(xrange(100)))
+    self.assertEquals(sorted(some_map.iter_members("a")), range(100))
+
+  def test_replace_and_delete(self):
+    some_map = ShardedLPCMSet(name = "some_map", num_shards = 4)
+    some_map["a"] = xrange(100)
+    some_map["a"] = [1, 2]
+    self.assertEquals(some_map["a"], {1, 2})
+    self.assertEquals(some_map.cardinality("a"), 2)
+    some_map.delete("a")
+    self.assertEquals(some_map["a"], set())
+    self.assertEquals(some_map.cardinality("a"), 0)
+
+  def test_str_and_unicode_keys(self):
+    some_map = ShardedLPCMSet(name = "some_map", num_shards = 4)
+    some_map.insert_values('abc', xrange(10))
+    some_map.insert_values(u'abc', [10])
+    self.assertEquals(some_map[u'abc'], set(xrange(11)))
+    self.assertEquals(some_map.cardinality('abc'), 11)
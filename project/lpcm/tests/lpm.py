@@ -41,6 +41,29 @@ class TestLPM(LPCMTestCase):
     with self.assertRaises(KeyError):
       a = some_map["bad_key"]
 
+  def test_get_many(self):
+    some_map = LPM(name = "some_map")
+    keys = ["key_{}".format(i) for i in range(150)] # more than one BatchGetItem
+    try:
+      for i, key in enumerate(keys):
+        some_map[key] = i
+      result = some_map.get_many(keys + ["bad_key", "key_0"])
+      self.assertEquals(result, dict((key, i) for i, key in enumerate(keys)))
+    finally:
+      for key in keys:
+        some_map.delete(key)
+
+  def test_set_many_and_delete_many(self):
+    some_map = LPM(name = "some_map")
+    mapping = dict(("key_{}".format(i), "value_{}".format(i)) for i in range(60))
+    try:
+      some_map.set_many(mapping)
+      self.assertEquals(some_map.get_many(mapping.keys()), mapping)
+      some_map.delete_many(mapping.keys() + ["lala_i_don't_exist"])
+      self.assertEquals(some_map.get_many(mapping.keys()), {})
+    finally:
+      some_map.delete_many(mapping.keys())
+
   def test_contains(self):
     some_map = LPM(name = "some_map")
     try:
@@ -74,7 +97,7 @@ class TestLPM(LPCMTestCase):
     some_map = LPM(name = "some_map")
     try:
       some_map['a'] = 41
-      some_map.atomic_add_value('a', -1)
+      self.assertEquals(some_map.atomic_add_value('a', -1), 40)
       self.assertEquals(some_map['a'], 40)
       some_map.atomic_add_value('a', 4.2)
       self.assertEquals(some_map['a'], 44.2)
@@ -115,4 +138,35 @@ class TestLPM(LPCMTestCase):
       some_map.delete("a")
       some_map.delete("b")
       some_map.delete("c")
-      some_map.delete(unicode_key)
\ No newline at end of file
+      some_map.delete(unicode_key)
+
+  def test_iteritems(self):
+    some_map = LPM(name = "some_map")
+    mapping = dict(("key_{}".format(i), i) for i in range(100))
+    mapping[u"Ivan Krsti\u0107"] = u"you are always a pain unicode"
+    try:
+      some_map.set_many(mapping)
+      self.assertEquals(dict(some_map.iteritems()), mapping)
+      self.assertEquals(dict(some_map.iteritems(segments = 4)), mapping)
+      self.assertEquals(set(some_map.iterkeys(segments = 40)), set(mapping))
+      self.assertEquals(sorted(some_map.items(segments = 3)), sorted(mapping.items()))
+      items = some_map.iteritems(segments = 4)
+      items.next()
+      items.close() # stops the parallel queries
+    finally:
+      some_map.delete_many(mapping.keys())
+
+  def test_keys_values_and_pop(self):
+    some_map = LPM(name = "some_map")
+    try:
+      some_map.set_many({"a": 1, "b": 2, "c": 3})
+      self.assertEquals(sorted(some_map.keys(request_limit = 2)), ["a", "b", "c"])
+      self.assertEquals(sorted(some_map.values(consistent_read = True)), [1, 2, 3])
+      self.assertEquals(sorted(some_map.itervalues(segments = 2)), [1, 2, 3])
+      self.assertEquals(some_map.pop("a"), 1)
+      self.assertNotIn("a", some_map)
+      self.assertEquals(some_map.pop("a", None), None)
+      with self.assertRaises(KeyError):
+        some_map.pop("a")
+    finally:
+      some_map.delete_many(["a", "b", "c"])
\ No newline at end of file
@@ -0,0 +1,76 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import threading
+from base import LPCMTestCase
+from ..single_flight import SingleFlight
+
+class TestSingleFlight(LPCMTestCase):
+
+  def _call_concurrently(self, flight, func, num_threads = 5):
+    "Calls func through flight from num_threads threads, and returns their results"
+    results = []
+    def call():
+      try:
+        results.append(flight.do('a', func))
+      except Exception as e:
+        results.append(e)
+    threads = [threading.Thread(target = call) for i in xrange(num_threads)]
+    for thread in threads:
+      thread.start()
+    return threads, results
+
+  def test_shared_result(self):
+    flight = SingleFlight()
+    release = threading.Event()
+    num_calls = []
+    def func():
+      num_calls.append(1)
+      release.wait(5)
+      return 123
+    threads, results = self._call_concurrently(flight, func)
+    while flight.stats()['shared'] < 4:
+      release.wait(0.01)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(results, [123] * 5)
+    self.assertEquals(len(num_calls), 1)
+    self.assertEquals(flight.stats(), {'in_flight': 0, 'calls': 1, 'shared': 4})
+
+  def test_waiters_get_copies(self):
+    flight = SingleFlight()
+    release = threading.Event()
+    def func():
+      release.wait(5)
+      return set([1, 2])
+    threads, results = self._call_concurrently(flight, func)
+    while flight.stats()['shared'] < 4:
+      release.wait(0.01)
+    release.set()
+    for thread in threads:
+      thread.join()
+    results[0].add(3)
+    self.assertEquals(sorted(len(result) for result in results), [2, 2, 2, 2, 3])
+
+  def test_shared_exception(self):
+    flight = SingleFlight()
+    release = threading.Event()
+    def func():
+      release.wait(5)
+      raise KeyError('a')
+    threads, results = self._call_concurrently(flight, func)
+    while flight.stats()['shared'] < 4:
+      release.wait(0.01)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(len(results), 5)
+    for result in results:
+      self.assertIsInstance(result, KeyError)
+
+  def test_sequential_calls(self):
+    flight = SingleFlight()
+    self.assertEquals(flight.do('a', lambda: 1), 1)
+    self.assertEquals(flight.do('a', lambda: 2), 2)
+    self.assertEquals(flight.stats()['calls'], 2)
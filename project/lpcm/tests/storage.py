@@ -0,0 +1,139 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import os
+import shutil
+import tempfile
+from boto.dynamodb.condition import BETWEEN, GT
+from boto.dynamodb.exceptions import DynamoDBConditionalCheckFailedError, DynamoDBKeyNotFoundError
+from boto.dynamodb.exceptions import DynamoDBResponseError, DynamoDBValidationError
+from django.core.cache import cache
+from base import LPCMTestCase
+from ..cleanup import LPCMCleanUp
+from ..key import LPCMKey
+from ..lpcm import LargePersistentCachedMap as LPCM
+from ..lpcm_set import LargePersistentCachedMapForSets as LPCMSet
+from .. import storage
+from ..storage import MemoryStorage, SqliteStorage
+
+class TestMemoryStorage(LPCMTestCase):
+
+  def make_storage(self, **kwargs):
+    return MemoryStorage(**kwargs)
+
+  def setUp(self):
+    super(TestMemoryStorage, self).setUp()
+    self.storage = self.make_storage()
+
+  def test_items(self):
+    a, b = LPCMKey("some_map", "a"), LPCMKey("some_map", "b")
+    with self.assertRaises(DynamoDBKeyNotFoundError):
+      self.storage.get_item(a)
+    self.storage.put_item(a, 123)
+    self.storage.batch_write(puts = [(b, "some string")])
+    self.assertEquals(self.storage.get_item(a)['value'], 123)
+    self.assertEquals(sorted(item['value'] for item in self.storage.batch_get_items([a, b, a])),
+      [123, "some string"])
+    self.assertEquals(self.storage.delete_item(a, return_values = 'ALL_OLD')['Attributes']['value'], 123)
+    self.assertEquals(self.storage.delete_item(a, return_values = 'ALL_OLD'), {})
+    self.storage.batch_write(deletes = [b])
+    self.assertEquals(self.storage.batch_get_items([a, b]), [])
+
+  def test_conditional_put(self):
+    a = LPCMKey("some_map", "a")
+    with self.assertRaises(DynamoDBConditionalCheckFailedError):
+      self.storage.put_item(a, 1, expected_value = {'value': True})
+    self.storage.put_item(a, 1, expected_value = {'value': False})
+    self.storage.put_item(a, 2, expected_value = {'value': 1})
+    with self.assertRaises(DynamoDBConditionalCheckFailedError):
+      self.storage.put_item(a, 3, expected_value = {'value': 1})
+    self.assertEquals(self.storage.get_item(a)['value'], 2)
+
+  def test_add_and_delete_values(self):
+    a, b = LPCMKey("some_map", "a"), LPCMKey("some_map", "b")
+    self.assertEquals(self.storage.add_to_item(a, 5, return_values = 'UPDATED_NEW'),
+      {'Attributes': {'value': 5}})
+    self.assertEquals(self.storage.add_to_item(a, -2, return_values = 'UPDATED_NEW'),
+      {'Attributes': {'value': 3}})
+    self.storage.add_to_item(b, {1, 2})
+    self.assertEquals(self.storage.add_to_item(b, {3}, return_values = 'UPDATED_NEW'),
+      {'Attributes': {'value': {1, 2, 3}}})
+    self.assertEquals(self.storage.delete_from_item(b, {1, 4}, return_values = 'UPDATED_NEW'),
+      {'Attributes': {'value': {2, 3}}})
+    self.assertEquals(self.storage.delete_from_item(b, {2, 3}, return_values = 'UPDATED_NEW'), {})
+    self.assertNotIn('value', self.storage.get_item(b)) # empty sets are removed
+    self.assertIsNone(self.storage.delete_from_item(b, {1}))
+    with self.assertRaises(DynamoDBValidationError):
+      self.storage.add_to_item(a, {1})
+    with self.assertRaises(DynamoDBValidationError):
+      self.storage.put_item(a, set())
+
+  def test_query(self):
+    keys = [LPCMKey("some_map", i) for i in xrange(10)]
+    self.storage.batch_write(puts = [(key, i) for i, key in enumerate(keys)])
+    self.storage.put_item(LPCMKey("another_map", 1), 1)
+    range_keys = sorted(key.range_key for key in keys)
+    requests = self.storage.stats()['requests']
+    items = list(self.storage.query(keys[0], request_limit = 3))
+    self.assertEquals([item['key'] for item in items], range_keys)
+    self.assertEquals(self.storage.stats()['requests'] - requests, 4) # pages of 3, 3, 3 and 1
+    items = self.storage.query(keys[0], attributes_to_get = ['key'], range_key_condition = GT(range_keys[5]))
+    self.assertEquals([item.keys() for item in items], [['key']] * 4)
+    items = self.storage.query(keys[0], max_results = 2,
+      range_key_condition = BETWEEN(range_keys[2], range_keys[6]))
+    self.assertEquals([item['key'] for item in items], range_keys[2:4])
+    requests = self.storage.stats()['requests']
+    items = self.storage.query(keys[0], request_limit = 3,
+      range_key_condition = BETWEEN(range_keys[1], range_keys[2]))
+    self.assertEquals([item['key'] for item in items], range_keys[1:3])
+    self.assertEquals(self.storage.stats()['requests'] - requests, 1) # stops past the range
+    segments = LPCMKey.range_key_segments(4)
+    self.assertEquals(sorted(item['key'] for item in self.storage.parallel_query(keys[0], segments)),
+      range_keys)
+
+  def test_throttling(self):
+    storage = self.make_storage(latency = (0, 0.001), throttle_rate = 0.5)
+    storage.Constants = type('Constants', (MemoryStorage.Constants,), {'THROTTLE_BACKOFF': 0})
+    for i in xrange(20):
+      storage.add_to_item(LPCMKey("some_map", "a"), 1)
+    self.assertEquals(storage.get_item(LPCMKey("some_map", "a"))['value'], 20)
+    self.assertGreater(storage.stats()['throttled'], 0)
+    storage.throttle_rate = 1
+    with self.assertRaises(DynamoDBResponseError):
+      storage.get_item(LPCMKey("some_map", "a"))
+
+  def test_maps(self):
+    cache.clear()
+    storage._storage = self.storage # the backend of the maps, and of their clean up
+    try:
+      some_map = LPCM(name = "some_map")
+      some_map["a"] = 123
+      some_map.set_many({"b": "some string", "c": 7.890})
+      self.assertEquals(some_map.increment("d", 3), 3)
+      cache.clear()
+      self.assertEquals(some_map["a"], 123)
+      self.assertEquals(some_map.get_many(["b", "c", "e"]), {"b": "some string", "c": 7.890})
+      self.assertEquals(sorted(some_map.keys(segments = 2)), ["a", "b", "c", "d"])
+      self.assertEquals(some_map.pop("a"), 123)
+      some_set = LPCMSet(name = "some_set")
+      some_set["a"] = []
+      self.assertEquals(some_set.insert_values("a", [1, 2]), {1, 2})
+      self.assertEquals(some_set.remove_values("a", [1]), {2})
+      LPCMCleanUp.full_clean_up()
+      self.assertEquals(some_map.keys(), [])
+    finally:
+      storage._storage = None
+
+
+class TestSqliteStorage(TestMemoryStorage):
+
+  def make_storage(self, **kwargs):
+    return SqliteStorage(os.path.join(self.dir, "lpcm.sqlite"), **kwargs)
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    super(TestSqliteStorage, self).setUp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+    super(TestSqliteStorage, self).tearDown()
@@ -0,0 +1,62 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from django.core.cache import cache
+from base import LPCMTestCase
+from ..lpcm import LargePersistentCachedMap as LPCM
+from ..lpcm_set import LargePersistentCachedMapForSets as LPCMSet
+from ..transfer import MapExporter, MapImporter
+from .. import config
+
+@unittest.skipIf(config.LPCM_TEST_USE_LOCAL_CACHE_ONLY, "Disable in CACHE_ONLY mode")
+class TestTransfer(LPCMTestCase):
+
+  def setUp(self):
+    super(TestTransfer, self).setUp()
+    cache.clear()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    super(TestTransfer, self).tearDown()
+
+  def test_export_import(self):
+    for compression in [None, 'gzip']:
+      some_map = LPCMSet(name = "some_map")
+      some_map.set_many({"a": [1, 2], "b": ["x"], "c": []})
+      path = os.path.join(self.directory, "some_map_{}".format(compression))
+      self.assertEquals(MapExporter("some_map", path, compression, page_size = 2).run(), 3)
+      self.assertFalse(os.path.exists(path + ".checkpoint"))
+      some_map.delete_many(["a", "b", "c"])
+      self.assertEquals(MapImporter("some_map", path, compression, page_size = 2).run(), 3)
+      self.assertEquals(some_map.get_many(["a", "b", "c"]),
+        {"a": {1, 2}, "b": {"x"}, "c": set()})
+
+  def test_resume(self):
+    some_map = LPCM(name = "some_map")
+    some_map.set_many({"a": 1, "b": 2, "c": 3})
+    path = os.path.join(self.directory, "some_map")
+    exporter = MapExporter("some_map", path, page_size = 1)
+    self.assertEquals(exporter.run(), 3)
+    with open(path) as f:
+      exported = f.read()
+    # as if interrupted in the middle of the second page
+    first_line = exported.split("\n")[0] + "\n"
+    with open(path, 'ab') as f:
+      f.write("half a line")
+    exporter.save_checkpoint({'last_key': json.loads(first_line)[0], 'offset': len(first_line), 'count': 1})
+    self.assertEquals(exporter.run(resume = True), 3)
+    with open(path) as f:
+      self.assertEquals(f.read(), exported)
+    # as if the import was interrupted after two keys
+    importer = MapImporter("another_map", path)
+    importer.save_checkpoint({'count': 2})
+    self.assertEquals(importer.run(resume = True), 3)
+    self.assertFalse(os.path.exists(path + ".checkpoint"))
+    another_map = LPCM(name = "another_map")
+    self.assertEquals(len(another_map.get_many(["a", "b", "c"])), 1)
@@ -0,0 +1,222 @@
+# Copyright (c) 2012 Yavar Naddaf http://www.empiricalresults.ca/
+# Released Under GNU General Public License. www.gnu.org/licenses/gpl-3.0.txt
+
+import base64
+import gzip
+import json
+import math
+import os
+import time
+from cStringIO import StringIO
+from decimal import Decimal
+from boto.dynamodb.condition import GT
+from boto.dynamodb.types import Binary
+from cache import Cache
+from key import LPCMKey
+from storage import get_storage
+
+class Throttle(object):
+  """ Keeps the consumed capacity under a given number of units per second """
+  def __init__(self, units_per_second):
+    self.units_per_second = float(units_per_second)
+    self.started = time.time()
+    self.consumed = 0.0
+
+  def consume(self, units):
+    self.consumed += units
+    ahead = self.consumed / self.units_per_second - (time.time() - self.started)
+    if ahead > 0:
+      time.sleep(ahead)
+
+
+class MapTransfer(object):
+  """ Base class of MapExporter and MapImporter.
+    Maps are saved as one JSON record per line: [range_key, value]. Values are saved exactly as
+    they are in dynamodb: sets are saved as {"set": [...]}, and binary values (e.g. written with a
+    codec) as {"binary": "<base64>"}.
+    With compression, every page of records is its own gzip member or zstd frame, so that an
+    interrupted export can be truncated to its last checkpoint and resumed.
+  """
+  COMPRESSIONS = (None, 'gzip', 'zstd')
+
+  def __init__(self, map_name, path, compression = None, units_per_second = None, page_size = 100,
+      key_encoding = None):
+    if compression not in self.COMPRESSIONS:
+      raise ValueError("Unknown compression: {}".format(compression))
+    if key_encoding is not None:
+      LPCMKey.set_map_encoding(map_name, key_encoding)
+    self.map_name = map_name
+    self.path = path
+    self.compression = compression
+    self.page_size = page_size
+    self.throttle = Throttle(units_per_second) if units_per_second else None
+    self.checkpoint_path = path + ".checkpoint"
+
+  def load_checkpoint(self):
+    if not os.path.exists(self.checkpoint_path):
+      return None
+    with open(self.checkpoint_path) as f:
+      return json.load(f)
+
+  def save_checkpoint(self, checkpoint):
+    tmp_path = self.checkpoint_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+      json.dump(checkpoint, f)
+    os.rename(tmp_path, self.checkpoint_path) # atomic, so a crash never leaves half a checkpoint
+
+  def _throttle(self, num_bytes, unit_size):
+    if self.throttle:
+      self.throttle.consume(max(1, int(math.ceil(num_bytes / float(unit_size)))))
+
+  @staticmethod
+  def _zstd():
+    try:
+      import zstandard
+    except ImportError:
+      raise ValueError("zstd compression requires the zstandard package")
+    return zstandard
+
+
+class MapExporter(MapTransfer):
+  """ Streams a map to a file, one query page at a time.
+    After each page, the last exported range key (dynamodb's LastEvaluatedKey) and the
+    file size are checkpointed, so that run(resume = True) can carry on after an interruption.
+    e = MapExporter("my_map", "/tmp/my_map.json.gz", compression = 'gzip')
+    num_exported = e.run()
+  """
+  READ_UNIT_SIZE = 4096
+
+  def run(self, resume = False):
+    "Returns the number of exported keys"
+    checkpoint = self.load_checkpoint() if resume else None
+    if checkpoint is None:
+      checkpoint = {'last_key': None, 'offset': 0, 'count': 0}
+    with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+      f.truncate(checkpoint['offset']) # drops whatever was written after the last checkpoint
+      f.seek(checkpoint['offset'])
+      page = []
+      for record in self._records(checkpoint['last_key']):
+        page.append(record)
+        if len(page) >= self.page_size:
+          self._write_page(f, page, checkpoint)
+          page = []
+      if page:
+        self._write_page(f, page, checkpoint)
+    if os.path.exists(self.checkpoint_path):
+      os.remove(self.checkpoint_path)
+    return checkpoint['count']
+
+  def _records(self, last_key):
+    cmp_key = LPCMKey(self.map_name, 'dummy_key')
+    condition = GT(last_key) if last_key else None
+    for item in get_storage().query(cmp_key, request_limit = self.page_size,
+        range_key_condition = condition):
+      if 'value' in item:
+        yield item['key'], item['value']
+
+  def _write_page(self, f, page, checkpoint):
+    data = ''.join(json.dumps([key, value], default = self._encode_value) + "\n" for key, value in page)
+    f.write(self._compress(data))
+    f.flush()
+    os.fsync(f.fileno())
+    checkpoint['last_key'] = page[-1][0]
+    checkpoint['offset'] = f.tell()
+    checkpoint['count'] += len(page)
+    self.save_checkpoint(checkpoint)
+    self._throttle(len(data), self.READ_UNIT_SIZE)
+
+  def _compress(self, data):
+    if self.compression == 'gzip':
+      buf = StringIO()
+      member = gzip.GzipFile(fileobj = buf, mode = 'wb')
+      member.write(data)
+      member.close()
+      return buf.getvalue()
+    if self.compression == 'zstd':
+      return self._zstd().ZstdCompressor().compress(data)
+    return data
+
+  @staticmethod
+  def _encode_value(value):
+    if isinstance(value, (set, frozenset)):
+      return {'set': sorted(value)}
+    if isinstance(value, Binary):
+      return {'binary': base64.b64encode(value.value)}
+    if isinstance(value, Decimal):
+      return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError("Cannot export {!r}".format(value))
+
+
+class MapImporter(MapTransfer):
+  """ Loads a file written by MapExporter into a map, with batched writes.
+    The values are saved in dynamodb as they are in the file, and removed from memcached.
+    The number of imported records is checkpointed after every batch, so that
+    run(resume = True) can skip them after an interruption.
+    i = MapImporter("my_map", "/tmp/my_map.json.gz", compression = 'gzip')
+    num_imported = i.run()
+  """
+  WRITE_UNIT_SIZE = 1024
+  READ_SIZE = 64 * 1024
+
+  def run(self, resume = False):
+    "Returns the number of imported keys"
+    checkpoint = self.load_checkpoint() if resume else None
+    if checkpoint is None:
+      checkpoint = {'count': 0}
+    to_skip = checkpoint['count']
+    cache = Cache(None)
+    page = []
+    for line in self._lines():
+      if to_skip:
+        to_skip -= 1
+        continue
+      page.append(line)
+      if len(page) >= self.page_size:
+        self._import_page(page, cache, checkpoint)
+        page = []
+    if page:
+      self._import_page(page, cache, checkpoint)
+    if os.path.exists(self.checkpoint_path):
+      os.remove(self.checkpoint_path)
+    return checkpoint['count']
+
+  def _import_page(self, page, cache, checkpoint):
+    puts = []
+    for line in page:
+      range_key, value = json.loads(line, object_hook = self._decode_value)
+      key = LPCMKey.decode_range_key(range_key, LPCMKey.map_encoding(self.map_name))
+      puts.append((LPCMKey(self.map_name, key), value))
+    get_storage().batch_write(puts = puts)
+    cache.delete_many([cmp_key.cache_key for cmp_key, value in puts])
+    checkpoint['count'] += len(page)
+    self.save_checkpoint(checkpoint)
+    self._throttle(sum(len(line) for line in page), self.WRITE_UNIT_SIZE)
+
+  def _lines(self):
+    with open(self.path, 'rb') as raw:
+      if self.compression == 'gzip':
+        f = gzip.GzipFile(fileobj = raw, mode = 'rb') # reads all the members
+      elif self.compression == 'zstd':
+        f = self._zstd().ZstdDecompressor().stream_reader(raw, read_across_frames = True)
+      else:
+        f = raw
+      pending = ''
+      while True:
+        data = f.read(self.READ_SIZE)
+        if not data:
+          break
+        lines = (pending + data).split("\n")
+        pending = lines.pop()
+        for line in lines:
+          if line:
+            yield line
+      if pending:
+        yield pending
+
+  @staticmethod
+  def _decode_value(obj):
+    if obj.keys() == ['set']:
+      return set(obj['set'])
+    if obj.keys() == ['binary']:
+      return Binary(base64.b64decode(obj['binary']))
+    return obj